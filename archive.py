@@ -0,0 +1,180 @@
+"""
+Zip writer that deflates entries on a thread pool
+"""
+import collections
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import BinaryIO, Deque, List, Optional
+
+import instrument
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+#: default deflate level, zlib's own default
+DEFAULT_LEVEL = 6
+
+#: entries already compressed by their format, deflating them only costs time
+STORED_EXTENSIONS = {
+    'jpg', 'jpeg', 'png', 'gif', 'webp', 'avif', 'heic', 'svgz',
+    'mp3', 'mp4', 'm4a', 'm4v', 'ogg', 'oga', 'webm', 'opus',
+    'woff', 'woff2', 'zip', 'gz',
+}
+
+#: threads entries are deflated on
+DEFLATE_THREADS = min(4, os.cpu_count() or 1)
+
+#: entries below this are deflated on the calling thread, a hand-off costs more
+INLINE_BYTES = 16 * 1024
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+END_RECORD = struct.Struct('<IHHHHIIH')
+ZIP64_END_RECORD = struct.Struct('<IQHHIIQQQQ')
+ZIP64_LOCATOR = struct.Struct('<IIQI')
+ZIP64_OFFSET = struct.Struct('<HHQ')
+
+#: names are utf-8
+UTF8_FLAG = 0x800
+#: made by unix, zip 4.5
+MADE_BY = (3 << 8) | 45
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+
+
+def compress_type(name: str) -> int:
+    """Whether an entry is stored as is (already compressed media) or deflated."""
+    extension = name.rsplit('.', 1)[-1].lower() if '.' in name.rsplit('/', 1)[-1] else ''
+    return ZIP_STORED if extension in STORED_EXTENSIONS else ZIP_DEFLATED
+
+
+@dataclass
+class Entry:
+    name: bytes
+    method: int
+    crc: int
+    size: int
+    data: Optional[bytes]
+    dos_time: int
+    dos_date: int
+    compressed: int = 0
+    offset: int = 0
+
+
+def dos_datetime(timestamp: float):
+    year, month, day, hour, minute, second = time.localtime(timestamp)[:6]
+    year = max(year, 1980)
+    return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
+
+
+def pack(name: str, data: bytes, method: int, level: int, timestamp: float) -> Entry:
+    """Checksum and (unless stored) deflate one entry, releases the GIL for large data."""
+    crc = zlib.crc32(data)
+    if method == ZIP_DEFLATED:
+        with instrument.stage('deflate'):
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            packed = compressor.compress(data) + compressor.flush()
+    else:
+        packed = data
+    return Entry(name.encode('utf-8'), method, crc, len(data), packed, *dos_datetime(timestamp))
+
+
+class ZipWriter:
+    """Write a zip archive whose entries are deflated concurrently.
+
+    ``write`` hands every entry to a pool of ``threads`` threads (zlib
+    releases the GIL while it compresses) and returns. Entries are
+    appended to the file in the order they were written as soon as they
+    are packed, with at most ``pending`` of them in flight, so memory stays
+    bounded. Entries named like already compressed media are stored as
+    is. ``close`` writes what is left and the central directory. Zip64
+    records are added when there are too many entries for a plain zip.
+    Writes must be serialized by the caller.
+    """
+
+    def __init__(self, path: str, level: int = DEFAULT_LEVEL, threads: int = DEFLATE_THREADS,
+                 pending: Optional[int] = None):
+        self.file: Optional[BinaryIO] = open(path, 'wb')
+        self.level = level
+        self.pool = ThreadPoolExecutor(threads) if threads > 1 else None
+        self.pending_limit = pending or 2 * threads
+        self.pending: Deque[Future] = collections.deque()
+        self.entries: List[Entry] = []
+
+    def write(self, name: str, data: bytes, method: Optional[int] = None):
+        """Add an entry, stored or deflated as ``method`` (by default after its name) says."""
+        if len(data) >= ZIP64_LIMIT:
+            raise ValueError(f'{name} is too large for a zip entry')
+        method = compress_type(name) if method is None else method
+        args = (name, data, method, self.level, time.time())
+        if self.pool is None or (len(data) < INLINE_BYTES and not self.pending):
+            self.append(pack(*args))
+            return
+        self.pending.append(self.pool.submit(pack, *args))
+        while self.pending and (self.pending[0].done() or len(self.pending) > self.pending_limit):
+            self.append(self.pending.popleft().result())
+
+    def flush(self):
+        """Write every entry still being packed."""
+        while self.pending:
+            self.append(self.pending.popleft().result())
+
+    def append(self, entry: Entry):
+        with instrument.stage('zip_write'):
+            entry.offset = self.file.tell()
+            entry.compressed = len(entry.data)
+            self.file.write(LOCAL_HEADER.pack(
+                0x04034b50, 20, UTF8_FLAG, entry.method, entry.dos_time, entry.dos_date,
+                entry.crc, entry.compressed, entry.size, len(entry.name), 0))
+            self.file.write(entry.name)
+            self.file.write(entry.data)
+        # the central directory needs everything but the data
+        entry.data = None
+        self.entries.append(entry)
+
+    def write_directory(self):
+        start = self.file.tell()
+        for entry in self.entries:
+            extra = b''
+            offset = entry.offset
+            if offset >= ZIP64_LIMIT:
+                extra = ZIP64_OFFSET.pack(1, 8, offset)
+                offset = ZIP64_LIMIT
+            self.file.write(CENTRAL_HEADER.pack(
+                0x02014b50, MADE_BY, 45 if extra else 20, UTF8_FLAG, entry.method,
+                entry.dos_time, entry.dos_date, entry.crc, entry.compressed, entry.size,
+                len(entry.name), len(extra), 0, 0, 0, 0o644 << 16, offset))
+            self.file.write(entry.name)
+            self.file.write(extra)
+        end = self.file.tell()
+        count, size = len(self.entries), end - start
+        if count >= ZIP64_COUNT_LIMIT or start >= ZIP64_LIMIT or size >= ZIP64_LIMIT:
+            self.file.write(ZIP64_END_RECORD.pack(
+                0x06064b50, ZIP64_END_RECORD.size - 12, MADE_BY, 45, 0, 0, count, count, size, start))
+            self.file.write(ZIP64_LOCATOR.pack(0x07064b50, 0, end, 1))
+            count, size, start = (min(count, ZIP64_COUNT_LIMIT), min(size, ZIP64_LIMIT),
+                                  min(start, ZIP64_LIMIT))
+        self.file.write(END_RECORD.pack(0x06054b50, 0, 0, count, count, size, start, 0))
+
+    def close(self):
+        """Finish the archive."""
+        if self.file is None:
+            return
+        try:
+            self.flush()
+            self.write_directory()
+        finally:
+            self.discard()
+
+    def discard(self):
+        """Close the file without finishing the archive."""
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+        self.pending.clear()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
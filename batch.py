@@ -0,0 +1,162 @@
+import json
+import re
+from dataclasses import dataclass, field, fields
+from typing import List, Optional, Union
+
+try:
+    import yaml
+except ModuleNotFoundError:
+    yaml = None
+
+LINK_ENGINES = ["soup", "lxml"]
+DISCOVER_MODES = ["page", "auto", "sitemap", "feed"]
+
+
+def compile_patterns(patterns: Union[str, List[str], None]) -> List[re.Pattern]:
+    if patterns is None:
+        return []
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    return [re.compile(pattern) for pattern in patterns]
+
+
+@dataclass
+class LinkFilter:
+    """Headless replacement for the link selection window.
+
+    Links matching none of ``include`` (when given) or any of ``exclude``
+    are dropped, the rest are optionally reversed and cut to ``max_posts``.
+    """
+    include: Union[str, List[str], None] = None
+    exclude: Union[str, List[str], None] = None
+    reverse: bool = False
+    max_posts: Optional[int] = None
+
+    def __post_init__(self):
+        self.include_patterns = compile_patterns(self.include)
+        self.exclude_patterns = compile_patterns(self.exclude)
+
+    def __call__(self, links: List[str]) -> List[str]:
+        if self.include_patterns:
+            links = [link for link in links
+                     if any(p.search(link) for p in self.include_patterns)]
+        links = [link for link in links
+                 if not any(p.search(link) for p in self.exclude_patterns)]
+        if self.reverse:
+            links = links[::-1]
+        if self.max_posts is not None:
+            links = links[:self.max_posts]
+        return links
+
+
+@dataclass
+class Job:
+    """One blog of a batch manifest, the keys mirror the command line options."""
+    url: str
+    title: Optional[str] = None
+    cover: Optional[str] = None
+    add_cover_text: bool = True
+    update: Optional[str] = None
+    link_engine: str = "soup"
+    discover: str = "page"
+    crawl: bool = False
+    max_pages: int = 50
+    max_depth: Optional[int] = None
+    include: Union[str, List[str], None] = None
+    exclude: Union[str, List[str], None] = None
+    reverse: bool = False
+    max_posts: Optional[int] = None
+    link_filter: LinkFilter = field(init=False)
+
+    def __post_init__(self):
+        self.link_filter = LinkFilter(self.include, self.exclude, self.reverse, self.max_posts)
+
+
+JOB_KEYS = {f.name for f in fields(Job) if f.init}
+
+#: what each option accepts: types (None when it may be left out), or choices
+JOB_TYPES = {
+    "url": (str,),
+    "title": (str, None),
+    "cover": (str, None),
+    "add_cover_text": (bool,),
+    "update": (str, None),
+    "link_engine": LINK_ENGINES,
+    "discover": DISCOVER_MODES,
+    "crawl": (bool,),
+    "max_pages": (int,),
+    "max_depth": (int, None),
+    "include": (str, list, None),
+    "exclude": (str, list, None),
+    "reverse": (bool,),
+    "max_posts": (int, None),
+}
+
+
+def option_error(name: str, value) -> Optional[str]:
+    """Why a job option has an invalid value, None when it is valid."""
+    accepted = JOB_TYPES[name]
+    if isinstance(accepted, list):
+        return None if value in accepted else f"{name} must be one of {accepted}"
+    if value is None:
+        return None if None in accepted else f"{name} must be set"
+    # bool is an int too, but true is not a number of pages
+    if not any(isinstance(value, kind) and not (kind is int and isinstance(value, bool))
+               for kind in accepted if kind is not None):
+        names = " or ".join("null" if kind is None else kind.__name__ for kind in accepted)
+        return f"{name} must be {names}, not {type(value).__name__}"
+    if isinstance(value, list) and not all(isinstance(item, str) for item in value):
+        return f"{name} must be a list of strings"
+    if isinstance(value, int) and not isinstance(value, bool) and value < (1 if name == "max_pages" else 0):
+        return f"{name} must not be {value}"
+    return None
+
+
+def parse_job(options: dict, where: str) -> Job:
+    """Build a Job from a mapping of options, ``where`` names it in errors."""
+    unknown = set(options) - JOB_KEYS
+    if unknown:
+        raise ValueError(f"{where} has unknown options {sorted(unknown)}")
+    if "url" not in options:
+        raise ValueError(f"{where} has no url")
+    for name, value in options.items():
+        error = option_error(name, value)
+        if error:
+            raise ValueError(f"{where}: {error}")
+    return Job(**options)
+
+
+def load_manifest(path: str) -> List[Job]:
+    """Read a batch manifest.
+
+    The manifest is YAML (or JSON, which is all that is accepted when PyYAML
+    is not installed) holding either a list of blogs or a mapping with a
+    ``blogs`` list and ``defaults`` applied to every blog. A blog is a url or
+    a mapping of options.
+    """
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    if yaml is not None:
+        try:
+            manifest = yaml.safe_load(text)
+        except yaml.YAMLError as e:
+            raise ValueError(f"{path}: {e}") from e
+    else:
+        try:
+            manifest = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"{path}: not valid JSON, install PyYAML to read YAML manifests") from e
+
+    defaults = {}
+    if isinstance(manifest, dict):
+        defaults = manifest.get("defaults") or {}
+        manifest = manifest.get("blogs")
+    if not isinstance(manifest, list):
+        raise ValueError(f"{path}: expected a list of blogs")
+
+    jobs = []
+    for number, entry in enumerate(manifest, 1):
+        if isinstance(entry, str):
+            entry = {"url": entry}
+        jobs.append(parse_job({**defaults, **entry}, f"{path}: blog #{number}"))
+    return jobs
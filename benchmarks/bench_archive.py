@@ -0,0 +1,85 @@
+"""Benchmark writing the epub archive against zipfile.
+
+Run from the repository root:
+
+    python benchmarks/bench_archive.py [--chapters 300] [--images 100] [--levels 1 6 9]
+
+The entries are a synthetic book: chapters of synthetic blog posts and
+noisy photo-like JPEGs re-encoded like the image pipeline does. The
+previous writer deflated every entry, images included, with
+``zipfile.ZipFile.writestr`` on the calling thread. ``ZipWriter`` stores
+the images and deflates the chapters on its threads.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import zipfile
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # noqa: E402
+
+from archive import DEFLATE_THREADS, ZIP_STORED, ZipWriter  # noqa: E402
+from blogserver import SyntheticBlog  # noqa: E402
+
+
+def book_entries(chapters: int, images: int, paragraphs: int):
+    blog = SyntheticBlog(posts=chapters, paragraphs=paragraphs, images=0)
+    entries = [('mimetype', b'application/epub+zip')]
+    entries += [(f'OEBPS/chapter_{n}.xhtml', blog.post(n)) for n in range(chapters)]
+    for n in range(images):
+        img = Image.effect_noise((800, 600), 40 + n % 30).convert('RGB')
+        out = BytesIO()
+        img.save(out, 'JPEG', quality=80, optimize=True)
+        entries.append((f'OEBPS/images/image-{n}.jpeg', out.getvalue()))
+    return entries
+
+
+def write_zipfile(path, entries, level):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, compresslevel=level) as archive:
+        for name, data in entries:
+            archive.writestr(name, data, zipfile.ZIP_STORED if name == 'mimetype' else None)
+
+
+def write_archive(path, entries, level, threads):
+    archive = ZipWriter(path, level, threads)
+    for name, data in entries:
+        archive.write(name, data, ZIP_STORED if name == 'mimetype' else None)
+    archive.close()
+
+
+def timed(write, path, *args):
+    start = time.perf_counter()
+    write(path, *args)
+    return time.perf_counter() - start, os.path.getsize(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chapters', type=int, default=300)
+    parser.add_argument('--paragraphs', type=int, default=40)
+    parser.add_argument('--images', type=int, default=100)
+    parser.add_argument('--levels', type=int, nargs='+', default=[1, 6, 9])
+    parser.add_argument('--threads', type=int, default=DEFLATE_THREADS)
+    args = parser.parse_args()
+
+    entries = book_entries(args.chapters, args.images, args.paragraphs)
+    total = sum(len(data) for _, data in entries)
+    print(f'{len(entries)} entries, {total / 2 ** 20:.1f} MB, {args.threads} threads')
+    print(f"{'level':>5} {'zipfile s':>9} {'MB':>6} {'archive s':>9} {'MB':>6} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as scratch:
+        path = os.path.join(scratch, 'book.epub')
+        for level in args.levels:
+            previous, previous_size = timed(write_zipfile, path, entries, level)
+            new, size = timed(write_archive, path, entries, level, args.threads)
+            with zipfile.ZipFile(path) as archive:
+                assert archive.testzip() is None
+            print(f'{level:>5} {previous:>9.3f} {previous_size / 2 ** 20:>6.2f} '
+                  f'{new:>9.3f} {size / 2 ** 20:>6.2f} {previous / new:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
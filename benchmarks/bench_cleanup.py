@@ -0,0 +1,167 @@
+"""Benchmark the chapter sanitizer against the previous cleanup_html.
+
+Run from the repository root:
+
+    python benchmarks/bench_cleanup.py [--wrappers 1000 5000] [--depth 20]
+
+Each post is a run of paragraphs buried in nested wrapper div/span/section
+elements. The previous implementation is reproduced below as it was,
+parsing with pyxml and unwrapping elements one child at a time.
+
+The content root lookup is then timed alone, with the heuristic selectors
+against the selector learned from the first posts of the site, once for
+posts marked up with ``articleBody`` (the first heuristic) and once for
+posts where every heuristic but ``body`` misses.
+"""
+import argparse
+import os
+import sys
+import time
+import urllib.parse
+from typing import cast
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lxml.html  # noqa: E402
+import pyxml.html  # noqa: E402
+from pypub.factory import REPLACE, SUPPORTED_TAGS, HtmlElement  # noqa: E402
+
+import sanitize  # noqa: E402
+from sitetemplate import SAMPLE_POSTS, SiteTemplates  # noqa: E402
+
+
+def previous_cleanup_html(content: bytes):
+    """cleanup_html from pypubpatch before the single pass sanitizer"""
+    content = content.decode('utf-8', 'replace').translate(REPLACE).encode()
+    etree_original = pyxml.html.fromstring(content)
+    etree = etree_original
+    body = etree_original.xpath('.//body')
+    etree = body[0] if body else etree
+    content = etree_original.xpath('//*[@class = "content"]')
+    etree = content[0] if content else etree
+    article = etree_original.xpath('.//article')
+    etree = article[0] if article else etree
+    post_content = etree_original.xpath('//*[contains(@class, "content")][contains(@class, "post")]')
+    etree = post_content[0] if post_content else etree
+    article_body = etree_original.xpath('//*[contains(@itemprop, "articleBody")]')
+    etree = article_body[0] if article_body else etree
+    for elem in [elem for elem in etree.iter()][1:]:
+        if elem.tag in SUPPORTED_TAGS:
+            for attr, value in list(elem.attrib.items()):
+                if attr not in SUPPORTED_TAGS[elem.tag] or not value:
+                    elem.attrib.pop(attr)
+                elif attr == 'href':
+                    elem.attrib['href'] = urllib.parse.quote(elem.attrib['href'])
+        else:
+            parent = cast(HtmlElement, elem.getparent())
+            for child in elem.getchildren():
+                parent.append(child)
+            parent.remove(elem)
+            if elem.tail and elem.tail.strip():
+                parent.text = (parent.text or '') + elem.tail.strip()
+    for img in etree.xpath('.//img'):
+        if 'src' not in img.attrib:
+            cast(HtmlElement, img.getparent()).remove(img)
+        elif 'alt' not in img.attrib:
+            img.attrib['alt'] = img.attrib['src']
+    return etree
+
+
+def new_cleanup_html(content: bytes):
+    return sanitize.cleanup_html(content)
+
+
+#: posts with scripts, styles and embeds, whose text must not end up in the chapter
+NON_CONTENT_POSTS = [
+    b'<article><p>Hello</p><script>var tracking = 1;</script><style>.a{color:red}</style>'
+    b'<p>World</p></article>',
+    b'<html><body><article><p>Hello</p><iframe src="https://x.example/embed">no frames</iframe>'
+    b'<form action="/s"><select><option>a</option></select><button>Go</button></form>'
+    b'<p>World <noscript>enable javascript</noscript>again</p></article></body></html>',
+]
+
+
+def outline(root):
+    """Tags and text of a cleaned element, comparable across pyxml and lxml."""
+    return [(elem.tag, (elem.text or '').strip(), (elem.tail or '').strip()) for elem in root.iter()]
+
+
+def check_non_content():
+    """The sanitizer leaves out the text of scripts, styles and embeds, like before."""
+    for content in NON_CONTENT_POSTS:
+        previous, new = outline(previous_cleanup_html(content)), outline(new_cleanup_html(content))
+        assert previous == new, f'{content!r}: {previous} != {new}'
+
+
+def synthetic_post(wrappers: int, depth: int) -> bytes:
+    """Generate a post with ``wrappers`` groups of ``depth`` nested wrappers."""
+    parts = ['<html><head><title>Post | Blog</title></head><body><nav><a href="/">home</a></nav>',
+             '<article><div class="content post" itemprop="articleBody">']
+    tags = (['section', 'div', 'span'] * depth)[:depth]
+    for i in range(wrappers):
+        opening = ''.join(f'<{tag} class="w{d}">' for d, tag in enumerate(tags))
+        closing = ''.join(f'</{tag}>' for tag in reversed(tags))
+        parts.append(f'{opening}<p id="p{i}" style="color: red">Paragraph {i} with '
+                     f'<a href="/post/{i}?a=1" rel="nofollow">a link</a> and '
+                     f'<img src="/img/{i}.png" class="inline"> text.</p>{closing}')
+    parts.append('</div></article></body></html>')
+    return ''.join(parts).encode()
+
+
+def plain_post(wrappers: int, depth: int) -> bytes:
+    """The synthetic post without any markup the heuristic selectors look for."""
+    return synthetic_post(wrappers, depth) \
+        .replace(b' class="content post" itemprop="articleBody"', b' class="entry"') \
+        .replace(b'<article>', b'<div class="main">').replace(b'</article>', b'</div>')
+
+
+def time_roots(content: bytes, posts: int = 20):
+    """Mean content root lookup time per post, heuristics and learned."""
+    documents = [lxml.html.document_fromstring(content.replace(b'Paragraph 1 ', f'Paragraph {n} '.encode()))
+                 for n in range(SAMPLE_POSTS + posts)]
+    templates = SiteTemplates()
+    for document in documents[:SAMPLE_POSTS]:
+        templates.content_root(document, 'http://blog.example/')
+    times = []
+    for lookup in (sanitize.content_root, lambda document: templates.content_root(document, 'http://blog.example/')):
+        start = time.perf_counter()
+        for document in documents[SAMPLE_POSTS:]:
+            lookup(document)
+        times.append((time.perf_counter() - start) / posts)
+    return times
+
+
+def timed(fn, content, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(content)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--wrappers', type=int, nargs='+', default=[200, 1000, 3000])
+    parser.add_argument('--depth', type=int, default=12)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    check_non_content()
+
+    print(f"{'wrappers':>8} {'KB':>6} {'previous s':>10} {'sanitizer s':>11} {'speedup':>8}")
+    for wrappers in args.wrappers:
+        content = synthetic_post(wrappers, args.depth)
+        previous = timed(previous_cleanup_html, content, args.repeat)
+        new = timed(new_cleanup_html, content, args.repeat)
+        print(f"{wrappers:>8} {len(content) // 1024:>6} {previous:>10.3f} {new:>11.3f} {previous / new:>7.1f}x")
+
+    print(f"\n{'layout':>12} {'wrappers':>8} {'heuristics ms':>13} {'learned ms':>10}")
+    for layout, make in (('articleBody', synthetic_post), ('plain', plain_post)):
+        for wrappers in args.wrappers:
+            heuristics, learned = time_roots(make(wrappers, args.depth))
+            print(f"{layout:>12} {wrappers:>8} {heuristics * 1000:>13.3f} {learned * 1000:>10.3f}")
+
+
+if __name__ == '__main__':
+    main()
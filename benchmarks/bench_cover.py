@@ -0,0 +1,119 @@
+"""Benchmark cover text fitting against the previous pil_autowrap.fit_text.
+
+Run from the repository root:
+
+    python benchmarks/bench_cover.py [--covers 200] [--words 4 12 40]
+
+Each cover fits a title of the given number of words and a url, the same
+way add_formatted_text_to_cover does. The previous implementation is
+reproduced below as it was: it loaded the font for every cover, stepped
+down through the font sizes geometrically and re-measured every line as
+it grew.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import ImageFont  # noqa: E402
+
+import pil_autowrap  # noqa: E402
+import utils  # noqa: E402
+
+FONT = "fonts/OpenSans-Regular.ttf"
+
+
+def previous_try_fit_text(font, text, max_width, max_height, spacing=4, direction="ltr"):
+    """try_fit_text from pil_autowrap before cached word advances"""
+    line_height = font.size
+    if line_height > max_height:
+        return None
+    lines = [""]
+    curr_line_width = 0
+    for word in text.split():
+        if curr_line_width == 0:
+            word_width = font.getlength(word, direction)
+            if word_width > max_width:
+                return None
+            lines[-1] = word
+            curr_line_width = word_width
+        else:
+            new_line_width = font.getlength(f"{lines[-1]} {word}", direction)
+            if new_line_width > max_width:
+                word_width = font.getlength(word, direction)
+                new_num_lines = len(lines) + 1
+                new_text_height = (new_num_lines * line_height) + (new_num_lines * spacing)
+                if word_width > max_width or new_text_height > max_height:
+                    return None
+                lines.append(word)
+                curr_line_width = word_width
+            else:
+                lines[-1] = f"{lines[-1]} {word}"
+                curr_line_width = new_line_width
+    return "\n".join(lines)
+
+
+def previous_fit_text(font, text, max_width, max_height, spacing=4, scale_factor=0.8,
+                      max_iterations=5, direction="ltr"):
+    """fit_text from pil_autowrap before the binary search"""
+    for i in range(max_iterations):
+        trial_font = font.font_variant(size=int(font.size * pow(scale_factor, i)))
+        wrapped_text = previous_try_fit_text(trial_font, text, max_width, max_height,
+                                             spacing, direction)
+        if wrapped_text:
+            return trial_font, wrapped_text
+    return trial_font, pil_autowrap.wrap_text(trial_font, text, max_width, direction)
+
+
+def previous_cover(title, url):
+    font = ImageFont.truetype(FONT, size=100)
+    return (previous_fit_text(font, title, 284, 120, max_iterations=10),
+            previous_fit_text(font, url, 284, 14, max_iterations=10))
+
+
+def new_cover(title, url):
+    font = utils.load_font(FONT, 100)
+    return (pil_autowrap.fit_text(font, title, 284, 120, max_iterations=10),
+            pil_autowrap.fit_text(font, url, 284, 14, max_iterations=10))
+
+
+def synthetic_titles(covers: int, words: int):
+    rng = random.Random(words)
+    vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 11)))
+                  for _ in range(500)]
+    return [(' '.join(rng.choice(vocabulary) for _ in range(words)).title(),
+             f'https://{rng.choice(vocabulary)}.example.com/blog/archive/page/{i}')
+            for i in range(covers)]
+
+
+def measure(fn, jobs):
+    start = time.perf_counter()
+    results = [fn(title, url) for title, url in jobs]
+    return time.perf_counter() - start, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--covers', type=int, default=200)
+    parser.add_argument('--words', type=int, nargs='+', default=[4, 12, 40])
+    args = parser.parse_args()
+
+    print(f"{'words':>6} {'previous s':>11} {'new s':>8} {'speedup':>8} {'larger':>7}")
+    for words in args.words:
+        jobs = synthetic_titles(args.covers, words)
+        previous_time, previous = measure(previous_cover, jobs)
+        new_time, new = measure(new_cover, jobs)
+        # the search may pick a larger size than the geometric steps, never a smaller one
+        larger = 0
+        for (old_title, old_url), (new_title, new_url) in zip(previous, new):
+            assert new_title[0].size >= old_title[0].size and new_url[0].size >= old_url[0].size
+            larger += new_title[0].size > old_title[0].size
+        print(f'{words:>6} {previous_time:>11.3f} {new_time:>8.3f} '
+              f'{previous_time / new_time:>7.1f}x {larger:>7}')
+
+
+if __name__ == '__main__':
+    main()
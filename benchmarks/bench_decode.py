@@ -0,0 +1,80 @@
+"""Benchmark decoding and parsing fetched pages against the previous paths.
+
+Run from the repository root:
+
+    python benchmarks/bench_decode.py [--sizes 1 4 16]
+
+Each page is a synthetic archive page of about the given size in MB, with
+non-ascii text and no charset in its headers. The previous text path
+decoded it like ``requests.Response.text``, which guesses the charset
+over the whole body when the headers name none. The previous chapter path
+decoded, translated and re-encoded the bytes before lxml parsed them.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lxml.html  # noqa: E402
+import requests  # noqa: E402
+from pypub.factory import REPLACE  # noqa: E402
+
+from decode import decode_html, parse_html  # noqa: E402
+
+ENTRY = ('<li><a href="/posts/{n}">Post {n}: “naïve” café notes – part {n}</a> '
+         '<span class="date">{n} days ago</span></li>\n')
+
+
+def archive_page(megabytes: float) -> bytes:
+    entries = []
+    size, n = 0, 0
+    while size < megabytes * 2 ** 20:
+        entry = ENTRY.format(n=n)
+        entries.append(entry)
+        size += len(entry.encode())
+        n += 1
+    return f'<html><head><title>Archive</title></head><body><ul>{"".join(entries)}</ul></body></html>'.encode()
+
+
+def previous_text(content: bytes) -> str:
+    """FetchResult.text before, decoding like requests (no charset header)"""
+    response = requests.Response()
+    response._content = content
+    response.encoding = None
+    return response.text
+
+
+def previous_parse(content: bytes):
+    """cleanup_html's parse before, through a decoded and translated copy"""
+    return lxml.html.document_fromstring(content.decode('utf-8', 'replace').translate(REPLACE).encode())
+
+
+def timed(fn, content, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(content)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'MB':>5} {'text before s':>13} {'text s':>7} {'parse before s':>14} {'parse s':>8}")
+    for megabytes in args.sizes:
+        content = archive_page(megabytes)
+        assert previous_text(content) == decode_html(content)
+        print(f'{megabytes:>5} {timed(previous_text, content, args.repeat):>13.3f} '
+              f'{timed(decode_html, content, args.repeat):>7.3f} '
+              f'{timed(previous_parse, content, args.repeat):>14.3f} '
+              f'{timed(parse_html, content, args.repeat):>8.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Benchmark the link detection engines on synthetic index pages.
+
+Run from the repository root:
+
+    python benchmarks/bench_links.py [--sizes 10000 30000 100000]
+
+Each page is an archive list of posts wrapped in layout markup, with
+navigation and sidebar links as noise. Both engines must return the same
+links. Each engine runs in a fresh process, which reports its wall time and
+how far its peak RSS rose above its RSS before the run. This counts the
+C allocations of lxml and libxml2 that tracemalloc does not see.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from links import find_post_links  # noqa: E402
+from utils import find_post_links_soup  # noqa: E402
+
+URL = "https://example.com/archive/"
+
+
+def synthetic_index(elements: int, nesting: int = 4, seed: int = 0) -> bytes:
+    """Generate an index page with roughly ``elements`` elements."""
+    rng = random.Random(seed)
+    per_post = 4 + nesting
+    posts = max(1, (elements - 200) // per_post)
+    parts = ['<!DOCTYPE html><html><head><meta charset="utf-8"><title>Archive | Blog</title></head><body>']
+    parts.append('<nav class="menu"><ul>')
+    parts += [f'<li><a href="/page-{i}">Page {i}</a></li>' for i in range(20)]
+    parts.append('</ul></nav><main><div class="archive">')
+    for i in range(posts):
+        open_tags = ''.join(f'<div class="wrap-{d}">' for d in range(nesting))
+        close_tags = '</div>' * nesting
+        tags = ' '.join(rng.choice(['python', 'rust', 'notes']) for _ in range(2))
+        parts.append(
+            f'<article class="post post-{i}">{open_tags}'
+            f'<h2><a href="/posts/{i}/">Post {i}</a></h2>'
+            f'<span class="date">2024-01-{i % 28 + 1:02d}</span>'
+            f'<p>{tags}</p>{close_tags}</article>'
+        )
+    parts.append('</div></main><aside>')
+    parts += [f'<p><a href="/tag/{i}">tag {i}</a></p>' for i in range(30)]
+    parts.append('</aside></body></html>')
+    return ''.join(parts).encode()
+
+
+def memory_kb(field: str) -> int:
+    """A memory figure of this process from /proc, in kilobytes."""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(f'{field}:'):
+                return int(line.split()[1])
+    raise OSError(f'no {field} in /proc/self/status')
+
+
+def run_engine(engine: str, size: int, nesting: int, results):
+    content = synthetic_index(size, nesting)
+    before = memory_kb('VmRSS')
+    start = time.perf_counter()
+    if engine == 'soup':
+        links = find_post_links_soup(content.decode(), URL)
+    else:
+        links = find_post_links(content, URL)
+    elapsed = time.perf_counter() - start
+    results.put((links, elapsed, memory_kb('VmHWM') - before))
+
+
+def measure(engine: str, size: int, nesting: int):
+    """Run one engine in a fresh process: its links, seconds and peak RSS growth in kB."""
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=run_engine, args=(engine, size, nesting, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 30_000, 100_000])
+    parser.add_argument('--nesting', type=int, default=4)
+    args = parser.parse_args()
+
+    print(f"{'elements':>9} {'engine':>6} {'links':>6} {'seconds':>8} {'+RSS MB':>8}")
+    for size in args.sizes:
+        soup_links, soup_time, soup_peak = measure('soup', size, args.nesting)
+        lxml_links, lxml_time, lxml_peak = measure('lxml', size, args.nesting)
+        print(f"{size:>9} {'soup':>6} {len(soup_links):>6} {soup_time:>8.3f} {soup_peak / 1024:>8.1f}")
+        print(f"{size:>9} {'lxml':>6} {len(lxml_links):>6} {lxml_time:>8.3f} {lxml_peak / 1024:>8.1f}")
+        if soup_links != lxml_links:
+            sys.exit(f"engines disagree on the {size} element page")
+
+
+if __name__ == '__main__':
+    main()
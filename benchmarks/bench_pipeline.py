@@ -0,0 +1,261 @@
+"""End to end pipeline benchmark against a local synthetic blog.
+
+Run from the repository root:
+
+    python benchmarks/bench_pipeline.py [--scenario default small] [--repeat 3]
+    python benchmarks/bench_pipeline.py --scenario default --save-baseline
+
+A blogserver.SyntheticBlog is served on a local port and each stage of a
+headless build is timed in a fresh process, so every stage reports its own
+peak RSS:
+
+- links:  crawl the archive and detect post links
+- fetch:  download every post
+- render: clean, render and zip the fetched posts with their images
+- build:  the whole of create_epub, as `blogtoepub.py --crawl --no-ui` runs it
+
+Results are compared with benchmarks/baseline.json. A stage regresses when
+its wall time or peak RSS grows by more than --tolerance, or when it
+produces fewer items than the baseline; the exit status is 1 if any did.
+The HTTP cache is disabled so every run does the same network work.
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import dataclasses
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import zipfile
+from typing import Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from blogserver import SyntheticBlog, serve  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+SCENARIOS = {
+    'small': SyntheticBlog(posts=50, page_size=25),
+    'default': SyntheticBlog(posts=300, page_size=50, latency=0.005),
+    'large-index': SyntheticBlog(posts=3000, page_size=1000, nesting=6, paragraphs=5, images=0),
+    'flaky': SyntheticBlog(posts=200, page_size=50, latency=0.02, error_rate=0.05),
+    'duplicates': SyntheticBlog(posts=200, page_size=50, latency=0.005, url_variants=0.2, reposts=0.1),
+    'sitemap': SyntheticBlog(posts=5000, page_size=50, latency=0.005, paragraphs=5, images=0,
+                             sitemaps=True),
+}
+
+STAGES = ['links', 'fetch', 'render', 'build']
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss survives exec on Linux (it would include the parent's peak),
+    # the high water mark of the process' own address space does not
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def run_stage(stage: str, url: str, pages: int, options: Optional[dict] = None) -> dict:
+    """Run one stage in this (fresh) process and measure it."""
+    os.chdir(ROOT)
+    logging.disable(logging.CRITICAL)
+    import pypub
+    from blogtoepub import create_epub
+    from crawl import crawl_post_links
+    from discover import discover_post_links
+    from fetch import Fetcher
+    from images import ImagePipeline, PipelineChapterFactory
+    from streambuilder import StreamingEpubBuilder
+    from utils import fetch_chapter
+
+    fetcher = Fetcher(None)
+
+    def fetch_all(links):
+        def fetch(link):
+            try:
+                return fetch_chapter(link, fetcher)
+            except Exception:
+                return None
+        with concurrent.futures.ThreadPoolExecutor(fetcher.max_connections) as executor:
+            return [chapter for chapter in executor.map(fetch, links) if chapter]
+
+    def render_all(chapters):
+        images = ImagePipeline(fetcher)
+        epub = pypub.Epub('bench', builder_factory=StreamingEpubBuilder,
+                          factory=PipelineChapterFactory(images))
+        builder = epub.builder
+        with tempfile.TemporaryDirectory() as tmp:
+            try:
+                builder.begin(os.path.join(tmp, 'bench.epub'))
+                for chapter in chapters:
+                    images.prefetch(chapter)
+                for n, chapter in enumerate(chapters, 1):
+                    builder.render_chapter(pypub.Assignment(f'chapter_{n}', f'chapter-{n}.xhtml', n), chapter)
+                builder.index()
+                builder.compress()
+            finally:
+                builder.cleanup()
+                images.close()
+        return len(builder.chapters)
+
+    options = options or {}
+
+    def find_links():
+        def crawl():
+            return crawl_post_links(url, fetcher, pages)
+        if options.get('discover', 'page') == 'page':
+            return crawl()
+        return discover_post_links(url, fetcher, options['discover'], crawl)
+
+    links = find_links() if stage != 'links' else None
+    chapters = fetch_all(links) if stage == 'render' else None
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start, cpu = time.perf_counter(), time.process_time()
+        if stage == 'links':
+            items = len(find_links())
+        elif stage == 'fetch':
+            items = len(fetch_all(links))
+        elif stage == 'render':
+            items = render_all(chapters)
+        else:
+            images = ImagePipeline(fetcher)
+            try:
+                paths = create_epub(url, 'bench-pipeline', None, True, fetcher, max_pages=pages,
+                                   images=images, ui=False, **options)
+            finally:
+                images.close()
+            items = 0
+            for path in paths:
+                with zipfile.ZipFile(path) as book:
+                    items += len([name for name in book.namelist() if name.startswith('OEBPS/chapter-')])
+                os.remove(path)
+        wall, cpu = time.perf_counter() - start, time.process_time() - cpu
+    fetcher.close()
+    return {'wall': round(wall, 3), 'cpu': round(cpu, 3), 'items': items,
+            'throughput': round(items / wall, 1) if wall else None,
+            'peak_rss_mb': round(peak_rss_mb(), 1)}
+
+
+def stage_process(stage, url, pages, options, results):
+    results.put(run_stage(stage, url, pages, options))
+
+
+def measure(stage: str, url: str, pages: int, options: Optional[dict] = None) -> dict:
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=stage_process, args=(stage, url, pages, options, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    problems = []
+    for key in ('wall', 'peak_rss_mb'):
+        if baseline.get(key) and result[key] > baseline[key] * (1 + tolerance):
+            problems.append(f'{key} {result[key]} vs {baseline[key]}')
+    if result['items'] < baseline.get('items', 0):
+        problems.append(f"items {result['items']} vs {baseline['items']}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', nargs='+', default=['default'], choices=sorted(SCENARIOS))
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--repeat', type=int, default=1, help='runs per stage, the fastest counts')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='render worker processes of the build stage (blogtoepub.py --workers)')
+    parser.add_argument('--memory-limit', type=int, default=None, metavar='MB',
+                        help='memory limit of the build stage (blogtoepub.py --memory-limit)')
+    parser.add_argument('--max-chapters', type=int, default=None,
+                        help='split the build stage into volumes (blogtoepub.py --max-chapters)')
+    parser.add_argument('--discover', default='page', choices=['page', 'auto', 'sitemap', 'feed'],
+                        help='where the links and build stages find posts (blogtoepub.py --discover)')
+    overrides = parser.add_argument_group('blog shape (overrides the scenario, skips the baseline)')
+    for field in dataclasses.fields(SyntheticBlog):
+        if field.type in (int, float, 'int', 'float'):
+            overrides.add_argument(f"--{field.name.replace('_', '-')}", dest=field.name,
+                                   type=float if field.type in (float, 'float') else int)
+    args = parser.parse_args()
+
+    changes = {field.name: getattr(args, field.name) for field in dataclasses.fields(SyntheticBlog)
+               if getattr(args, field.name, None) is not None}
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results, regressions = {}, []
+    print(f"{'scenario':<12} {'stage':<7} {'wall s':>8} {'cpu s':>8} {'items':>6} "
+          f"{'items/s':>8} {'rss MB':>7}  vs baseline")
+    for name in args.scenario:
+        blog = dataclasses.replace(SCENARIOS[name], **changes)
+        key = name if not changes else f'{name}-custom'
+        options = {'workers': args.workers, 'max_chapters': args.max_chapters, 'discover': args.discover,
+                   'memory_limit': args.memory_limit * 1024 * 1024 if args.memory_limit is not None else None}
+        if args.workers:
+            key += f'-w{args.workers}'
+        if args.memory_limit is not None:
+            key += f'-m{args.memory_limit}'
+        if args.max_chapters is not None:
+            key += f'-v{args.max_chapters}'
+        if args.discover != 'page':
+            key += f'-{args.discover}'
+        server = serve(blog)
+        url = f'http://127.0.0.1:{server.server_port}/'
+        try:
+            for stage in args.stages:
+                runs = [measure(stage, url, blog.pages + 1, options) for _ in range(args.repeat)]
+                result = min(runs, key=lambda run: run['wall'])
+                result['peak_rss_mb'] = max(run['peak_rss_mb'] for run in runs)
+                results.setdefault(key, {})[stage] = result
+                reference = baseline.get(key, {}).get(stage)
+                verdict = 'no baseline'
+                if reference:
+                    problems = compare(result, reference, args.tolerance)
+                    verdict = 'REGRESSION: ' + ', '.join(problems) if problems else \
+                        f"ok ({result['wall'] / reference['wall']:.2f}x time)"
+                    if problems:
+                        regressions.append((key, stage))
+                print(f"{key:<12} {stage:<7} {result['wall']:>8.3f} {result['cpu']:>8.3f} "
+                      f"{result['items']:>6} {result['throughput']:>8} {result['peak_rss_mb']:>7}  {verdict}")
+        finally:
+            server.shutdown()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'saved baseline to {args.baseline}')
+    elif regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
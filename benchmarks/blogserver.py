@@ -0,0 +1,329 @@
+"""Local HTTP server generating a synthetic, reproducible blog.
+
+Used by bench_pipeline.py, or on its own to try the tool against a blog of
+a known shape:
+
+    python benchmarks/blogserver.py --posts 500 --page-size 50 --port 8000
+    python blogtoepub.py http://127.0.0.1:8000/ --crawl --no-ui
+
+The archive is paginated at /, /page/2, ... and every post lives at
+/post/<n>. Pages are generated from the seed, so the same configuration
+always serves the same bytes. Injected errors are chosen per path, so the
+same posts and images fail on every run.
+"""
+import argparse
+import gzip
+import hashlib
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from dataclasses import dataclass
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from typing import Optional, Tuple
+
+from PIL import Image
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+         'incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud '
+         'exercitation ullamco laboris nisi aliquip ex ea commodo consequat').split()
+
+#: the single byte range requests use, e.g. bytes=0-16383
+RANGE = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+#: publication date of post 0, each later post number is six hours older
+NEWEST = datetime(2024, 6, 1, tzinfo=timezone.utc)
+
+#: posts per gzipped sitemap
+SITEMAP_SIZE = 1000
+
+#: posts in the feed
+FEED_SIZE = 20
+
+
+@dataclass
+class SyntheticBlog:
+    """Shape of the generated blog.
+
+    ``posts`` posts are listed ``page_size`` per archive page, each entry
+    wrapped in ``nesting`` layout elements. A post has ``paragraphs``
+    paragraphs and ``images`` images, drawn from ``distinct_images``
+    different images of ``image_size``. Every response is delayed by
+    ``latency`` seconds and a ``error_rate`` fraction of post and image
+    paths answer 503. With ``max_concurrent`` set, requests beyond that
+    many in flight are throttled with a 429 and a one second Retry-After.
+    A ``url_variants`` fraction of posts is listed a second time under a
+    tracking-parameter url, and a ``reposts`` fraction repeats the previous
+    post's content under its own url, naming the original as canonical.
+    With ``sitemaps`` robots.txt points at a sitemap index of the static
+    pages and of every post in gzipped chunks. An RSS feed of the latest
+    posts is always served at /feed.xml.
+    """
+    posts: int = 200
+    page_size: int = 50
+    nesting: int = 3
+    paragraphs: int = 20
+    images: int = 1
+    distinct_images: int = 5
+    image_size: Tuple[int, int] = (1600, 1200)
+    latency: float = 0.0
+    error_rate: float = 0.0
+    max_concurrent: int = 0
+    url_variants: float = 0.0
+    reposts: float = 0.0
+    sitemaps: bool = False
+    seed: int = 0
+
+    @property
+    def pages(self) -> int:
+        return max(1, -(-self.posts // self.page_size))
+
+    def chance(self, key: str) -> float:
+        digest = hashlib.sha256(f'{self.seed}:{key}'.encode()).digest()
+        return int.from_bytes(digest[:4], 'big') / 2 ** 32
+
+    def fails(self, path: str) -> bool:
+        return self.chance(path) < self.error_rate
+
+    def original(self, n: int) -> int:
+        """The post whose content post ``n`` carries."""
+        while n > 0 and self.chance(f'repost:{n}') < self.reposts:
+            n -= 1
+        return n
+
+    def text(self, rng: random.Random, words: int) -> str:
+        return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+    def index(self, page: int) -> Optional[bytes]:
+        if not 1 <= page <= self.pages:
+            return None
+        rng = random.Random(f'{self.seed}:index:{page}')
+        parts = ['<!DOCTYPE html><html><head><meta charset="utf-8">'
+                 '<link rel="alternate" type="application/rss+xml" href="/feed.xml">'
+                 '<title>Synthetic Blog | Archive</title></head><body>',
+                 '<nav class="menu"><ul>']
+        parts += [f'<li><a href="/about-{i}">About {i}</a></li>' for i in range(8)]
+        parts.append('</ul></nav><main class="archive">')
+        first = (page - 1) * self.page_size
+        for n in range(first, min(first + self.page_size, self.posts)):
+            opening = ''.join(f'<div class="wrap-{d}">' for d in range(self.nesting))
+            hrefs = [f'/post/{n}']
+            if self.chance(f'variant:{n}') < self.url_variants:
+                hrefs.append(f'/post/{n}/?utm_source=feed&utm_medium=rss#comments')
+            for href in hrefs:
+                parts.append(f'<article class="entry">{opening}'
+                             f'<h2><a href="{href}">{self.text(rng, 5).title()} {n}</a></h2>'
+                             f'<p>{self.text(rng, 25)}</p>{"</div>" * self.nesting}</article>')
+        parts.append('</main><div class="pager">')
+        if page < self.pages:
+            parts.append(f'<a href="/page/{page + 1}">Older posts</a>')
+        parts += [f'<a href="/page/{p}">{p}</a>' for p in sorted({2, 3, self.pages}) if 1 < p <= self.pages]
+        parts.append('</div><aside><h3>Tags</h3>')
+        parts += [f'<a href="/tag/{word}" class="tag">{word}</a>' for word in WORDS[:6]]
+        parts.append('</aside></body></html>')
+        return ''.join(parts).encode()
+
+    def post(self, n: int) -> Optional[bytes]:
+        if not 0 <= n < self.posts:
+            return None
+        n = self.original(n)
+        rng = random.Random(f'{self.seed}:post:{n}')
+        title = f'{self.text(rng, 5).title()} {n}'
+        parts = ['<!DOCTYPE html><html><head><meta charset="utf-8">'
+                 f'<link rel="canonical" href="/post/{n}">'
+                 f'<title>{title} | Synthetic Blog</title></head><body>',
+                 '<header><a href="/">Synthetic Blog</a></header>',
+                 f'<article><div class="content post" itemprop="articleBody"><h1>{title}</h1>']
+        for i in range(self.paragraphs):
+            parts.append(f'<div class="block"><p>{self.text(rng, 60)} '
+                         f'<a href="/post/{rng.randrange(self.posts)}">related</a> '
+                         f'&amp; <em>{self.text(rng, 4)}</em>.</p></div>')
+            if i < self.images:
+                image = rng.randrange(self.distinct_images)
+                parts.append(f'<p><img src="/img/{image}.png" alt="figure"></p>')
+        parts.append('</div></article><footer>&copy; Synthetic Blog</footer></body></html>')
+        return ''.join(parts).encode()
+
+    def published(self, n: int) -> datetime:
+        return NEWEST - timedelta(hours=6 * n)
+
+    def robots(self, base: str) -> bytes:
+        lines = ['User-agent: *', 'Allow: /']
+        if self.sitemaps:
+            lines.append(f'Sitemap: {base}/sitemap.xml')
+        return '\n'.join(lines).encode()
+
+    def sitemap_index(self, base: str) -> Optional[bytes]:
+        if not self.sitemaps:
+            return None
+        chunks = -(-self.posts // SITEMAP_SIZE)
+        locations = [f'{base}/sitemap-pages.xml'] + \
+            [f'{base}/sitemap-posts-{k}.xml.gz' for k in range(chunks)]
+        return ('<?xml version="1.0" encoding="UTF-8"?>'
+                '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+                + ''.join(f'<sitemap><loc>{loc}</loc></sitemap>' for loc in locations)
+                + '</sitemapindex>').encode()
+
+    def urlset(self, entries) -> bytes:
+        return ('<?xml version="1.0" encoding="UTF-8"?>'
+                '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+                + ''.join(f'<url><loc>{loc}</loc>' + (f'<lastmod>{date.isoformat()}</lastmod>' if date else '')
+                          + '</url>' for loc, date in entries)
+                + '</urlset>').encode()
+
+    def sitemap_pages(self, base: str) -> Optional[bytes]:
+        if not self.sitemaps:
+            return None
+        pages = [f'{base}/'] + [f'{base}/page/{p}' for p in range(2, self.pages + 1)] + \
+            [f'{base}/about-{i}' for i in range(8)]
+        return self.urlset((page, None) for page in pages)
+
+    def sitemap_posts(self, k: int, base: str) -> Optional[bytes]:
+        if not self.sitemaps or not 0 <= k * SITEMAP_SIZE < self.posts:
+            return None
+        # oldest first, as many generators write them
+        numbers = reversed(range(k * SITEMAP_SIZE, min((k + 1) * SITEMAP_SIZE, self.posts)))
+        body = self.urlset((f'{base}/post/{n}', self.published(n)) for n in numbers)
+        return gzip.compress(body, mtime=0)
+
+    def feed(self, base: str) -> bytes:
+        items = ''.join(f'<item><title>Post {n}</title><link>{base}/post/{n}</link>'
+                        f'<pubDate>{self.published(n).strftime("%a, %d %b %Y %H:%M:%S +0000")}</pubDate></item>'
+                        for n in range(min(FEED_SIZE, self.posts)))
+        return ('<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel>'
+                f'<title>Synthetic Blog</title><link>{base}/</link>{items}</channel></rss>').encode()
+
+    def image(self, n: int) -> Optional[bytes]:
+        if not 0 <= n < self.distinct_images:
+            return None
+        return render_image(self.image_size, n)
+
+    def respond(self, path: str, base: str = '') -> Tuple[int, str, bytes]:
+        """Status, content type and body for a request path, ``base`` is the server's url."""
+        path = path.split('?', 1)[0]
+        parts = path.strip('/').split('/')
+        body, content_type = None, 'text/html; charset=utf-8'
+        sitemap = re.fullmatch(r'/sitemap-posts-(\d+)\.xml\.gz', path)
+        try:
+            if path == '/':
+                body = self.index(1)
+            elif path == '/robots.txt':
+                body, content_type = self.robots(base), 'text/plain'
+            elif path == '/sitemap.xml':
+                body, content_type = self.sitemap_index(base), 'application/xml'
+            elif path == '/sitemap-pages.xml':
+                body, content_type = self.sitemap_pages(base), 'application/xml'
+            elif sitemap:
+                body, content_type = self.sitemap_posts(int(sitemap.group(1)), base), 'application/gzip'
+            elif path == '/feed.xml':
+                body, content_type = self.feed(base), 'application/rss+xml'
+            elif parts[0] == 'page' and len(parts) == 2:
+                body = self.index(int(parts[1]))
+            elif parts[0] == 'post' and len(parts) == 2:
+                body = self.post(int(parts[1]))
+            elif parts[0] == 'img' and len(parts) == 2 and parts[1].endswith('.png'):
+                body, content_type = self.image(int(parts[1][:-4])), 'image/png'
+        except ValueError:
+            body = None
+        if body is None:
+            return 404, 'text/plain', b'not found'
+        if parts[0] in ('post', 'img') and self.fails(path):
+            return 503, 'text/plain', b'injected error'
+        return 200, content_type, body
+
+
+@lru_cache(maxsize=None)
+def render_image(size: Tuple[int, int], n: int) -> bytes:
+    img = Image.new('RGB', size)
+    for x in range(0, size[0], 40):
+        img.paste(((x * 7 + n * 50) % 256, (n * 90) % 256, 120), (x, 0, x + 40, size[1]))
+    out = BytesIO()
+    img.save(out, 'PNG')
+    return out.getvalue()
+
+
+def handler(blog: SyntheticBlog):
+    in_flight = [0]
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            with lock:
+                in_flight[0] += 1
+                throttled = blog.max_concurrent and in_flight[0] > blog.max_concurrent
+            try:
+                if blog.latency:
+                    time.sleep(blog.latency)
+                if throttled:
+                    status, content_type, body = 429, 'text/plain', b'slow down'
+                else:
+                    base = f"http://{self.headers.get('Host', '127.0.0.1')}"
+                    status, content_type, body = blog.respond(self.path, base)
+                requested = RANGE.match(self.headers.get('Range', ''))
+                length = len(body)
+                if status == 200 and requested:
+                    start, end = int(requested.group(1)), int(requested.group(2) or length - 1)
+                    status, body = 206, body[start:end + 1]
+                self.send_response(status)
+                if throttled:
+                    self.send_header('Retry-After', '1')
+                if status == 206:
+                    self.send_header('Content-Range', f'bytes {start}-{start + len(body) - 1}/{length}')
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            finally:
+                with lock:
+                    in_flight[0] -= 1
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(blog: SyntheticBlog, port: int = 0) -> ThreadingHTTPServer:
+    """Start serving ``blog`` on a background thread, returns the running server."""
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler(blog))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a synthetic blog')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--posts', type=int, default=200)
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--nesting', type=int, default=3)
+    parser.add_argument('--paragraphs', type=int, default=20)
+    parser.add_argument('--images', type=int, default=1)
+    parser.add_argument('--distinct-images', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per response')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--max-concurrent', type=int, default=0, help='answer 429 beyond this many requests')
+    parser.add_argument('--url-variants', type=float, default=0.0, help='fraction of posts listed twice')
+    parser.add_argument('--reposts', type=float, default=0.0, help='fraction of posts copying the previous one')
+    parser.add_argument('--sitemaps', action='store_true', help='serve robots.txt and gzipped sitemaps')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    blog = SyntheticBlog(args.posts, args.page_size, args.nesting, args.paragraphs, args.images,
+                         args.distinct_images, latency=args.latency, error_rate=args.error_rate,
+                         max_concurrent=args.max_concurrent, url_variants=args.url_variants,
+                         reposts=args.reposts, sitemaps=args.sitemaps, seed=args.seed)
+    server = serve(blog, args.port)
+    print(f'serving {blog.posts} posts on http://127.0.0.1:{server.server_port}/')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,114 +1,313 @@
 import argparse
+import cProfile
+import pstats
+import os
+import re
+import sys
 import pypub
-import concurrent.futures
-from utils import get_post_links, add_formatted_text_to_cover, fetch_title
+from functools import partial
+from typing import Callable, List
+from utils import get_post_links, add_formatted_text_to_cover, fetch_title, fetch_chapter
+import instrument
+from cache import HTTPCache
+from fetch import Fetcher
+from update import UpdateError, read_epub, import_book
+from streambuilder import StreamingEpubBuilder
+from archive import DEFAULT_LEVEL
+from crawl import crawl_post_links
+from images import ImagePipeline, PipelineChapterFactory
+from render import ParallelRenderer
+from pipeline import ChapterPipeline
+from prefetch import Prefetcher
+from service import BuildService, parse_address, serve
+from volumes import VolumeWriter
+from journal import DROPPED, ChapterRecord, Journal
+from discover import discover_post_links
+from canonical import DuplicateIndex, dedupe_links, fingerprint, resolve_canonical, url_key
+from batch import DISCOVER_MODES, LINK_ENGINES, Job, LinkFilter, load_manifest
 from pypubpatch import *
 import shutil
-from PyQt5.QtWidgets import QApplication, QMainWindow, QVBoxLayout, \
-      QListWidget, QPushButton, QWidget, QMessageBox
 
 
-def create_epub(url: str, title: str | None, cover: str | None, add_cover_text: bool):
-    links = get_post_links(url)
-    title = title or fetch_title(url)
+def create_epub(url: str, title: str | None, cover: str | None, add_cover_text: bool,
+                fetcher: Fetcher | None = None, update: str | None = None,
+                link_engine: str = "soup", max_pages: int = 1, max_depth: int | None = None,
+                images: ImagePipeline | None = None,
+                link_filter: Callable[[List[str]], List[str]] | None = None,
+                ui: bool = True, workers: int = 0, window: int = 256,
+                memory_limit: int | None = None, max_chapters: int | None = None,
+                max_bytes: int | None = None, canonical: bool = False, dedupe: bool = True,
+                discover: str = "page", compress_level: int = DEFAULT_LEVEL,
+                output_dir: str = "./output",
+                progress: Callable[[int, int], None] | None = None, resume: bool = False):
+    """Build a blog into an epub, returns the paths of the written files.
+
+    With ``max_chapters`` or ``max_bytes`` the book is split into volumes,
+    each its own epub with a numbered cover and table of contents. Links
+    come from the index page, or with ``discover`` from the blog's sitemaps
+    or feeds first. Links to the same post are fetched once, ``canonical``
+    also checks the pages' <link rel=canonical>, and with ``dedupe`` posts
+    whose text nearly matches an earlier post's are left out. Text in the
+    archive is deflated at ``compress_level``. The book is written to
+    ``output_dir``, and ``progress(written, total)`` is called as each
+    chapter is written.
+
+    A journal of the build (its links, and every chapter as it is written)
+    is kept under ``output_dir`` until the book is finished. With ``resume``
+    an interrupted build continues from its journal: the links are not
+    looked for again and only the chapters not finished are fetched and
+    rendered, before the book is put together anew.
+    """
+    split = max_chapters is not None or max_bytes is not None
+    if update and split:
+        raise ValueError("an updated book cannot be split into volumes")
+    fetcher = fetcher or Fetcher()
+    def detect_links():
+        if max_pages > 1:
+            return crawl_post_links(url, fetcher, max_pages, max_depth, link_engine)
+        return get_post_links(url, fetcher, link_engine)
+
+    journal = Journal(Journal.location(output_dir, url))
+    checkpoint = journal.load() if resume else None
+    if resume and checkpoint is None:
+        print(f"No interrupted build of {url} to resume, starting over")
+    book = read_epub(update) if update else None
+    if book and book.chapters and not book.sources:
+        # every post would be fetched again and appended as a duplicate
+        raise UpdateError(f"{update} records no post sources, it was built before --update "
+                         f"was supported and must be rebuilt once")
+    if checkpoint:
+        # the links were chosen and filtered by the interrupted build
+        links = checkpoint.links
+        title = title or checkpoint.title
+        print(f"Resuming {url}: {len(checkpoint.chapters)} of {len(links)} posts already done")
+    else:
+        with instrument.stage("links"):
+            if discover == "page":
+                links = detect_links()
+            else:
+                # the index page detector only runs when sitemaps and feeds fall short
+                links = discover_post_links(url, fetcher, discover, detect_links)
+        links = dedupe_links(links)
+    if book:
+        if not checkpoint:
+            # only fetch posts the existing book does not hold yet
+            known = {url_key(source) for source in book.sources}
+            links = [link for link in links if url_key(link) not in known]
+            if not links:
+                print(f"No new posts for {update}")
+                return
+        title = title or book.title
+    title = title or fetch_title(url, fetcher)
     cover = cover or "./covers/red.png"
 
-    os.makedirs("./output", exist_ok=True)
-
-    def open_ui(links):
-        class LinkManager(QMainWindow):
-            def __init__(self):
-                super().__init__()
-                self.setWindowTitle("Select links for epub")
-                self.result = []
-                self.init_ui(links)
-
-            def init_ui(self, links):
-                # Main layout
-                self.central_widget = QWidget()
-                self.setCentralWidget(self.central_widget)
-                layout = QVBoxLayout()
-
-                # List widget to display links
-                self.list_widget = QListWidget()
-                self.list_widget.addItems(links)
-                self.list_widget.setSelectionMode(QListWidget.MultiSelection)
-                layout.addWidget(self.list_widget)
-
-                # Buttons
-                self.exclude_button = QPushButton("Exclude selected")
-                self.exclude_button.clicked.connect(self.exclude_selected)
-                layout.addWidget(self.exclude_button)
-
-                self.reverse_button = QPushButton("Reverse order")
-                self.reverse_button.clicked.connect(self.reverse_order)
-                layout.addWidget(self.reverse_button)
-
-                self.submit_button = QPushButton("Submit")
-                self.submit_button.clicked.connect(self.submit)
-                layout.addWidget(self.submit_button)
-
-                # Set layout
-                self.central_widget.setLayout(layout)
-
-            def exclude_selected(self):
-                for item in self.list_widget.selectedItems():
-                    self.list_widget.takeItem(self.list_widget.row(item))
-
-            def reverse_order(self):
-                items = [self.list_widget.item(i).text() for i in range(self.list_widget.count())]
-                self.list_widget.clear()
-                self.list_widget.addItems(reversed(items))
-
-            def submit(self):
-                self.result = [self.list_widget.item(i).text() for i in range(self.list_widget.count())]
-                if not self.result:
-                    QMessageBox.critical(self, "Error", "No links left to process!")
-                    return
-                self.close()
-
-        app = QApplication([])
-        manager = LinkManager()
-        manager.show()
-        app.exec_()
-        return manager.result
-
-    links = open_ui(links)
-    chapters = [None] * len(links)
-
-    epub = pypub.Epub(title)
-    epub.creator = url
-    epub.publisher = "blog-to-epub"
-
-    edited_title = title.replace(" ", "_")
-
-    cover_output_path = f"./output/{edited_title}.png"
-    if add_cover_text:
-        add_formatted_text_to_cover(cover, title, url, cover_output_path)
+    os.makedirs(output_dir, exist_ok=True)
+
+    if link_filter and not checkpoint:
+        links = link_filter(links)
+    if canonical and not checkpoint:
+        with instrument.stage("canonical"):
+            links, duplicates = resolve_canonical(links, fetcher)
+        for link, original in duplicates.items():
+            print(f"Skipped {link}: same canonical url as {original}")
+    own_images = images is None
+    images = images or ImagePipeline(fetcher)
+    prefetcher = None
+    if ui and not checkpoint:
+        # Qt is only imported when the window is actually shown
+        from ui import select_links
+        # posts (and their images) are fetched while the user picks them
+        prefetcher = Prefetcher(partial(prefetch_chapter, fetcher=fetcher, images=images), links,
+                                threads=fetcher.max_connections, limit=window)
+        links = select_links(links, prefetcher.update)
+        prefetcher.update(links)
+        prefetcher.close()
+    if not links:
+        print(f"No posts left to convert for {url}")
+        if prefetcher:
+            prefetcher.stop()
+        if own_images:
+            images.close()
+        journal.close()
+        return
+
+    images.reset()
+    if checkpoint:
+        for name, data in journal.images():
+            images.restore(name, data)
     else:
-        shutil.copyfile(cover, cover_output_path)
-    epub.cover = os.path.abspath(cover_output_path)
+        journal.begin(title, links)
+    # chapters finished before the build was interrupted, by url
+    finished = {record.url: record for record in checkpoint.chapters.values()} if checkpoint else {}
+    factory = PipelineChapterFactory(images)
+    edited_title = title.replace(" ", "_")
+    covers = []
+
+    def open_volume(number):
+        suffix = f"_Vol_{number}" if split else ""
+        epub = pypub.Epub(f"{title} Vol. {number}" if split else title,
+                          builder_factory=partial(StreamingEpubBuilder, compress_level=compress_level),
+                          factory=factory)
+        epub.creator = url
+        epub.publisher = "blog-to-epub"
+        cover_output_path = os.path.join(output_dir, f"{edited_title}{suffix}.png")
+        with instrument.stage("cover"):
+            if add_cover_text:
+                add_formatted_text_to_cover(cover, title, url, cover_output_path,
+                                            volume=number if split else None)
+            else:
+                shutil.copyfile(cover, cover_output_path)
+        covers.append(cover_output_path)
+        epub.cover = os.path.abspath(cover_output_path)
+        builder = epub.builder
+        builder.begin(update or os.path.join(output_dir, f"{edited_title}{suffix}.epub"))
+        if book:
+            import_book(builder, book)
+        return builder
+
+    # chapters are rendered against the whole book, then written into
+    # whichever volume they end up in
+    epub = pypub.Epub(title, builder_factory=StreamingEpubBuilder, factory=factory)
+    builder = epub.builder
+    first_chapter = book.last_chapter + 1 if book else 1
+    dropped = {}
+    fingerprints = DuplicateIndex()
+    # chapters are cleaned and rendered in worker processes when asked for
+    renderer = ParallelRenderer(images, workers) if workers else None
 
     def create_chapter_from_url(link):
+        if link in finished:
+            return finished[link], 0
+        chapter = prefetcher.take(link) if prefetcher else None
         try:
-            return pypub.create_chapter_from_url(link)
-        except: 
+            if chapter is None:
+                with instrument.stage("fetch_chapter"):
+                    chapter = fetch_chapter(link, fetcher)
+        except Exception as e:
+            dropped[link] = f"{type(e).__name__}: {e}"
+            return None, 0
+        # start the chapter's image downloads while other posts are fetched
+        images.prefetch(chapter)
+        return chapter, len(chapter.content)
+
+    def render_chapter(index, chapter):
+        number = first_chapter + index
+        assign = pypub.Assignment(f"chapter_{number}", f"chapter-{number}.xhtml", number)
+        if isinstance(chapter, ChapterRecord):
+            return restore_chapter(assign, chapter)
+        try:
+            with instrument.stage("render_chapter"):
+                if renderer:
+                    content = renderer.render_content(builder, assign, chapter)
+                else:
+                    content = builder.render_content(assign, chapter)
+        except Exception as e:
+            dropped[chapter.url] = f"render failed, {type(e).__name__}: {e}"
             return None
+        if content is None:
+            return None
+        with instrument.stage("fingerprint"):
+            value = fingerprint(content) if dedupe else None
+        return assign, chapter, content, value
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = {executor.submit(create_chapter_from_url, item): idx for idx, item in enumerate(links)}
-        
-        for future in concurrent.futures.as_completed(futures):
-            idx = futures[future]
-            chapters[idx] = future.result()
-
-    for chapter in chapters:
-        if chapter:
-            epub.add_chapter(chapter)
-
-    file_name = f"./output/{edited_title}.epub"
-    epub.create(file_name)
-    os.remove(cover_output_path)
+    def restore_chapter(assign, record):
+        if record.status == DROPPED:
+            dropped[record.url] = record.reason
+            return None
+        with instrument.stage("journal"):
+            content = journal.content(record)
+        return assign, pypub.Chapter(record.title, b"", record.url), content, record.fingerprint
+
+    written = 0
+
+    def write_chapter(index, rendered):
+        nonlocal written
+        assign, chapter, content, value = rendered
+        # decided in link order, so the first of two near duplicates is kept
+        original = fingerprints.add(value, chapter.url)
+        if original:
+            dropped[chapter.url] = f"near duplicate of {original}"
+            journal.drop(index, chapter.url, dropped[chapter.url])
+            return
+        writer.write(assign, chapter, content)
+        if chapter.url not in finished:
+            with instrument.stage("journal"):
+                journal.add(index, chapter, content, value, images.image_data)
+        written += 1
+        if progress:
+            progress(written, len(links))
+
+    writer = None
+    try:
+        builder.prepare()
+        writer = VolumeWriter(open_volume, max_chapters, max_bytes)
+
+        # chapters stream through fetch -> render -> write and are freed once
+        # written, in link order, with fetching held back by the window and
+        # the memory limit
+        ChapterPipeline(create_chapter_from_url, render_chapter, write_chapter,
+                        fetch_threads=fetcher.max_connections,
+                        render_threads=workers or 2, window=window,
+                        memory_limit=memory_limit,
+                        extra_bytes=lambda: images.loading_bytes).run(links)
+        file_names = writer.close()
+        # the book is finished, there is nothing left to resume
+        journal.remove()
+        for link in links:
+            if link in dropped:
+                print(f"Dropped {link}: {dropped[link]}")
+        for chapter, reason in builder.rejected:
+            print(f"Skipped {chapter.url}: {reason}")
+    finally:
+        journal.close()
+        if writer:
+            writer.cleanup()
+        builder.cleanup()
+        if renderer:
+            renderer.close()
+        if prefetcher:
+            prefetcher.stop()
+        if own_images:
+            images.close()
+        for cover_output_path in covers:
+            os.remove(cover_output_path)
+    return file_names
+
+
+def prefetch_chapter(link: str, fetcher: Fetcher, images: ImagePipeline) -> pypub.Chapter:
+    """Fetch a post and start its image downloads ahead of the build."""
+    with instrument.stage("prefetch_chapter"):
+        chapter = fetch_chapter(link, fetcher)
+    images.prefetch(chapter)
+    return chapter
+
+
+def run_batch(jobs: List[Job], fetcher: Fetcher, images: ImagePipeline, **options) -> bool:
+    """Build every blog of a batch manifest in turn, returns whether all succeeded.
+
+    The blogs share the fetcher (its connection pool and cache) and the image
+    pipeline, a failing blog is reported and the batch moves on.
+    """
+    failed = []
+    for job in jobs:
+        print(f"Building {job.url}")
+        try:
+            paths = create_epub(job.url, job.title, job.cover, job.add_cover_text, fetcher,
+                               job.update, job.link_engine, job.max_pages if job.crawl else 1,
+                               job.max_depth, images, job.link_filter, ui=False,
+                               discover=job.discover, **options)
+        except Exception as e:
+            print(f"Failed {job.url}: {e}")
+            failed.append(job.url)
+            continue
+        finally:
+            # the next blog has images of its own
+            images.forget()
+        for path in paths or []:
+            print(f"Wrote {path}")
+    if failed:
+        print(f"{len(failed)} blog(s) failed: {', '.join(failed)}")
+    return not failed
 
 
 def main():
@@ -119,9 +318,77 @@ def main():
     parser.add_argument(
         'url',
         type=str,
+        nargs='?',
         help='Blog url (should be a page of links e.g. https://www.paulgraham.com/articles.html)'
     )
 
+    parser.add_argument(
+        '--batch',
+        type=str,
+        default=None,
+        metavar='MANIFEST',
+        help='YAML/JSON manifest of blogs to build in one run without the UI, instead of a single url.'
+    )
+
+    parser.add_argument(
+        '--serve',
+        type=str,
+        default=None,
+        metavar='ADDRESS',
+        help='Run as a build service answering on [HOST:]PORT or a unix socket path, instead of a single url.'
+    )
+
+    parser.add_argument(
+        '--concurrent-jobs',
+        type=int,
+        default=2,
+        help='Number of jobs the build service runs at once (default: 2).'
+    )
+
+    parser.add_argument(
+        '--serve-files',
+        type=str,
+        default=None,
+        metavar='DIR',
+        help='Directory the build service takes the cover and update files of jobs from (default: none, jobs cannot set them).'
+    )
+
+    parser.add_argument(
+        '--no-ui',
+        dest='ui',
+        action='store_false',
+        help='Flag to skip the link selection window (Qt is never loaded), use the filters below instead.'
+    )
+
+    parser.add_argument(
+        '--include',
+        action='append',
+        default=None,
+        metavar='REGEX',
+        help='Only keep posts whose url matches this regex, may be repeated.'
+    )
+
+    parser.add_argument(
+        '--exclude',
+        action='append',
+        default=None,
+        metavar='REGEX',
+        help='Drop posts whose url matches this regex, may be repeated.'
+    )
+
+    parser.add_argument(
+        '--reverse',
+        action='store_true',
+        help='Flag to reverse the order of the posts.'
+    )
+
+    parser.add_argument(
+        '--max-posts',
+        type=int,
+        default=None,
+        help='Maximum number of posts to convert, counted after filtering and reversing (default: unlimited).'
+    )
+
     parser.add_argument(
         '--title', '-t',
         type=str,
@@ -143,9 +410,283 @@ def main():
         help='Flag to disable adding the epub title to the cover image.'
     )
 
+    parser.add_argument(
+        '--link-engine',
+        choices=LINK_ENGINES,
+        default='soup',
+        help='Link detection engine, lxml is much faster on very large index pages (default: soup).'
+    )
+
+    parser.add_argument(
+        '--discover',
+        choices=DISCOVER_MODES,
+        default='page',
+        help='Where to find the posts: the index page, or the sitemaps (robots.txt) and feeds first, falling back to the index page (default: page).'
+    )
+
+    parser.add_argument(
+        '--crawl',
+        action='store_true',
+        help='Flag to follow the archive pagination (/page/2, ?page=3, "Older posts", ...) and collect posts from every page.'
+    )
+
+    parser.add_argument(
+        '--max-pages',
+        type=int,
+        default=50,
+        help='Maximum number of archive pages to crawl (default: 50).'
+    )
+
+    parser.add_argument(
+        '--max-depth',
+        type=int,
+        default=None,
+        help='Maximum number of pagination hops from the first page to crawl (default: unlimited).'
+    )
+
+    parser.add_argument(
+        '--image-size',
+        type=str,
+        default='1072x1448',
+        help='Images larger than WIDTHxHEIGHT are downscaled to fit (default: 1072x1448).'
+    )
+
+    parser.add_argument(
+        '--image-quality',
+        type=int,
+        default=80,
+        help='JPEG quality of downscaled images (default: 80).'
+    )
+
+    parser.add_argument(
+        '--image-budget',
+        type=int,
+        default=None,
+        help='Maximum total size of the images in the epub in MB, later images are left out (default: unlimited).'
+    )
+
+    parser.add_argument(
+        '--update', '-u',
+        type=str,
+        default=None,
+        metavar='EPUB',
+        help='Existing epub to update in place, only posts missing from it are fetched and appended.'
+    )
+
+    parser.add_argument(
+        '--cache-dir',
+        type=str,
+        default='./.cache',
+        help='Directory for the on-disk http cache (default: ./.cache).'
+    )
+
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=1024,
+        help='Maximum size of the http cache in MB, least recently used pages are evicted first (default: 1024).'
+    )
+
+    parser.add_argument(
+        '--no-cache',
+        dest='use_cache',
+        action='store_false',
+        help='Flag to disable the http cache.'
+    )
+
+    parser.add_argument(
+        '--offline',
+        action='store_true',
+        help='Flag to serve every page from the http cache without touching the network.'
+    )
+
+    parser.add_argument(
+        '--max-connections',
+        type=int,
+        default=16,
+        help='Maximum number of concurrent connections (default: 16).'
+    )
+
+    parser.add_argument(
+        '--max-per-host',
+        type=int,
+        default=6,
+        help='Maximum number of concurrent connections to a single host, the ceiling of its adaptive limit (default: 6).'
+    )
+
+    parser.add_argument(
+        '--retries',
+        type=int,
+        default=4,
+        help='Retries of a request after a timeout, connection error, 429 or 5xx response (default: 4).'
+    )
+
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=0,
+        help='Clean and render chapters in this many worker processes to use all cores (default: 0, render in the main process).'
+    )
+
+    parser.add_argument(
+        '--window',
+        type=int,
+        default=256,
+        help='Maximum number of posts between being fetched and being written into the book (default: 256).'
+    )
+
+    parser.add_argument(
+        '--memory-limit',
+        type=int,
+        default=None,
+        metavar='MB',
+        help='Hold back fetching while the posts in flight add up to more than this many MB (default: unlimited).'
+    )
+
+    parser.add_argument(
+        '--max-chapters',
+        type=int,
+        default=None,
+        help='Split the book into volumes of at most this many chapters (default: one book).'
+    )
+
+    parser.add_argument(
+        '--max-bytes',
+        type=int,
+        default=None,
+        metavar='MB',
+        help='Split the book into volumes of at most this many MB of chapters and images before compression (default: one book).'
+    )
+
+    parser.add_argument(
+        '--compress-level',
+        type=int,
+        default=DEFAULT_LEVEL,
+        choices=range(10),
+        metavar='0-9',
+        help=f'Deflate level of the text in the epub, images are stored as they are (default: {DEFAULT_LEVEL}).'
+    )
+
+    parser.add_argument(
+        '--canonical',
+        action='store_true',
+        help='Flag to read the start of every post for its <link rel=canonical> and fetch each canonical post once.'
+    )
+
+    parser.add_argument(
+        '--keep-duplicates',
+        dest='dedupe',
+        action='store_false',
+        help='Flag to keep posts whose text nearly matches an earlier post.'
+    )
+
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Continue an interrupted build from its journal, fetching and rendering only the posts it had not finished.'
+    )
+
+    parser.add_argument(
+        '--report',
+        type=str,
+        default=None,
+        metavar='JSON',
+        help='Write per-stage timings, per-url fetch statistics and peak memory to this file and print a summary.'
+    )
+
+    parser.add_argument(
+        '--profile',
+        type=str,
+        default=None,
+        metavar='PSTATS',
+        help='Run under cProfile, dump the stats to this file and print the top functions.'
+    )
+
     args = parser.parse_args()
 
-    create_epub(args.url, args.title, args.cover, args.add_cover_text)
+    if sum(option is not None for option in (args.url, args.batch, args.serve)) != 1:
+        parser.error('pass either a blog url, --batch MANIFEST or --serve ADDRESS')
+    if args.resume and args.serve:
+        parser.error('--resume cannot be combined with --serve')
+    if args.serve:
+        try:
+            parse_address(args.serve)
+        except ValueError as e:
+            parser.error(f'--serve: {e}')
+    if args.concurrent_jobs < 1:
+        parser.error('--concurrent-jobs must be at least 1')
+    jobs = None
+    if args.batch:
+        try:
+            jobs = load_manifest(args.batch)
+        except (OSError, ValueError, re.error) as e:
+            parser.error(f'cannot read --batch manifest: {e}')
+    if args.update and (args.max_chapters is not None or args.max_bytes is not None):
+        parser.error('--update cannot be combined with --max-chapters or --max-bytes')
+    if (args.max_chapters is not None and args.max_chapters < 1) \
+            or (args.max_bytes is not None and args.max_bytes < 1):
+        parser.error('--max-chapters and --max-bytes must be at least 1')
+    if args.offline and not args.use_cache:
+        parser.error('--offline requires the http cache')
+    cache = None
+    if args.use_cache:
+        cache = HTTPCache(args.cache_dir, args.cache_size * 1024 * 1024, args.offline)
+
+    fetcher = Fetcher(cache, args.max_connections, args.max_per_host, retries=args.retries)
+
+    try:
+        image_size = tuple(int(x) for x in args.image_size.lower().split('x'))
+    except ValueError:
+        parser.error('--image-size must look like 1072x1448')
+    budget = args.image_budget * 1024 * 1024 if args.image_budget is not None else None
+    make_images = partial(ImagePipeline, fetcher, image_size, args.image_quality, budget)
+    # the build service gives each of its workers a pipeline of its own
+    images = make_images() if not args.serve else None
+
+    pipeline_options = {
+        'workers': args.workers,
+        'window': args.window,
+        'memory_limit': args.memory_limit * 1024 * 1024 if args.memory_limit is not None else None,
+        'max_chapters': args.max_chapters,
+        'canonical': args.canonical,
+        'dedupe': args.dedupe,
+        'compress_level': args.compress_level,
+        'max_bytes': args.max_bytes * 1024 * 1024 if args.max_bytes is not None else None,
+    }
+
+    recorder = instrument.enable() if args.report else None
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    try:
+        if args.serve:
+            serve(BuildService(create_epub, fetcher, make_images,
+                               concurrency=args.concurrent_jobs, files_dir=args.serve_files,
+                               **pipeline_options), args.serve)
+        elif jobs is not None:
+            if not run_batch(jobs, fetcher, images, resume=args.resume, **pipeline_options):
+                sys.exit(1)
+        else:
+            link_filter = LinkFilter(args.include, args.exclude, args.reverse, args.max_posts)
+            try:
+                create_epub(args.url, args.title, args.cover, args.add_cover_text, fetcher,
+                            args.update, args.link_engine, args.max_pages if args.crawl else 1,
+                            args.max_depth, images, link_filter, args.ui, discover=args.discover,
+                            resume=args.resume, **pipeline_options)
+            except UpdateError as e:
+                sys.exit(f'error: {e}')
+    finally:
+        if images:
+            images.close()
+        # commits what the http cache still holds back
+        fetcher.close()
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+        if recorder:
+            recorder.write(args.report)
+            print(recorder.summary())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,189 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+#: index changes (stores and uses) committed together
+COMMIT_BATCH = 256
+
+#: seconds an index change may wait for its batch to be committed
+COMMIT_INTERVAL = 1.0
+
+
+@dataclass
+class CacheEntry:
+    url: str
+    digest: str
+    size: int
+    status: int
+    content_type: Optional[str]
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+
+class HTTPCache:
+    """Content-addressed on-disk cache for HTTP responses.
+
+    Bodies are stored once per sha256 digest under ``objects/`` and an sqlite
+    index maps each url to its digest and validators. The least recently
+    used urls are evicted once the stored bodies exceed ``max_bytes``.
+
+    The size of the stored bodies is kept as a running total, so the index
+    is only scanned when something has to be evicted. Index changes and
+    the use times of hits are committed in batches, ``close`` commits what
+    is left.
+    """
+
+    def __init__(self, directory: str = "./.cache", max_bytes: int = 1 << 30,
+                 offline: bool = False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.offline = offline
+        # urls revalidated during this run are served without asking again
+        self.validated = set()
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, "index.sqlite"),
+                                  check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "url TEXT PRIMARY KEY, digest TEXT NOT NULL, size INTEGER NOT NULL, "
+            "status INTEGER NOT NULL, content_type TEXT, etag TEXT, "
+            "last_modified TEXT, atime REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest)")
+        self.db.commit()
+        # identical bodies are shared between urls, so count each digest once
+        self.total = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM "
+            "(SELECT size FROM entries GROUP BY digest)"
+        ).fetchone()[0]
+        # use times of cache hits not written to the index yet
+        self.touched: Dict[str, float] = {}
+        self.changes = 0
+        self.committed = time.monotonic()
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.directory, "objects", digest[:2], digest)
+
+    def lookup(self, url: str) -> Optional[CacheEntry]:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT url, digest, size, status, content_type, etag, last_modified "
+                "FROM entries WHERE url = ?", (url,)
+            ).fetchone()
+        if row is None or not os.path.exists(self.object_path(row[1])):
+            return None
+        return CacheEntry(*row)
+
+    def conditional_headers(self, entry: CacheEntry) -> dict:
+        """Return the revalidation headers for a cached entry."""
+        headers = {}
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def read(self, entry: CacheEntry) -> bytes:
+        with open(self.object_path(entry.digest), "rb") as f:
+            return f.read()
+
+    def touch(self, url: str):
+        """Mark a cached url as used and valid for the rest of this run."""
+        with self.lock:
+            self.touched[url] = time.time()
+            self.validated.add(url)
+            self.changed()
+
+    def changed(self):
+        """Count an index change, committing the batch when it is due.
+
+        Must be called with the lock held.
+        """
+        self.changes += 1
+        if self.changes >= COMMIT_BATCH or time.monotonic() - self.committed >= COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        """Write the pending use times and commit. Must be called with the lock held."""
+        if self.touched:
+            self.db.executemany("UPDATE entries SET atime = ? WHERE url = ?",
+                                [(atime, url) for url, atime in self.touched.items()])
+            self.touched.clear()
+        self.db.commit()
+        self.changes = 0
+        self.committed = time.monotonic()
+
+    def referenced(self, digest: str) -> bool:
+        return self.db.execute(
+            "SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)
+        ).fetchone() is not None
+
+    def store(self, url: str, status: int, headers, content: bytes) -> CacheEntry:
+        digest = hashlib.sha256(content).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        entry = CacheEntry(url, digest, len(content), status,
+                           headers.get("Content-Type"), headers.get("ETag"),
+                           headers.get("Last-Modified"))
+        with self.lock:
+            previous = self.db.execute(
+                "SELECT digest, size FROM entries WHERE url = ?", (url,)).fetchone()
+            new_body = not self.referenced(digest)
+            self.db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (entry.url, entry.digest, entry.size, entry.status,
+                 entry.content_type, entry.etag, entry.last_modified, time.time())
+            )
+            # the stored use time is newer than a pending one
+            self.touched.pop(url, None)
+            if new_body:
+                self.total += entry.size
+            if previous and previous[0] != digest:
+                self.release(*previous)
+            self.validated.add(url)
+            if self.total > self.max_bytes:
+                self.evict()
+            self.changed()
+        return entry
+
+    def release(self, digest: str, size: int):
+        """Delete a body no url points to anymore. Must be called with the lock held."""
+        if self.referenced(digest):
+            return
+        try:
+            os.remove(self.object_path(digest))
+        except FileNotFoundError:
+            pass
+        self.total -= size
+
+    def evict(self):
+        """Drop least recently used urls until the cache fits in max_bytes.
+
+        Must be called with the lock held.
+        """
+        self.commit()
+        rows = self.db.execute(
+            "SELECT url, digest, size FROM entries ORDER BY atime")
+        for url, digest, size in rows.fetchall():
+            if self.total <= self.max_bytes:
+                break
+            self.db.execute("DELETE FROM entries WHERE url = ?", (url,))
+            self.validated.discard(url)
+            self.release(digest, size)
+        self.commit()
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.db.close()
@@ -0,0 +1,181 @@
+"""
+Canonical post urls and near-duplicate detection of post content
+"""
+import hashlib
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import unquote, urljoin, urlsplit, urlunsplit
+
+import lxml.html
+from lxml import etree
+
+from fetch import Fetcher
+
+#: query parameters added by feeds, newsletters and ad networks
+TRACKING_PARAMS = re.compile(
+    r'^(utm_\w+|fbclid|gclid|dclid|msclkid|yclid|igshid|mc_cid|mc_eid|_ga|_gl|ref_src)$',
+    re.IGNORECASE)
+
+#: directory index documents, /post/index.html is /post/
+INDEX_DOCUMENT = re.compile(r'/(index|default)\.(html?|php|aspx?)$', re.IGNORECASE)
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+#: bytes of a post read to find its <link rel=canonical>
+HEAD_BYTES = 16 * 1024
+
+#: simhashes at most this many bits apart are near duplicates
+MAX_DISTANCE = 3
+
+#: posts with fewer word shingles are too short to compare reliably
+MIN_SHINGLES = 16
+
+TAG = re.compile(r'<[^>]*>|&\w+;|&#\w+;')
+WORD = re.compile(r'\w+')
+
+
+def clean_url(url: str) -> str:
+    """The url without its fragment and tracking parameters, host lowercased."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port and port != DEFAULT_PORTS.get(scheme):
+        host = f'{host}:{port}'
+    # parameters keep their original encoding, only tracking ones go
+    query = '&'.join(param for param in parts.query.split('&')
+                     if param and not TRACKING_PARAMS.match(unquote(param.split('=', 1)[0])))
+    return urlunsplit((scheme, host, parts.path or '/', query, ''))
+
+
+def url_key(url: str) -> str:
+    """Key under which every spelling of the same post's url compares equal.
+
+    Ignores the scheme, fragments, tracking parameters, the order of the
+    remaining parameters, a trailing slash, an index document and
+    percent-encoding of characters that need none.
+    """
+    parts = urlsplit(clean_url(url))
+    path = INDEX_DOCUMENT.sub('/', unquote(parts.path)).rstrip('/')
+    query = '&'.join(sorted(parts.query.split('&'))) if parts.query else ''
+    return f'{parts.netloc}{path}?{query}' if query else f'{parts.netloc}{path}'
+
+
+def dedupe_links(links: Iterable[str]) -> List[str]:
+    """Clean links, keeping the first of those with the same ``url_key``."""
+    seen = set()
+    unique = []
+    for link in links:
+        key = url_key(link)
+        if key not in seen:
+            seen.add(key)
+            unique.append(clean_url(link))
+    return unique
+
+
+def canonical_link(head: bytes, url: str) -> Optional[str]:
+    """The absolute href of the <link rel=canonical> in (the start of) a page."""
+    if not head.strip():
+        return None
+    try:
+        document = lxml.html.fromstring(head)
+    except (etree.ParserError, ValueError):
+        return None
+    for link in document.iter('link'):
+        rel = (link.get('rel') or '').lower().split()
+        href = (link.get('href') or '').strip()
+        if 'canonical' in rel and href:
+            return urljoin(url, href)
+    return None
+
+
+def resolve_canonical(links: List[str], fetcher: Fetcher) -> Tuple[List[str], Dict[str, str]]:
+    """Drop links whose page names the same canonical url as an earlier one.
+
+    Only the first ``HEAD_BYTES`` of every page are fetched, concurrently.
+    Returns the remaining links and, for every dropped link, the link it
+    duplicates. Pages that fail to load or name no canonical url are kept.
+    """
+    def canonical(link):
+        try:
+            response = fetcher.fetch(link, limit=HEAD_BYTES)
+        except Exception:
+            return link
+        if response.status >= 400:
+            return link
+        return canonical_link(response.content[:HEAD_BYTES], link) or link
+
+    with ThreadPoolExecutor(fetcher.max_connections) as executor:
+        canonicals = list(executor.map(canonical, links))
+    first: Dict[str, str] = {}
+    kept, duplicates = [], {}
+    for link, target in zip(links, canonicals):
+        key = url_key(target)
+        if key in first:
+            duplicates[link] = first[key]
+        else:
+            first[key] = link
+            kept.append(link)
+    return kept, duplicates
+
+
+def fingerprint(content: bytes) -> Optional[int]:
+    """64 bit simhash of the word 3-shingles of an html document's text.
+
+    Tags and entities are ignored. None when the text is too short for
+    the fingerprint to say anything.
+    """
+    text = TAG.sub(' ', content.decode('utf-8', 'replace')).lower()
+    words = WORD.findall(text)
+    shingles = {' '.join(words[i:i + 3]) for i in range(len(words) - 2)}
+    if len(shingles) < MIN_SHINGLES:
+        return None
+    # every shingle hash in one integer, so a bit's votes are counted by
+    # masking that bit of every hash at once
+    packed = int.from_bytes(b''.join(hashlib.blake2b(shingle.encode(), digest_size=8).digest()
+                                     for shingle in shingles), 'big')
+    column = int.from_bytes(b'\0\0\0\0\0\0\0\1' * len(shingles), 'big')
+    # a bit is set when it is set in more than half the shingle hashes
+    half = len(shingles) / 2
+    value = 0
+    for bit in range(64):
+        if (packed & (column << bit)).bit_count() > half:
+            value |= 1 << bit
+    return value
+
+
+class DuplicateIndex:
+    """Finds the earlier post a fingerprint is a near duplicate of.
+
+    Fingerprints are split into four 16 bit bands. Two fingerprints at
+    most three bits apart agree on at least one whole band, so only the
+    posts sharing a band with the new one are compared.
+    """
+    bands = 4
+
+    def __init__(self, max_distance: int = MAX_DISTANCE):
+        if max_distance >= self.bands:
+            raise ValueError(f'max_distance must be below {self.bands}')
+        self.max_distance = max_distance
+        self.tables: List[Dict[int, List[Tuple[int, str]]]] = [{} for _ in range(self.bands)]
+
+    def band_keys(self, value: int):
+        width = 64 // self.bands
+        return [(value >> (width * band)) & ((1 << width) - 1) for band in range(self.bands)]
+
+    def add(self, value: Optional[int], url: str) -> Optional[str]:
+        """Record a post, returns the url of an earlier near duplicate instead if any."""
+        if value is None:
+            return None
+        keys = self.band_keys(value)
+        for table, key in zip(self.tables, keys):
+            for other, other_url in table.get(key, ()):
+                if (value ^ other).bit_count() <= self.max_distance:
+                    return other_url
+        for table, key in zip(self.tables, keys):
+            table.setdefault(key, []).append((value, url))
+        return None
@@ -0,0 +1,143 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+from urllib.parse import urljoin, urlsplit
+
+import requests
+
+from decode import parse_html
+from fetch import Fetcher
+from utils import detect_post_links, get_request_headers
+
+#: numbered archive pages, e.g. /page/3, /page/3/, ?page=3, ?paged=3
+#: (not ?p=, which WordPress uses for post ids)
+PAGE_NUMBER = re.compile(r'(/page/|[?&](?:page|paged)=)(\d+)(?=/?(?:$|[?&#]))')
+
+#: the page part of a paginated listing's path
+PAGE_PATH = re.compile(r'/page/\d+/?$')
+
+#: the whole anchor text of "older posts" style pagination links
+PAGINATION_TEXT = re.compile(
+    r'^\s*[«‹←]*\s*(older|newer|next|previous)(\s+(posts|entries|articles|page))?\s*[»›→]*\s*$'
+    r'|^\s*[«‹←»›→]+\s*$',
+    re.IGNORECASE)
+
+
+def page_number(url: str) -> Optional[int]:
+    match = PAGE_NUMBER.search(url)
+    return int(match.group(2)) if match else None
+
+
+def listing_path(url: str) -> str:
+    """Path of the listing a page belongs to, without its /page/N part."""
+    return PAGE_PATH.sub('', urlsplit(url).path).rstrip('/') + '/'
+
+
+def under_page(link: str, url: str) -> bool:
+    """Whether ``link`` is in ``url``'s listing with another query, or a path below it."""
+    return listing_path(link).startswith(listing_path(url))
+
+
+def find_pagination_links(content: bytes, url: str) -> List[str]:
+    """Find links to further archive pages on the same host as ``url``.
+
+    A link is followed when it is marked ``rel=next``/``prev``. One that
+    carries a page number must be a page of the same listing, so the pagers
+    of tag or category listings are not crawled too. One that only reads
+    like a pager ("Older posts", "»") must stay under the page's own path,
+    so "Next.js" or "Previous post: ..." in the navigation are not taken
+    for archive pages.
+    """
+    if not content.strip():
+        return []
+    root = parse_html(content)
+    host = urlsplit(url).netloc
+    found = []
+    for elem in root.iter('a', 'link'):
+        href = elem.get('href')
+        if not href:
+            continue
+        rel = (elem.get('rel') or '').lower().split()
+        link = urljoin(url, href).split('#', 1)[0]
+        if 'next' not in rel and 'prev' not in rel:
+            if PAGE_NUMBER.search(href):
+                if listing_path(link) != listing_path(url):
+                    continue
+            else:
+                text = elem.text_content() if elem.tag == 'a' else ''
+                if not PAGINATION_TEXT.search(text) or not under_page(link, url):
+                    continue
+        if urlsplit(link).netloc == host and link not in found:
+            found.append(link)
+    return found
+
+
+def expand_page_range(links: List[str]) -> List[str]:
+    """Fill in the numbered pages between those a pager shows.
+
+    Pagers usually list the first few and the last page, so every page in
+    between can be requested right away instead of one hop at a time.
+    """
+    numbered = [(page_number(link), link) for link in links]
+    numbered = [(number, link) for number, link in numbered if number is not None]
+    if not numbered:
+        return links
+    last, template = max(numbered)
+    match = PAGE_NUMBER.search(template)
+    expanded = list(links)
+    for number in range(2, last + 1):
+        link = template[:match.start(2)] + str(number) + template[match.end(2):]
+        if link not in expanded:
+            expanded.append(link)
+    return expanded
+
+
+def crawl_post_links(url: str, fetcher: Optional[Fetcher] = None, max_pages: int = 50,
+                     max_depth: Optional[int] = None, engine: str = "soup") -> List[str]:
+    """Collect post links across a paginated archive.
+
+    Pages are fetched breadth first, every page of one depth concurrently,
+    and link detection runs on each page. The links are merged in page
+    order (by page number where the url has one) without duplicates.
+    """
+    fetcher = fetcher or Fetcher()
+    pages = [url]
+    results = {}
+
+    def crawl_page(page):
+        try:
+            response = fetcher.fetch(page, headers=get_request_headers())
+            response.raise_for_status()
+        except requests.RequestException:
+            if page == url:
+                raise
+            return [], []
+        return (detect_post_links(response, page, engine),
+                find_pagination_links(response.content, page))
+
+    frontier = [url]
+    depth = 0
+    with ThreadPoolExecutor(fetcher.max_connections) as executor:
+        while frontier and (max_depth is None or depth <= max_depth):
+            discovered = []
+            for page, (links, pagination) in zip(frontier, executor.map(crawl_page, frontier)):
+                results[page] = links
+                discovered += pagination
+            frontier = []
+            for page in expand_page_range(discovered):
+                if page not in pages and len(pages) < max_pages:
+                    pages.append(page)
+                    frontier.append(page)
+            depth += 1
+
+    # the start page is page 1, pages without a number keep discovery order
+    order = {page: (page_number(page) or (1 if page == url else len(pages) + i), i)
+             for i, page in enumerate(pages)}
+    links = []
+    seen = set(pages)
+    for page in sorted(results, key=order.get):
+        for link in results[page]:
+            if link not in seen:
+                links.append(link)
+                seen.add(link)
+    return links
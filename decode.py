@@ -0,0 +1,157 @@
+"""
+Charset sniffing for fetched pages, parsed from bytes without guessing
+"""
+import codecs
+import re
+import threading
+from typing import Mapping, Optional
+
+import lxml.html
+from lxml.html import HtmlElement
+from requests.compat import chardet
+
+#: bytes of a page searched for <meta charset>
+SNIFF_BYTES = 4096
+
+#: bytes of a page charset detection looks at, when nothing else works
+DETECT_BYTES = 64 * 1024
+
+#: what undeclared pages that are not utf-8 are read as when detection fails too
+DEFAULT_ENCODING = 'cp1252'
+
+BOMS = [
+    (codecs.BOM_UTF8, 'utf-8'),
+    (codecs.BOM_UTF32_LE, 'utf-32-le'),
+    (codecs.BOM_UTF32_BE, 'utf-32-be'),
+    (codecs.BOM_UTF16_LE, 'utf-16-le'),
+    (codecs.BOM_UTF16_BE, 'utf-16-be'),
+]
+
+#: <meta charset="..."> and <meta http-equiv="Content-Type" content="...; charset=...">
+META_CHARSET = re.compile(rb'<meta\s[^>]*?charset\s*=\s*["\']?\s*([\w.:-]+)', re.IGNORECASE)
+XML_DECLARATION = re.compile(rb'^\s*<\?xml\s[^>]*?encoding\s*=\s*["\']([\w.:-]+)')
+CONTENT_TYPE_CHARSET = re.compile(r';\s*charset\s*=\s*["\']?([\w.:-]+)', re.IGNORECASE)
+
+
+def normalize(label: Optional[str]) -> Optional[str]:
+    """Python codec name for a charset label, None for unknown labels.
+
+    Like browsers, latin-1 and ascii labels mean windows-1252.
+    """
+    if not label:
+        return None
+    try:
+        name = codecs.lookup(label.strip()).name
+    except LookupError:
+        return None
+    if name in ('iso8859-1', 'ascii'):
+        return 'cp1252'
+    return name
+
+
+def bom_encoding(content: bytes) -> Optional[str]:
+    for bom, encoding in BOMS:
+        if content.startswith(bom):
+            return encoding
+    return None
+
+
+def header_encoding(headers: Optional[Mapping[str, str]]) -> Optional[str]:
+    """Charset of an explicit ``charset`` parameter in the Content-Type header."""
+    if not headers:
+        return None
+    match = CONTENT_TYPE_CHARSET.search(headers.get('Content-Type') or '')
+    return normalize(match.group(1)) if match else None
+
+
+def meta_encoding(content: bytes) -> Optional[str]:
+    """Charset declared in the first ``SNIFF_BYTES`` of a page.
+
+    A page whose markup could be read to find the label is not utf-16,
+    browsers take such labels for utf-8.
+    """
+    head = content[:SNIFF_BYTES]
+    match = XML_DECLARATION.match(head) or META_CHARSET.search(head)
+    if not match:
+        return None
+    encoding = normalize(match.group(1).decode('ascii'))
+    return 'utf-8' if encoding and encoding.startswith('utf-16') else encoding
+
+
+def declared_encoding(content: bytes, headers: Optional[Mapping[str, str]] = None) -> Optional[str]:
+    """Charset a page declares by BOM, Content-Type header or <meta>, in that order."""
+    return bom_encoding(content) or header_encoding(headers) or meta_encoding(content)
+
+
+def is_utf8(content: bytes) -> bool:
+    if content.isascii():
+        return True
+    try:
+        content.decode('utf-8')
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def detect_encoding(content: bytes) -> str:
+    """Guess the charset from a sample of the page, the slow last resort."""
+    guess = chardet.detect(content[:DETECT_BYTES]).get('encoding')
+    return normalize(guess) or DEFAULT_ENCODING
+
+
+def html_encoding(content: bytes, headers: Optional[Mapping[str, str]] = None) -> str:
+    """Charset of a page: declared, else utf-8 if it decodes as such, else detected."""
+    encoding = declared_encoding(content, headers)
+    if encoding:
+        return encoding
+    return 'utf-8' if is_utf8(content) else detect_encoding(content)
+
+
+def decode_html(content: bytes, headers: Optional[Mapping[str, str]] = None) -> str:
+    """The text of a page, decoded once in its ``html_encoding``."""
+    text = content.decode(html_encoding(content, headers), 'replace')
+    return text[1:] if text.startswith('\ufeff') else text
+
+
+def parse_html(content: bytes, headers: Optional[Mapping[str, str]] = None) -> HtmlElement:
+    """Parse a page into an lxml document.
+
+    Valid utf-8, which almost every page is, goes to the parser as the
+    bytes it is. Anything else is decoded once in Python first, with
+    invalid sequences replaced, since libxml2 keeps bytes it cannot decode
+    and lxml only fails on them when the text is read.
+    """
+    encoding = declared_encoding(content, headers)
+    if encoding in (None, 'utf-8') and not content.startswith(codecs.BOM_UTF8) and is_utf8(content):
+        return lxml.html.document_fromstring(content, parser=utf8_parser())
+    return lxml.html.document_fromstring(decode_html(content, headers))
+
+
+def declare_charset(content: bytes, headers: Optional[Mapping[str, str]] = None) -> bytes:
+    """The page, with the charset its headers or BOM give declared up front.
+
+    Lets the page be stored or wrapped without its headers and still be
+    sniffed right by ``parse_html``. Returns ``content`` itself when the
+    page declares the same charset already.
+    """
+    bom = bom_encoding(content)
+    encoding = bom or header_encoding(headers)
+    if bom == 'utf-8':
+        content = content[len(codecs.BOM_UTF8):]
+    elif bom:
+        content = content.decode(bom, 'replace').lstrip('\ufeff').encode('utf-8')
+        encoding = 'utf-8'
+    if not encoding or encoding == meta_encoding(content):
+        return content
+    return b'<meta charset="%s">' % encoding.encode('ascii') + content
+
+
+def utf8_parser() -> lxml.html.HTMLParser:
+    """This thread's parser for pages known to be utf-8, parsers are not shared."""
+    parser = getattr(PARSERS, 'utf8', None)
+    if parser is None:
+        parser = PARSERS.utf8 = lxml.html.HTMLParser(encoding='utf-8')
+    return parser
+
+
+PARSERS = threading.local()
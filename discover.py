@@ -0,0 +1,274 @@
+"""
+Post discovery from robots.txt, sitemaps and feeds
+"""
+import email.utils
+import gzip
+import logging
+import re
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from io import BytesIO
+from typing import Callable, Iterator, List, Optional, Tuple
+from urllib.parse import urljoin, urlsplit
+
+import lxml.html
+from lxml import etree
+
+from fetch import Fetcher
+from utils import get_request_headers
+
+logger = logging.getLogger(__name__)
+
+#: where sitemaps live when robots.txt does not say
+SITEMAP_PATHS = ['sitemap.xml', 'sitemap_index.xml', 'wp-sitemap.xml']
+
+#: where feeds live when the index page does not link one
+FEED_PATHS = ['feed', 'feed.xml', 'rss.xml', 'atom.xml', 'index.xml']
+
+FEED_TYPES = {'application/rss+xml', 'application/atom+xml', 'application/feed+xml'}
+
+#: sub-sitemaps of pages, taxonomies and media rather than posts (Yoast, WordPress core, ...)
+SKIPPED_SITEMAPS = re.compile(
+    r'(^|[/_-])(pages?|categor(y|ies)|tags?|post_tag|authors?|users|taxonomies|products?'
+    r'|attachments?|images?|videos?)([._-]|$)', re.IGNORECASE)
+
+#: urls that are listings or files rather than posts
+NON_POST = re.compile(
+    r'/(tags?|categor(y|ies)|topics?|authors?|page|feed|search|archives?|wp-content|wp-json'
+    r'|attachment|about|contact)(/|$)'
+    r'|\.(xml|rss|atom|json|txt|jpe?g|png|gif|webp|svg|pdf|zip|mp3|mp4)$', re.IGNORECASE)
+
+SITEMAP_LINE = re.compile(r'^\s*sitemap\s*:\s*(\S+)', re.IGNORECASE | re.MULTILINE)
+
+#: how deep sitemap indexes are followed
+MAX_SITEMAP_DEPTH = 2
+
+
+@dataclass
+class Entry:
+    url: str
+    date: Optional[float] = None
+
+
+def parse_date(text: Optional[str]) -> Optional[float]:
+    """Timestamp of an ISO 8601 (sitemaps, Atom) or RFC 822 (RSS) date."""
+    if not text or not text.strip():
+        return None
+    text = text.strip()
+    try:
+        date = datetime.fromisoformat(text.replace('Z', '+00:00'))
+    except ValueError:
+        try:
+            date = email.utils.parsedate_to_datetime(text)
+        except (TypeError, ValueError):
+            return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.timestamp()
+
+
+def local_name(tag) -> str:
+    return etree.QName(tag).localname if isinstance(tag, str) else ''
+
+
+def iter_elements(content: bytes, names: Tuple[str, ...]) -> Iterator[etree._Element]:
+    """Stream the elements called ``names`` (in any namespace) out of an xml document.
+
+    Gzipped documents are decompressed on the fly. Every yielded element is
+    freed along with its already seen siblings once the consumer moves on,
+    so memory stays flat however many entries the document holds.
+    """
+    source = gzip.GzipFile(fileobj=BytesIO(content)) if content[:2] == b'\x1f\x8b' else BytesIO(content)
+    events = etree.iterparse(source, events=('end',), recover=True, huge_tree=True,
+                             resolve_entities=False, no_network=True)
+    try:
+        for _, elem in events:
+            if local_name(elem.tag) not in names:
+                continue
+            yield elem
+            elem.clear()
+            parent = elem.getparent()
+            if parent is not None:
+                while elem.getprevious() is not None:
+                    del parent[0]
+    except (etree.XMLSyntaxError, OSError, EOFError) as e:
+        logger.warning('stopped parsing xml: %s', e)
+
+
+def child_text(elem, *names: str) -> Optional[str]:
+    for child in elem:
+        if local_name(child.tag) in names and child.text:
+            return child.text.strip()
+    return None
+
+
+def parse_sitemap(content: bytes) -> Tuple[List[Entry], List[str]]:
+    """The pages and the sub-sitemaps listed by a sitemap or sitemap index."""
+    pages, sitemaps = [], []
+    for elem in iter_elements(content, ('url', 'sitemap')):
+        loc = child_text(elem, 'loc')
+        if not loc:
+            continue
+        if local_name(elem.tag) == 'sitemap':
+            sitemaps.append(loc)
+        else:
+            pages.append(Entry(loc, parse_date(child_text(elem, 'lastmod'))))
+    return pages, sitemaps
+
+
+def parse_feed(content: bytes, url: str) -> List[Entry]:
+    """The entries of an RSS 0.9x/1.0/2.0 or Atom feed."""
+    entries = []
+    for elem in iter_elements(content, ('item', 'entry')):
+        link = None
+        if local_name(elem.tag) == 'entry':
+            for child in elem:
+                if local_name(child.tag) == 'link' and child.get('rel', 'alternate') == 'alternate':
+                    link = child.get('href')
+                    break
+            date = child_text(elem, 'published', 'updated')
+        else:
+            link = child_text(elem, 'link')
+            date = child_text(elem, 'pubDate', 'date')
+        if link:
+            entries.append(Entry(urljoin(url, link.strip()), parse_date(date)))
+    return entries
+
+
+def newest_first(entries: List[Entry]) -> List[Entry]:
+    """Sort entries by date, newest first like a blog's index, undated ones last."""
+    dated = sorted((entry for entry in entries if entry.date is not None),
+                   key=lambda entry: -entry.date)
+    return dated + [entry for entry in entries if entry.date is None]
+
+
+def path_shape(path: str) -> Tuple[str, ...]:
+    return tuple('#' if segment.isdigit() else '*' for segment in path.strip('/').split('/'))
+
+
+def post_entries(entries: List[Entry], url: str) -> List[Entry]:
+    """Keep the entries that look like posts of the blog at ``url``.
+
+    They must be on the blog's host and under its path, must not be the
+    index itself or a listing, and must share the most common url shape
+    (number and kind of path segments), which on a blog is the posts'.
+    """
+    blog = urlsplit(url)
+    prefix = blog.path if blog.path.endswith('/') else blog.path.rsplit('/', 1)[0] + '/'
+    host, home = blog.netloc.lower(), blog.path.rstrip('/')
+    candidates = []
+    for entry in entries:
+        parts = urlsplit(entry.url)
+        if parts.netloc.lower() != host or not parts.path.startswith(prefix):
+            continue
+        if parts.path.rstrip('/') == home or NON_POST.search(parts.path):
+            continue
+        candidates.append((entry, path_shape(parts.path)))
+    if not candidates:
+        return []
+    shape = Counter(shape for _, shape in candidates).most_common(1)[0][0]
+    return [entry for entry, entry_shape in candidates if entry_shape == shape]
+
+
+def fetch_document(url: str, fetcher: Fetcher) -> Optional[bytes]:
+    try:
+        response = fetcher.fetch(url, headers=get_request_headers())
+    except Exception as e:
+        logger.info('cannot fetch %r: %s', url, e)
+        return None
+    if response.status != 200 or not response.content.strip():
+        return None
+    return response.content
+
+
+def robots_sitemaps(url: str, fetcher: Fetcher) -> List[str]:
+    """Sitemaps named by the host's robots.txt."""
+    content = fetch_document(urljoin(url, '/robots.txt'), fetcher)
+    if content is None:
+        return []
+    return [urljoin(url, match) for match in SITEMAP_LINE.findall(content.decode('utf-8', 'replace'))]
+
+
+def sitemap_links(url: str, fetcher: Fetcher) -> List[str]:
+    """Post links of a blog according to its sitemaps, newest first."""
+    sitemaps = robots_sitemaps(url, fetcher)
+    if not sitemaps:
+        sitemaps = [urljoin(url, '/' + path) for path in SITEMAP_PATHS]
+        if urlsplit(url).path.strip('/'):
+            sitemaps.insert(0, urljoin(url, 'sitemap.xml'))
+    entries, seen = [], set(sitemaps)
+    with ThreadPoolExecutor(fetcher.max_connections) as executor:
+        for depth in range(MAX_SITEMAP_DEPTH + 1):
+            found = []
+            for content in executor.map(lambda sitemap: fetch_document(sitemap, fetcher), sitemaps):
+                if content is None:
+                    continue
+                pages, children = parse_sitemap(content)
+                entries += pages
+                found += [child for child in children if child not in seen
+                          and not SKIPPED_SITEMAPS.search(urlsplit(child).path.rsplit('/', 1)[-1])]
+                seen.update(children)
+            if not found or depth == MAX_SITEMAP_DEPTH:
+                break
+            sitemaps = found
+    return [entry.url for entry in newest_first(post_entries(entries, url))]
+
+
+def feed_urls(url: str, fetcher: Fetcher) -> List[str]:
+    """Feeds the index page links to, or the usual feed locations."""
+    try:
+        response = fetcher.fetch(url, headers=get_request_headers())
+        response.raise_for_status()
+        document = lxml.html.fromstring(response.content)
+    except Exception:
+        document = None
+    feeds = []
+    if document is not None:
+        for link in document.iter('link'):
+            rel = (link.get('rel') or '').lower().split()
+            if 'alternate' in rel and (link.get('type') or '').lower() in FEED_TYPES and link.get('href'):
+                feeds.append(urljoin(url, link.get('href').strip()))
+    return feeds or [urljoin(url, path) for path in FEED_PATHS]
+
+
+def feed_links(url: str, fetcher: Fetcher) -> List[str]:
+    """Post links of the first feed of a blog that lists any, newest first.
+
+    Entries go through the same checks as sitemap entries, so items
+    linking off the blog or to its index are left out.
+    """
+    for feed in feed_urls(url, fetcher):
+        content = fetch_document(feed, fetcher)
+        entries = post_entries(parse_feed(content, feed), url) if content else []
+        if entries:
+            return [entry.url for entry in newest_first(entries)]
+    return []
+
+
+def discover_post_links(url: str, fetcher: Fetcher, source: str = 'auto',
+                        fallback: Optional[Callable[[], List[str]]] = None) -> List[str]:
+    """Find the post links of a blog without parsing its index page where possible.
+
+    ``source`` is ``sitemap``, ``feed`` or ``auto`` (sitemaps, then feeds).
+    A sitemap lists the whole archive, so its posts are used as soon as
+    there are any. Feeds usually carry only the latest posts, so in
+    ``auto`` mode the links ``fallback()`` detects on the index page win
+    when there are more of them. ``fallback()`` also runs when neither
+    source yields a post.
+    """
+    if source in ('auto', 'sitemap'):
+        links = sitemap_links(url, fetcher)
+        if links:
+            logger.info('found %d posts in the sitemaps of %s', len(links), url)
+            return links
+    links = feed_links(url, fetcher) if source in ('auto', 'feed') else []
+    if links and source == 'feed':
+        logger.info('found %d posts in the feed of %s', len(links), url)
+        return links
+    detected = fallback() if fallback else []
+    if len(links) > len(detected):
+        logger.info('found %d posts in the feed of %s', len(links), url)
+        return links
+    return detected
@@ -0,0 +1,202 @@
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+import instrument
+from cache import HTTPCache
+from decode import decode_html
+from ratelimit import THROTTLED, RateController, backoff, retry_after
+
+#: errors after which a request is retried
+RETRIED_ERRORS = (requests.ConnectionError, requests.Timeout,
+                  requests.exceptions.ChunkedEncodingError)
+
+
+class CacheMiss(requests.ConnectionError):
+    """Raised in offline mode when a url is not in the cache."""
+
+
+@dataclass
+class FetchResult:
+    url: str
+    status: int
+    content: bytes
+    headers: CaseInsensitiveDict = field(default_factory=CaseInsensitiveDict)
+    from_cache: bool = False
+    retries: int = 0
+
+    @property
+    def encoding(self) -> Optional[str]:
+        return requests.utils.get_encoding_from_headers(self.headers)
+
+    @property
+    def text(self) -> str:
+        """The body decoded in its declared charset, see ``decode.html_encoding``."""
+        if not self.content:
+            return ""
+        return decode_html(self.content, self.headers)
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            retried = f" after {self.retries} retries" if self.retries else ""
+            raise requests.HTTPError(f"{self.status} error for url: {self.url}{retried}")
+
+
+class Fetcher:
+    """Pooled http client shared by every fetch of a build.
+
+    One keep-alive ``requests.Session`` is reused across threads. At most
+    ``max_connections`` requests are in flight overall. Each host gets an
+    adaptive concurrency window (see ``ratelimit.HostLimiter``) of at most
+    ``max_per_host`` requests, which is also the size of each host's
+    connection pool, so connections are reused rather than reopened.
+    Timeouts, connection errors, 429 and 5xx responses are retried up to
+    ``retries`` times, after the ``Retry-After`` delay when the host sends
+    one and with jittered exponential backoff from ``backoff`` seconds
+    otherwise.
+    """
+
+    #: longest wait between two attempts, whatever the host asks for
+    max_delay = 120.0
+
+    def __init__(self, cache: Optional[HTTPCache] = None, max_connections: int = 16,
+                 max_per_host: int = 6, timeout: int = 10, chunk_size: int = 64 * 1024,
+                 retries: int = 4, backoff: float = 0.5):
+        self.cache = cache
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_connections,
+                              pool_maxsize=max_per_host, pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.limits = RateController(max_per_host)
+
+    def cached(self, url: str, entry) -> FetchResult:
+        self.cache.touch(url)
+        return FetchResult(url, entry.status, self.cache.read(entry),
+                           CaseInsensitiveDict({"Content-Type": entry.content_type or ""}),
+                           from_cache=True)
+
+    def request(self, url: str, headers: dict, timeout: int,
+                limit: Optional[int] = None) -> FetchResult:
+        """Stream a single GET over the pooled session, at most ``limit`` bytes of it."""
+        limiter = self.limits.host(url)
+        sequence = limiter.acquire()
+        throttled, pause = True, None
+        try:
+            with self.slots:
+                with self.session.get(url, headers=headers, timeout=timeout,
+                                      stream=True) as response:
+                    if limit is None:
+                        content = b"".join(response.iter_content(self.chunk_size))
+                    else:
+                        content = self.read_limited(response, limit)
+                    result = FetchResult(url, response.status_code, content,
+                                         response.headers)
+            throttled = result.status in THROTTLED
+            if throttled:
+                pause = retry_after(result.headers.get("Retry-After"))
+            return result
+        finally:
+            limiter.release(sequence, throttled, pause and min(pause, self.max_delay))
+
+    def read_limited(self, response: requests.Response, limit: int) -> bytes:
+        chunks, size = [], 0
+        for chunk in response.iter_content(min(self.chunk_size, limit)):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= limit:
+                break
+        return b"".join(chunks)[:limit]
+
+    def request_with_retries(self, url: str, headers: dict, timeout: int,
+                             limit: Optional[int] = None) -> FetchResult:
+        attempt = 0
+        while True:
+            try:
+                result = self.request(url, headers, timeout, limit)
+            except RETRIED_ERRORS as e:
+                if attempt >= self.retries:
+                    e.retries = attempt
+                    raise
+                delay = backoff(attempt, self.backoff, self.max_delay)
+            else:
+                if result.status not in THROTTLED or attempt >= self.retries:
+                    result.retries = attempt
+                    return result
+                delay = retry_after(result.headers.get("Retry-After"))
+                if delay is None:
+                    delay = backoff(attempt, self.backoff, self.max_delay)
+            attempt += 1
+            time.sleep(min(delay, self.max_delay))
+
+    def fetch(self, url: str, timeout: Optional[int] = None,
+              headers: Optional[dict] = None, limit: Optional[int] = None) -> FetchResult:
+        """Fetch a url, revalidating against and filling the cache if given.
+
+        With ``limit`` only the first ``limit`` bytes are wanted: they are
+        asked for with a ``Range`` header, the download stops there if the
+        host ignores it, and the partial page is not cached. A cached copy
+        of the page is returned as is, without revalidation.
+        """
+        start = time.perf_counter()
+        try:
+            result = self.get(url, timeout, headers, limit)
+        except Exception as e:
+            instrument.record_fetch(url, None, 0, time.perf_counter() - start,
+                                    retries=getattr(e, "retries", 0), error=str(e))
+            raise
+        instrument.record_fetch(url, result.status, len(result.content),
+                                time.perf_counter() - start, result.from_cache, result.retries)
+        return result
+
+    @staticmethod
+    def complete(result: FetchResult, limit: int) -> bool:
+        """Whether a response read up to ``limit`` bytes holds the whole body."""
+        if result.status == 200:
+            return len(result.content) < limit
+        if result.status == 206:
+            total = result.headers.get("Content-Range", "").rpartition("/")[2]
+            return total.isdigit() and int(total) == len(result.content)
+        return False
+
+    def get(self, url: str, timeout: Optional[int] = None,
+            headers: Optional[dict] = None, limit: Optional[int] = None) -> FetchResult:
+        cache = self.cache
+        headers = dict(headers or {})
+        entry = cache.lookup(url) if cache else None
+        if entry and (cache.offline or url in cache.validated or limit is not None):
+            return self.cached(url, entry)
+        if cache and cache.offline:
+            raise CacheMiss(f"offline and not cached: {url}")
+        if limit is not None:
+            headers["Range"] = f"bytes=0-{limit - 1}"
+            result = self.request_with_retries(url, headers, timeout or self.timeout, limit)
+            if cache and self.complete(result, limit):
+                # the whole page fit, the full fetch can come from the cache
+                cache.store(url, 200, result.headers, result.content)
+            return result
+        if entry:
+            headers.update(cache.conditional_headers(entry))
+
+        result = self.request_with_retries(url, headers, timeout or self.timeout)
+        if entry and result.status == 304:
+            return self.cached(url, entry)
+        if cache and result.status == 200:
+            cache.store(url, result.status, result.headers, result.content)
+        return result
+
+    def close(self):
+        self.session.close()
+        if self.cache:
+            self.cache.close()
@@ -0,0 +1,282 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import threading
+import urllib.parse
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Dict, List, Optional, Set, Tuple
+
+import pypub
+from PIL import Image
+from pypub.factory import RenderCtx, mime_type
+
+import instrument
+from fetch import Fetcher
+from sanitize import externalize_links
+
+logger = logging.getLogger(__name__)
+
+#: image sources in raw chapter html, scanned before the chapter is parsed
+IMG_SRC = re.compile(rb'<img\b[^>]*?\ssrc\s*=\s*["\']?([^"\'\s>]+)', re.IGNORECASE)
+
+#: formats e-readers display natively, anything else is re-encoded
+READER_FORMATS = {'jpeg', 'png', 'gif', 'svg'}
+
+#: default target resolution (a 6" 300ppi e-reader screen)
+DEFAULT_MAX_SIZE = (1072, 1448)
+
+
+@dataclass
+class ProcessedImage:
+    """A downscaled image, its data is in the pipeline's spool directory."""
+    digest: str
+    size: int
+    extension: str
+
+    @property
+    def name(self) -> str:
+        return f'image-{self.digest[:16]}.{self.extension}'
+
+
+def image_url(src: str, chapter_url: Optional[str]) -> Optional[str]:
+    """Resolve an image src the same way pypub's render_images does."""
+    url = src.rsplit('?', 1)[0]
+    if '://' not in url:
+        if not chapter_url:
+            return None
+        url = urllib.parse.urljoin(chapter_url, url)
+    return url
+
+
+def downscale(data: bytes, extension: str, max_size: Tuple[int, int],
+              quality: int) -> Tuple[bytes, str]:
+    """Shrink an image to fit ``max_size`` and re-encode it if that saves bytes.
+
+    Runs in a worker process. Returns the new bytes and file extension.
+    """
+    extension = 'jpeg' if extension == 'jpg' else extension
+    if extension == 'svg':
+        return data, extension
+    with Image.open(BytesIO(data)) as img:
+        if getattr(img, 'is_animated', False):
+            return data, extension
+        too_large = img.width > max_size[0] or img.height > max_size[1]
+        if not too_large and extension in READER_FORMATS:
+            return data, extension
+        img.thumbnail(max_size, Image.LANCZOS)
+        out = BytesIO()
+        if 'A' in img.mode or 'transparency' in img.info:
+            img.save(out, 'PNG', optimize=True)
+            encoded = (out.getvalue(), 'png')
+        else:
+            img.convert('RGB').save(out, 'JPEG', quality=quality, optimize=True)
+            encoded = (out.getvalue(), 'jpeg')
+    if extension in READER_FORMATS and not too_large and len(encoded[0]) >= len(data):
+        return data, extension
+    return encoded
+
+
+def process_pool(workers: Optional[int] = None) -> ProcessPoolExecutor:
+    """Process pool that is safe to start from threads of a running build."""
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else None)
+    return ProcessPoolExecutor(workers, mp_context=context)
+
+
+class ImagePipeline:
+    """Download, dedupe and downscale the images of every chapter of a book.
+
+    ``prefetch`` starts downloads as soon as a chapter's html is known, so
+    images of all chapters download concurrently. Identical images are
+    stored once under a name derived from the hash of their content, large
+    ones are downscaled in a process pool, and once ``byte_budget`` bytes of
+    images have been added the remaining images are left out of the book.
+    One pipeline can build several books in turn, ``reset`` between them.
+
+    Processed images are written to a spool directory at once and read
+    back when they are written into the book, so memory only holds the
+    images being downloaded and downscaled (``loading_bytes``), however
+    many images the book has.
+    """
+
+    def __init__(self, fetcher: Fetcher, max_size: Tuple[int, int] = DEFAULT_MAX_SIZE,
+                 quality: int = 80, byte_budget: Optional[int] = None,
+                 workers: Optional[int] = None):
+        self.fetcher = fetcher
+        self.max_size = max_size
+        self.quality = quality
+        self.byte_budget = byte_budget
+        self.downloads = ThreadPoolExecutor(fetcher.max_connections)
+        self.processes = process_pool(workers)
+        self.futures: Dict[str, Future] = {}
+        self.names: Dict[str, Optional[str]] = {}
+        self.pending: List[str] = []
+        # images added to the current book
+        self.stored: Set[str] = set()
+        self.total_bytes = 0
+        self.loading_bytes = 0
+        self.spool = tempfile.mkdtemp(prefix='blogtoepub-images-')
+        self.lock = threading.Lock()
+
+    def prefetch(self, chapter: pypub.Chapter):
+        """Start downloading every image referenced by a fetched chapter."""
+        for match in IMG_SRC.finditer(chapter.content):
+            src = match.group(1).decode('utf-8', 'replace')
+            url = image_url(src, chapter.url)
+            if url:
+                self.future(url)
+
+    def future(self, url: str) -> Future:
+        with self.lock:
+            if url not in self.futures:
+                self.futures[url] = self.downloads.submit(self.load, url)
+            return self.futures[url]
+
+    def load(self, url: str) -> Optional[ProcessedImage]:
+        try:
+            response = self.fetcher.fetch(url)
+            response.raise_for_status()
+        except Exception as e:
+            logger.error('failed to download image %r: %s', url, e)
+            return None
+        size = len(response.content)
+        with self.lock:
+            self.loading_bytes += size
+        try:
+            extension = mime_type(url, response.content[:8192])
+            if not extension:
+                logger.warning('cannot identify %r mime', url)
+                return None
+            digest = hashlib.sha256(response.content).hexdigest()
+            try:
+                data, extension = self.processes.submit(
+                    downscale, response.content, extension, self.max_size, self.quality
+                ).result()
+            except Exception as e:
+                logger.warning('cannot downscale %r, embedding as is: %s', url, e)
+                data = response.content
+            image = ProcessedImage(digest, len(data), extension)
+            self.spool_image(image.name, data)
+            return image
+        finally:
+            with self.lock:
+                self.loading_bytes -= size
+
+    def spool_path(self, name: str) -> str:
+        return os.path.join(self.spool, name)
+
+    def spool_image(self, name: str, data: bytes):
+        # images with the same content share a name, each is written whole
+        handle, path = tempfile.mkstemp(dir=self.spool, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as f:
+            f.write(data)
+        os.replace(path, self.spool_path(name))
+
+    def resolve(self, url: str) -> Tuple[bool, Optional[str]]:
+        """Wait for an image and return (downloaded, epub path or None).
+
+        The path is None when the image failed to download or would exceed
+        the byte budget.
+        """
+        image = self.future(url).result()
+        if image is None:
+            return False, None
+        with self.lock:
+            if image.digest not in self.names:
+                if image.name in self.stored:
+                    # restored from a journal, already counted
+                    self.names[image.digest] = image.name
+                elif self.byte_budget is not None \
+                        and self.total_bytes + image.size > self.byte_budget:
+                    logger.warning('image budget exhausted, leaving out %r', url)
+                    self.names[image.digest] = None
+                else:
+                    self.total_bytes += image.size
+                    self.names[image.digest] = image.name
+                    self.pending.append(image.name)
+                    self.stored.add(image.name)
+            name = self.names[image.digest]
+        return True, name and f'images/{name}'
+
+    def render(self, ctx: RenderCtx):
+        """Point the images of a chapter at their embedded copies."""
+        with instrument.stage('images'):
+            self.render_images(ctx)
+
+    def render_images(self, ctx: RenderCtx):
+        for image in ctx.etree.xpath('.//img[@src]'):
+            url = image_url(image.attrib['src'], ctx.chapter.url)
+            if not url:
+                continue
+            downloaded, path = self.resolve(url)
+            if path:
+                image.attrib['src'] = path
+            elif downloaded:
+                image.getparent().remove(image)
+
+    def reset(self):
+        """Start a new book, downloaded images stay available for reuse."""
+        with self.lock:
+            self.names.clear()
+            self.pending = []
+            self.stored.clear()
+            self.total_bytes = 0
+
+    def restore(self, name: str, data: bytes):
+        """Add an image an interrupted build of the book had added, counted against the budget."""
+        self.spool_image(name, data)
+        with self.lock:
+            if name not in self.stored:
+                self.total_bytes += len(data)
+                self.stored.add(name)
+
+    def forget(self):
+        """Drop the finished downloads kept for reuse, so a long-lived pipeline stays small."""
+        with self.lock:
+            done = [future for future in self.futures.values() if future.done()]
+            self.futures = {url: future for url, future in self.futures.items()
+                            if not future.done()}
+            names = self.stored | {future.result().name for future in done
+                                   if not future.exception() and future.result()}
+        for name in names:
+            try:
+                os.remove(self.spool_path(name))
+            except FileNotFoundError:
+                pass
+
+    def image_data(self, name: str) -> Optional[bytes]:
+        """Data of an image added to the book under ``name``, read back from the spool."""
+        with self.lock:
+            if name not in self.stored:
+                return None
+        with open(self.spool_path(name), 'rb') as f:
+            return f.read()
+
+    def drain(self) -> List[Tuple[str, bytes]]:
+        """Return the images added since the last call, to write into the book."""
+        with self.lock:
+            pending, self.pending = self.pending, []
+        return [(name, self.image_data(name)) for name in pending]
+
+    def close(self):
+        self.downloads.shutdown(cancel_futures=True)
+        self.processes.shutdown(cancel_futures=True)
+        shutil.rmtree(self.spool, ignore_errors=True)
+
+
+class PipelineChapterFactory(pypub.SimpleChapterFactory):
+    """Chapter factory that embeds images through an ``ImagePipeline``."""
+
+    def __init__(self, images: ImagePipeline):
+        self.images = images
+
+    def hydrate(self, ctx: RenderCtx):
+        self.images.render(ctx)
+        if ctx.extern_links and ctx.chapter.url:
+            externalize_links(ctx.chapter.url, ctx.etree)
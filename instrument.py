@@ -0,0 +1,182 @@
+"""
+Optional timing and fetch instrumentation of a build.
+
+Code marks its stages with ``with instrument.stage("name"):`` and the
+fetcher reports every request through ``instrument.record_fetch``. Until
+``enable`` is called both go to a recorder that does nothing, so the hooks
+cost one function call each.
+"""
+import json
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+
+def current_rss() -> Optional[int]:
+    """Resident set size of this process in bytes, None where unsupported."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+@dataclass
+class StageStats:
+    calls: int = 0
+    wall: float = 0.0
+    cpu: float = 0.0
+    max_wall: float = 0.0
+
+
+@dataclass
+class FetchStats:
+    url: str
+    status: Optional[int]
+    bytes: int
+    elapsed: float
+    from_cache: bool = False
+    retries: int = 0
+    error: Optional[str] = None
+
+
+class NullRecorder:
+    """Recorder used while instrumentation is disabled."""
+    enabled = False
+    _null = nullcontext()
+
+    def stage(self, name: str):
+        return self._null
+
+    def record_fetch(self, *args, **kwargs):
+        pass
+
+
+class Recorder:
+    """Collects stage timings, fetch statistics and peak memory of a run.
+
+    Stage CPU time is that of the thread running the stage, so stages run
+    concurrently on several threads add up to more than the wall time.
+    A background thread samples the resident set size every
+    ``sample_interval`` seconds.
+    """
+    enabled = True
+
+    def __init__(self, sample_interval: float = 0.05):
+        self.sample_interval = sample_interval
+        self.stages: Dict[str, StageStats] = {}
+        self.fetches: List[FetchStats] = []
+        self.lock = threading.Lock()
+        self.peak_rss = current_rss() or 0
+        self.started = time.perf_counter()
+        self.started_cpu = time.process_time()
+        self.finished: Optional[float] = None
+        self.finished_cpu: Optional[float] = None
+        self.stopping = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+
+    def sample(self):
+        while not self.stopping.wait(self.sample_interval):
+            rss = current_rss()
+            if rss is None:
+                return
+            if rss > self.peak_rss:
+                self.peak_rss = rss
+
+    def stop(self):
+        if self.finished is None:
+            self.stopping.set()
+            self.sampler.join()
+            self.finished = time.perf_counter()
+            self.finished_cpu = time.process_time()
+            self.peak_rss = max(self.peak_rss, peak_rss())
+
+    @contextmanager
+    def stage(self, name: str):
+        start, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - start, time.thread_time() - cpu
+            with self.lock:
+                stats = self.stages.setdefault(name, StageStats())
+                stats.calls += 1
+                stats.wall += wall
+                stats.cpu += cpu
+                stats.max_wall = max(stats.max_wall, wall)
+
+    def record_fetch(self, url: str, status: Optional[int], size: int, elapsed: float,
+                     from_cache: bool = False, retries: int = 0, error: Optional[str] = None):
+        with self.lock:
+            self.fetches.append(FetchStats(url, status, size, elapsed, from_cache, retries, error))
+
+    def report(self) -> dict:
+        self.stop()
+        fetches = [asdict(fetch) for fetch in self.fetches]
+        return {
+            "wall": round(self.finished - self.started, 4),
+            "cpu": round(self.finished_cpu - self.started_cpu, 4),
+            "peak_rss_mb": round(self.peak_rss / (1024 * 1024), 1),
+            "stages": {name: {key: round(value, 4) if isinstance(value, float) else value
+                              for key, value in asdict(stats).items()}
+                       for name, stats in self.stages.items()},
+            "fetch_totals": {
+                "requests": len(fetches),
+                "bytes": sum(fetch["bytes"] for fetch in fetches),
+                "from_cache": sum(fetch["from_cache"] for fetch in fetches),
+                "errors": sum(fetch["error"] is not None or (fetch["status"] or 0) >= 400
+                              for fetch in fetches),
+                "retries": sum(fetch["retries"] for fetch in fetches),
+            },
+            "fetches": fetches,
+        }
+
+    def summary(self, slowest: int = 5) -> str:
+        report = self.report()
+        lines = [f"Run: {report['wall']:.2f}s wall, {report['cpu']:.2f}s cpu, "
+                 f"peak RSS {report['peak_rss_mb']} MB",
+                 f"{'stage':<16} {'calls':>6} {'wall s':>9} {'cpu s':>9} {'max s':>8}"]
+        for name, stats in sorted(report["stages"].items(), key=lambda item: -item[1]["wall"]):
+            lines.append(f"{name:<16} {stats['calls']:>6} {stats['wall']:>9.3f} "
+                         f"{stats['cpu']:>9.3f} {stats['max_wall']:>8.3f}")
+        totals = report["fetch_totals"]
+        lines.append(f"Fetches: {totals['requests']} requests, {totals['bytes'] / 1024:.0f} KiB, "
+                     f"{totals['from_cache']} from cache, {totals['errors']} errors, "
+                     f"{totals['retries']} retries")
+        for fetch in sorted(report["fetches"], key=lambda fetch: -fetch["elapsed"])[:slowest]:
+            lines.append(f"  {fetch['elapsed']:7.3f}s {fetch['status'] or fetch['error']} {fetch['url']}")
+        return "\n".join(lines)
+
+    def write(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=2)
+
+
+recorder = NullRecorder()
+
+
+def enable(sample_interval: float = 0.05) -> Recorder:
+    """Start recording this run, returns the recorder."""
+    global recorder
+    recorder = Recorder(sample_interval)
+    return recorder
+
+
+def stage(name: str):
+    """Context manager timing a stage of the build."""
+    return recorder.stage(name)
+
+
+def record_fetch(*args, **kwargs):
+    recorder.record_fetch(*args, **kwargs)
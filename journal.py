@@ -0,0 +1,172 @@
+"""
+On-disk checkpoints of a build, so an interrupted build can be resumed
+"""
+import hashlib
+import json
+import os
+import shutil
+from dataclasses import asdict, dataclass, field
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, TextIO, Tuple
+from urllib.parse import urlsplit
+
+import pypub
+
+from streambuilder import IMAGE_SRC
+
+#: bumped when the layout changes, older journals are not resumed
+VERSION = 1
+
+WRITTEN = "written"
+DROPPED = "dropped"
+
+
+@dataclass
+class ChapterRecord:
+    """A chapter the build is done with: written into the book, or dropped."""
+    index: int
+    url: str
+    status: str
+    title: str = ""
+    fingerprint: Optional[int] = None
+    reason: Optional[str] = None
+    offset: int = 0
+    length: int = 0
+
+
+@dataclass
+class Checkpoint:
+    """What an interrupted build had done: its links and the chapters finished."""
+    title: str
+    links: List[str]
+    chapters: Dict[int, ChapterRecord] = field(default_factory=dict)
+
+
+class Journal:
+    """Checkpoint journal of one build, in a directory of its own.
+
+    ``build.json`` holds the title and the final, ordered list of links.
+    Every chapter the build finishes is appended to ``chapters.jsonl``, with
+    its rendered xhtml appended to ``chapters.bin`` first and the images it
+    uses saved under ``images/``. A line is only appended once what it points
+    to is written, so after a crash the journal reads up to the last
+    finished chapter. Writes are flushed to the OS but not synced, they
+    survive the process dying, not the machine.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.records: Optional[TextIO] = None
+        self.data: Optional[BinaryIO] = None
+        self.saved_images = set()
+
+    @staticmethod
+    def location(output_dir: str, url: str) -> str:
+        """Journal directory of the builds of a blog."""
+        digest = hashlib.sha1(url.encode()).hexdigest()[:12]
+        return os.path.join(output_dir, ".journal", f"{urlsplit(url).hostname or 'blog'}-{digest}")
+
+    def file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def load(self) -> Optional[Checkpoint]:
+        """Read the checkpoint of a previous build and open the journal to add to it.
+
+        None when there is no journal or it cannot be read.
+        """
+        try:
+            with open(self.file("build.json"), encoding="utf-8") as f:
+                build = json.load(f)
+            if build.get("version") != VERSION:
+                return None
+            checkpoint = Checkpoint(build["title"], build["links"])
+            size = os.path.getsize(self.file("chapters.bin"))
+            end = 0
+            with open(self.file("chapters.jsonl"), "rb") as f:
+                for line in f:
+                    try:
+                        record = ChapterRecord(**json.loads(line))
+                    except (ValueError, TypeError):
+                        break  # the line being written when the build died
+                    if not line.endswith(b"\n") or record.offset + record.length > size \
+                            or not 0 <= record.index < len(checkpoint.links) \
+                            or checkpoint.links[record.index] != record.url:
+                        break
+                    checkpoint.chapters[record.index] = record
+                    end += len(line)
+            # new records go after the last whole one
+            os.truncate(self.file("chapters.jsonl"), end)
+            # an image being saved when the build died is left as .tmp
+            self.saved_images = {name for name in os.listdir(self.file("images"))
+                                 if not name.endswith(".tmp")}
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        self.open()
+        return checkpoint
+
+    def begin(self, title: str, links: List[str]):
+        """Start the journal of a new build, replacing any previous one."""
+        self.remove()
+        os.makedirs(self.file("images"))
+        with open(self.file("build.json.tmp"), "w", encoding="utf-8") as f:
+            json.dump({"version": VERSION, "title": title, "links": links}, f)
+        os.replace(self.file("build.json.tmp"), self.file("build.json"))
+        self.open()
+
+    def open(self):
+        self.data = open(self.file("chapters.bin"), "ab")
+        self.records = open(self.file("chapters.jsonl"), "a", encoding="utf-8")
+
+    def append(self, record: ChapterRecord):
+        self.records.write(json.dumps(asdict(record)) + "\n")
+        self.records.flush()
+
+    def add(self, index: int, chapter: pypub.Chapter, content: bytes, fingerprint: Optional[int],
+            image_data: Callable[[str], Optional[bytes]]):
+        """Record a chapter written into the book, with its rendered xhtml and images."""
+        for name in dict.fromkeys(IMAGE_SRC.findall(content)):
+            name = name.decode()
+            data = image_data(name) if name not in self.saved_images else None
+            if data is not None:
+                self.save_image(name, data)
+        offset = self.data.tell()
+        self.data.write(content)
+        self.data.flush()
+        self.append(ChapterRecord(index, chapter.url, WRITTEN, chapter.title, fingerprint,
+                                  offset=offset, length=len(content)))
+
+    def drop(self, index: int, url: str, reason: str):
+        """Record a chapter left out of the book for good."""
+        self.append(ChapterRecord(index, url, DROPPED, reason=reason))
+
+    def save_image(self, name: str, data: bytes):
+        path = self.file(os.path.join("images", name))
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(data)
+        os.replace(f"{path}.tmp", path)
+        self.saved_images.add(name)
+
+    def content(self, record: ChapterRecord) -> bytes:
+        """Rendered xhtml of a written chapter, safe to call from any thread."""
+        with open(self.file("chapters.bin"), "rb") as f:
+            return os.pread(f.fileno(), record.length, record.offset)
+
+    def images(self) -> Iterator[Tuple[str, bytes]]:
+        """Every image saved with the chapters, as (name, data)."""
+        for name in self.saved_images:
+            with open(self.file(os.path.join("images", name)), "rb") as f:
+                yield name, f.read()
+
+    def close(self):
+        for f in (self.data, self.records):
+            if f is not None:
+                f.close()
+        self.data = self.records = None
+
+    def remove(self):
+        """Delete the journal, once the book it was for is finished."""
+        self.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+        try:
+            os.rmdir(os.path.dirname(self.path))
+        except OSError:
+            pass  # journals of other builds
@@ -0,0 +1,116 @@
+import re
+from io import BytesIO
+from typing import List, Optional
+from urllib.parse import urljoin
+
+from lxml import etree
+
+#: attributes BeautifulSoup splits into lists, compared by their tokens
+MULTI_VALUED_ATTRIBUTES = {'rel', 'rev', 'accept-charset', 'headers', 'accesskey', 'dropzone'}
+
+#: attributes left out of the structural hash (they differ between posts)
+IGNORED_ATTRIBUTES = {'href', 'class'}
+
+#: child link state once children disagree on their link
+MIXED = object()
+
+IMAGE_EXTENSIONS = re.compile(r'\.(jpg|jpeg|png|gif|bmp|tiff|webp|svg)$', re.IGNORECASE)
+
+
+def is_image_url(url):
+    return bool(IMAGE_EXTENSIONS.search(url))
+
+
+class Record:
+    """Per-element state while its subtree is open on the traversal stack."""
+    __slots__ = ('hash', 'link', 'child_link', 'size')
+
+    def __init__(self, hash, link):
+        self.hash = hash
+        self.link = link
+        self.child_link = None
+        self.size = 1
+
+    def add_child(self, child, first):
+        # rolling hash over the ordered child hashes, so no child list is kept
+        self.hash = hash((self.hash, child.hash))
+        self.size += child.size
+        if first:
+            self.child_link = child.link
+        elif self.child_link is not MIXED and self.child_link != child.link:
+            self.child_link = MIXED
+
+
+def element_hash(elem) -> int:
+    attrs = []
+    for name, value in elem.items():
+        if name in IGNORED_ATTRIBUTES:
+            continue
+        if name in MULTI_VALUED_ATTRIBUTES:
+            value = tuple(value.split())
+        attrs.append((name, value))
+    attrs.sort()
+    return hash((elem.tag, tuple(attrs)))
+
+
+def find_post_links(content: bytes, url: str, encoding: Optional[str] = None) -> List[str]:
+    """Find the links of the largest repeating subtree in an index page.
+
+    Produces the same links as the BeautifulSoup engine in ``utils`` but
+    streams the page through lxml's ``iterparse``, keeps only one small
+    ``Record`` per open element and frees every element once it closes.
+    """
+    # per subtree hash: total size of its link-carrying subtrees and their links
+    subtree_sizes = {}
+    subtree_links = {}
+    stack: List[Record] = []
+    children = []  # number of element children seen by each open record
+    in_body = False
+
+    events = etree.iterparse(BytesIO(content), events=('start', 'end'),
+                             html=True, encoding=encoding, recover=True)
+    for event, elem in events:
+        if not isinstance(elem.tag, str):
+            continue
+        if event == 'start':
+            if not in_body:
+                in_body = elem.tag == 'body'
+                if not in_body:
+                    continue
+            stack.append(Record(element_hash(elem), elem.get('href')))
+            children.append(0)
+            continue
+
+        if not in_body:
+            continue
+        record = stack.pop()
+        count = children.pop()
+        if count and record.child_link is not MIXED:
+            record.link = record.child_link
+        if record.link:
+            key = str(record.hash)
+            subtree_sizes[key] = subtree_sizes.get(key, 0) + record.size
+            subtree_links.setdefault(key, []).append(record.link)
+        # drop the closed element and its already processed siblings
+        elem.clear()
+        parent = elem.getparent()
+        if parent is not None:
+            while elem.getprevious() is not None:
+                del parent[0]
+        if not stack:
+            break
+        stack[-1].add_child(record, children[-1] == 0)
+        children[-1] += 1
+
+    if not subtree_sizes:
+        return []
+    largest = max((count, key) for key, count in subtree_sizes.items())[1]
+
+    links_set = set()
+    links = []
+    for link in subtree_links[largest]:
+        if link in links_set or is_image_url(link):
+            continue
+        links.append(urljoin(url, link))
+        links_set.add(link)
+    return links
@@ -5,14 +5,96 @@
 import logging
 import os
 
-from typing import Optional, Tuple
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
 
 from PIL import Image, ImageDraw, ImageFont  # type: ignore
 from PIL.ImageFont import FreeTypeFont  # type: ignore
 
-logging.basicConfig(level="DEBUG")
 logger = logging.getLogger(__name__)
 
+#: words whose advances one ``FontMetrics`` keeps, the oldest are dropped first
+MAX_ADVANCES = 2048
+
+
+class FontMetrics:
+    """
+    Advances of the words of a text at one font size.
+
+    Every word is measured once, a line is then measured by summing word and
+    space advances instead of re-measuring the whole line as it grows. At
+    most ``MAX_ADVANCES`` words are kept, so metrics shared by a long-running
+    process do not grow with every title they measure.
+    """
+
+    def __init__(self, font: FreeTypeFont, direction: str = "ltr"):
+        self.font = font
+        self.direction = direction
+        self.space = font.getlength(" ", direction)
+        self.advances: Dict[str, float] = {}
+
+    def word(self, word: str) -> float:
+        advance = self.advances.get(word)
+        if advance is None:
+            if len(self.advances) >= MAX_ADVANCES:
+                del self.advances[next(iter(self.advances))]
+            advance = self.advances[word] = self.font.getlength(word, self.direction)
+        return advance
+
+
+@lru_cache(maxsize=256)
+def font_metrics(font: FreeTypeFont, size: int, direction: str = "ltr") -> FontMetrics:
+    """
+    Metrics of ``font`` at ``size``, cached across calls.
+
+    ``font`` is used as the cache key, so pass the same (shared) font
+    object to reuse the measured advances.
+    """
+    return FontMetrics(font.font_variant(size=size), direction)
+
+
+def wrap_lines(
+    metrics: FontMetrics,
+    words: List[str],
+    max_width: float,
+    max_lines: Optional[int] = None,
+) -> Optional[List[str]]:
+    """
+    Greedily wraps words into lines no wider than ``max_width``.
+
+    :return: The lines, or ``None`` if a word is wider than ``max_width``
+             or more than ``max_lines`` lines are needed. Without
+             ``max_lines`` long words overflow instead of failing.
+    """
+
+    lines: List[List[str]] = []
+    curr_line_width = 0.0
+
+    for word in words:
+        word_width = metrics.word(word)
+
+        if lines and curr_line_width + metrics.space + word_width <= max_width:
+            # Put the word on the current line
+            lines[-1].append(word)
+            curr_line_width += metrics.space + word_width
+            continue
+
+        if max_lines is not None and (
+            word_width > max_width or len(lines) + 1 > max_lines
+        ):
+            return None
+
+        # Put the word on the next line
+        lines.append([word])
+        curr_line_width = word_width
+
+    return [" ".join(line) for line in lines] or [""]
+
+
+def max_lines(line_height: int, max_height: int, spacing: int) -> int:
+    """Number of lines of ``line_height`` (plus ``spacing``) fitting in ``max_height``."""
+    return max_height // (line_height + spacing)
+
 
 def wrap_text(
     font: FreeTypeFont,
@@ -29,10 +111,6 @@ def wrap_text(
 
     :param max_width: Maximum width of the final text, in pixels.
 
-    :param max_height: Maximum height height of the final text, in pixels.
-
-    :param spacing: The number of pixels between lines.
-
     :param direction: Direction of the text. It can be 'rtl' (right to
                       left), 'ltr' (left to right) or 'ttb' (top to bottom).
                       Requires libraqm.
@@ -40,32 +118,7 @@ def wrap_text(
     :return: The wrapped text.
     """
 
-    words = text.split()
-
-    lines: list[str] = [""]
-    curr_line_width = 0
-
-    for word in words:
-        if curr_line_width == 0:
-            word_width = font.getlength(word, direction)
-
-            lines[-1] = word
-            curr_line_width = word_width
-        else:
-            new_line_width = font.getlength(f"{lines[-1]} {word}", direction)
-
-            if new_line_width > max_width:
-                # Word is too long to fit on the current line
-                word_width = font.getlength(word, direction)
-
-                # Put the word on the next line
-                lines.append(word)
-                curr_line_width = word_width
-            else:
-                # Put the word on the current line
-                lines[-1] = f"{lines[-1]} {word}"
-                curr_line_width = new_line_width
-
+    lines = wrap_lines(FontMetrics(font, direction), text.split(), max_width)
     return "\n".join(lines)
 
 
@@ -81,9 +134,6 @@ def try_fit_text(
     """
     Attempts to wrap the text into a rectangle.
 
-    Tries to fit the text into a box using the given font at decreasing sizes,
-    based on ``scale_factor``. Makes ``max_iterations`` attempts.
-
     :param font: Font to use.
 
     :param text: Text to fit.
@@ -101,52 +151,28 @@ def try_fit_text(
     :return: If able to fit the text, the wrapped text. Otherwise, ``None``.
     """
 
-    words = text.split()
+    return _try_fit(
+        FontMetrics(font, direction), text.split(), max_width, max_height, spacing
+    )
+
 
-    line_height = font.size
+def _try_fit(
+    metrics: FontMetrics,
+    words: List[str],
+    max_width: int,
+    max_height: int,
+    spacing: int,
+) -> Optional[str]:
+    line_height = metrics.font.size
 
     if line_height > max_height:
         # The line height is already too big
         return None
 
-    lines: list[str] = [""]
-    curr_line_width = 0
-
-    for word in words:
-        if curr_line_width == 0:
-            word_width = font.getlength(word, direction)
-
-            if word_width > max_width:
-                # Word is longer than max_width
-                return None
-
-            lines[-1] = word
-            curr_line_width = word_width
-        else:
-            new_line_width = font.getlength(f"{lines[-1]} {word}", direction)
-
-            if new_line_width > max_width:
-                # Word is too long to fit on the current line
-                word_width = font.getlength(word, direction)
-                new_num_lines = len(lines) + 1
-                new_text_height = (new_num_lines * line_height) + (
-                    new_num_lines * spacing
-                )
-
-                if word_width > max_width or new_text_height > max_height:
-                    # Word is longer than max_width, and
-                    # adding a new line would make the text too tall
-                    return None
-
-                # Put the word on the next line
-                lines.append(word)
-                curr_line_width = word_width
-            else:
-                # Put the word on the current line
-                lines[-1] = f"{lines[-1]} {word}"
-                curr_line_width = new_line_width
-
-    return "\n".join(lines)
+    lines = wrap_lines(
+        metrics, words, max_width, max(1, max_lines(line_height, max_height, spacing))
+    )
+    return "\n".join(lines) if lines is not None else None
 
 
 # pylint: disable=too-many-arguments
@@ -163,11 +189,13 @@ def fit_text(
     """
     Automatically determines text wrapping and appropriate font size.
 
-    Tries to fit the text into a box using the given font at decreasing sizes,
-    based on ``scale_factor``. Makes ``max_iterations`` attempts.
+    Binary searches the largest font size, between the size of ``font`` and
+    that size scaled down ``max_iterations - 1`` times by ``scale_factor``,
+    at which the text fits into the box. Word advances are cached per font
+    size (see ``font_metrics``), so each candidate size wraps in linear time.
 
-    If unable to find an appropriate font size within ``max_iterations``
-    attempts, wraps the text at the last attempted size.
+    If the text does not fit even at the smallest size, wraps the text at
+    that size.
 
     :param font: Font to use.
 
@@ -179,9 +207,9 @@ def fit_text(
 
     :param spacing: The number of pixels between lines.
 
-    :param scale_factor:
+    :param scale_factor: Lower bound of the searched sizes, per iteration.
 
-    :param max_iterations: Maximum number of attempts to try to fit the text.
+    :param max_iterations: Number of scaling steps bounding the searched sizes.
 
     :param direction: Direction of the text. It can be 'rtl' (right to
                       left), 'ltr' (left to right) or 'ttb' (top to bottom).
@@ -190,34 +218,33 @@ def fit_text(
     :return: The font at the appropriate size and the wrapped text.
     """
 
-    initial_font_size = font.size
-
-    logger.debug('Trying to fit text "%s"', text)
+    words = text.split()
+    high = int(font.size)
+    low = max(1, int(font.size * pow(scale_factor, max_iterations - 1)))
+    smallest = low
 
-    for i in range(max_iterations):
-        trial_font_size = int(initial_font_size * pow(scale_factor, i))
-        trial_font = font.font_variant(size=trial_font_size)
+    logger.debug('Trying to fit text "%s" at sizes %i-%i', text, low, high)
 
-        logger.debug("Trying font size %i", trial_font_size)
+    best: Optional[Tuple[FreeTypeFont, str]] = None
+    while low <= high:
+        size = (low + high) // 2
+        metrics = font_metrics(font, size, direction)
+        wrapped_text = _try_fit(metrics, words, max_width, max_height, spacing)
 
-        wrapped_text = try_fit_text(
-            trial_font,
-            text,
-            max_width,
-            max_height,
-            spacing,
-            direction,
-        )
+        if wrapped_text is not None:
+            best = (metrics.font, wrapped_text)
+            low = size + 1
+        else:
+            high = size - 1
 
-        if wrapped_text:
-            logger.debug("Successfully fit text")
-            return (trial_font, wrapped_text)
+    if best:
+        logger.debug("Successfully fit text at size %i", best[0].size)
+        return best
 
-    # Give up and wrap the text at the last size
+    # Give up and wrap the text at the smallest size
     logger.debug("Gave up trying to fit text; just wrapping text")
-    wrapped_text = wrap_text(trial_font, text, max_width, direction)
-
-    return (trial_font, wrapped_text)
+    metrics = font_metrics(font, smallest, direction)
+    return (metrics.font, "\n".join(wrap_lines(metrics, words, max_width)))
 
 
 if __name__ == "__main__":
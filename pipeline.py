@@ -0,0 +1,159 @@
+import queue
+import threading
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
+
+#: tells a render thread to exit
+STOP = object()
+
+
+class ChapterPipeline:
+    """Fetch, render and write items with bounded memory, in input order.
+
+    ``fetch(item) -> (value, size)`` runs on ``fetch_threads`` threads and
+    ``render(index, value)`` on ``render_threads`` threads, linked by a
+    queue of ``queue_size`` fetched values. Rendered results go into a
+    reorder buffer that ``run`` drains in input order, calling
+    ``write(index, result)`` on the calling thread. A fetch returning a
+    ``None`` value, or a render returning ``None``, skips the item.
+
+    Fetching is throttled so that at most ``window`` items are between
+    being fetched and being written, and, when ``memory_limit`` is given,
+    so that no new fetch starts while the fetched items still in flight add
+    up to more than ``memory_limit`` bytes, counting ``extra_bytes()``, the
+    memory held elsewhere on their behalf (images being downloaded, say).
+    Items are handed to fetchers in input order, so the item the writer
+    waits for is always already in flight and the throttling cannot stall
+    the pipeline. The extra bytes are released outside the pipeline, so
+    they are polled, and never hold back a fetch when nothing is in flight.
+    """
+
+    def __init__(self, fetch: Callable[[Any], Tuple[Any, int]],
+                 render: Callable[[int, Any], Any], write: Callable[[int, Any], None],
+                 fetch_threads: int = 16, render_threads: int = 2, window: int = 256,
+                 queue_size: int = 8, memory_limit: Optional[int] = None,
+                 extra_bytes: Optional[Callable[[], int]] = None):
+        self.fetch = fetch
+        self.render = render
+        self.write = write
+        self.fetch_threads = fetch_threads
+        self.render_threads = render_threads
+        self.window = max(1, window)
+        self.memory_limit = memory_limit
+        self.extra_bytes = extra_bytes
+        self.rendering: queue.Queue = queue.Queue(queue_size)
+        self.condition = threading.Condition()
+        self.items: Sequence = []
+        self.next_index = 0
+        self.written = 0
+        self.in_flight_bytes = 0
+        self.peak_bytes = 0
+        self.done: Dict[int, Tuple[Any, int]] = {}
+        self.error: Optional[BaseException] = None
+
+    def admit(self) -> Optional[int]:
+        """Wait until the next item may be fetched, None once there is none."""
+        with self.condition:
+            while True:
+                if self.error is not None or self.next_index >= len(self.items):
+                    return None
+                within_window = self.next_index < self.written + self.window
+                within_memory = self.memory_limit is None \
+                    or self.in_flight_bytes + self.held_bytes() <= self.memory_limit
+                if within_window and within_memory:
+                    self.next_index += 1
+                    return self.next_index - 1
+                self.condition.wait(0.05 if self.extra_bytes else None)
+
+    def held_bytes(self) -> int:
+        if self.extra_bytes is None or self.next_index == self.written:
+            return 0
+        return self.extra_bytes()
+
+    def finish(self, index: int, result: Any, size: int):
+        with self.condition:
+            self.done[index] = (result, size)
+            self.condition.notify_all()
+
+    def fail(self, error: BaseException):
+        with self.condition:
+            if self.error is None:
+                self.error = error
+            self.condition.notify_all()
+
+    def put(self, item) -> bool:
+        """Queue an item for rendering unless the pipeline failed meanwhile."""
+        while self.error is None:
+            try:
+                self.rendering.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def fetch_worker(self):
+        while (index := self.admit()) is not None:
+            try:
+                value, size = self.fetch(self.items[index])
+            except BaseException as e:
+                self.fail(e)
+                return
+            with self.condition:
+                self.in_flight_bytes += size
+                self.peak_bytes = max(self.peak_bytes, self.in_flight_bytes)
+            if value is None:
+                self.finish(index, None, size)
+            elif not self.put((index, value, size)):
+                return
+
+    def render_worker(self):
+        while self.error is None:
+            try:
+                item = self.rendering.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is STOP:
+                return
+            index, value, size = item
+            try:
+                result = self.render(index, value)
+            except BaseException as e:
+                self.fail(e)
+                return
+            # drop the fetched value before waiting for the next one
+            del item, value
+            self.finish(index, result, size)
+
+    def run(self, items: Sequence):
+        """Push every item through the pipeline, returns once all are written."""
+        self.items = items
+        fetchers = [threading.Thread(target=self.fetch_worker, daemon=True)
+                    for _ in range(min(self.fetch_threads, len(items)) or 1)]
+        renderers = [threading.Thread(target=self.render_worker, daemon=True)
+                     for _ in range(self.render_threads)]
+        for thread in fetchers + renderers:
+            thread.start()
+        try:
+            while self.written < len(items):
+                with self.condition:
+                    while self.written not in self.done and self.error is None:
+                        self.condition.wait()
+                    if self.error is not None:
+                        raise self.error
+                    result, size = self.done.pop(self.written)
+                if result is not None:
+                    self.write(self.written, result)
+                del result
+                with self.condition:
+                    self.written += 1
+                    self.in_flight_bytes -= size
+                    self.condition.notify_all()
+        except BaseException as e:
+            self.fail(e)
+            raise
+        finally:
+            for thread in fetchers:
+                thread.join()
+            for _ in renderers:
+                self.put(STOP)
+            for thread in renderers:
+                thread.join()
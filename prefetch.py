@@ -0,0 +1,87 @@
+import threading
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set
+
+
+class Prefetcher:
+    """Fetch posts in the background while the user is still choosing them.
+
+    ``fetch(link)`` runs on ``threads`` threads, in the order of the list,
+    for at most ``limit`` links at a time (fetched and not yet taken).
+    ``update`` follows the list as it is edited: the links not started yet
+    are fetched in the new order, and excluded links are never started or
+    have their result dropped. ``take`` hands a result over to the build,
+    waiting for a fetch already under way rather than starting another.
+    A fetch that raises leaves its link to be fetched again by the build.
+    """
+
+    def __init__(self, fetch: Callable[[str], Any], links: Sequence[str],
+                 threads: int = 8, limit: int = 256):
+        self.fetch = fetch
+        self.limit = max(1, limit)
+        self.condition = threading.Condition()
+        self.wanted: Set[str] = set(links)
+        self.pending: List[str] = list(links)
+        self.running: Set[str] = set()
+        self.done: Dict[str, Any] = {}
+        self.closed = False
+        self.threads = [threading.Thread(target=self.worker, daemon=True)
+                        for _ in range(min(threads, len(links)))]
+        for thread in self.threads:
+            thread.start()
+
+    def next_link(self) -> Optional[str]:
+        with self.condition:
+            while not self.closed and (not self.pending
+                                       or len(self.running) + len(self.done) >= self.limit):
+                self.condition.wait()
+            if self.closed:
+                return None
+            link = self.pending.pop(0)
+            self.running.add(link)
+            return link
+
+    def worker(self):
+        while (link := self.next_link()) is not None:
+            try:
+                result = self.fetch(link)
+            except Exception:
+                result = None
+            with self.condition:
+                self.running.discard(link)
+                if result is not None and link in self.wanted:
+                    self.done[link] = result
+                self.condition.notify_all()
+
+    def update(self, links: Sequence[str]):
+        """Fetch the links left in the list, in its current order."""
+        with self.condition:
+            self.wanted = set(links)
+            for link in [link for link in self.done if link not in self.wanted]:
+                del self.done[link]
+            self.pending = [link for link in links
+                            if link not in self.running and link not in self.done]
+            self.condition.notify_all()
+
+    def take(self, link: str) -> Optional[Any]:
+        """The prefetched result for ``link``, None if the build must fetch it."""
+        with self.condition:
+            while link in self.running:
+                self.condition.wait()
+            result = self.done.pop(link, None)
+            self.condition.notify_all()
+            return result
+
+    def close(self):
+        """Start no more fetches, results already fetched can still be taken."""
+        with self.condition:
+            self.closed = True
+            self.pending = []
+            self.condition.notify_all()
+
+    def stop(self):
+        """Close and drop every result, waiting for fetches under way."""
+        self.close()
+        for thread in self.threads:
+            thread.join()
+        with self.condition:
+            self.done.clear()
@@ -1,19 +1,53 @@
-import html
 import os
+import re
+from functools import partial
+from typing import Optional
 import pypub
-import pyxml
 from pypub.builder import jinja_env, copy_static, epub_dirs, copy_file, generate_cover
-from pypub.factory import REPLACE, SUPPORTED_TAGS, HtmlElement, cast
-import urllib.parse
+from pypub.factory import SUPPORTED_TAGS, RenderCtx
+import lxml.html
 from lxml import etree
+import instrument
+import sanitize
+from sitetemplate import TEMPLATES
 
-def is_valid_xml(xml_string):
+#: name of the chapter meta tag holding the url the chapter was fetched from
+SOURCE_META = 'dc.source'
+
+#: elements the chapter template adds around the cleaned content
+TEMPLATE_TAGS = {'meta', 'link', 'title', 'hr'}
+
+#: valid xml attribute names (optionally prefixed, e.g. xml:lang)
+XML_NAME = re.compile(r'^[A-Za-z_][\w.-]*(:[A-Za-z_][\w.-]*)?$')
+
+
+class ChapterRejected(Exception):
+    """raised when a chapter cannot be rendered into valid xhtml"""
+
+
+def serialize_xhtml(root) -> bytes:
+    """
+    serialize a finalized chapter tree, validating it along the way
+
+    lxml only ever holds xml-safe text, so the remaining failure modes are
+    elements and attribute names that xhtml cannot represent
+    """
+    for elem in root.iter():
+        if not isinstance(elem.tag, str):
+            continue
+        if elem.tag not in SUPPORTED_TAGS and elem.tag not in TEMPLATE_TAGS:
+            raise ChapterRejected(f'unsupported element <{elem.tag}>')
+        for name in elem.attrib:
+            if not XML_NAME.match(name):
+                raise ChapterRejected(f'invalid attribute name {name!r} on <{elem.tag}>')
+        # keep empty elements self-closing (<br/>) after prettify
+        if elem.text == '':
+            elem.text = None
     try:
-        # Parse the XML string
-        etree.fromstring(xml_string)
-        return True
-    except etree.XMLSyntaxError:
-        return False
+        return etree.tostring(root, method='xml', encoding='utf-8', xml_declaration=True)
+    except (ValueError, etree.SerialisationError) as e:
+        raise ChapterRejected(f'cannot serialize: {e}') from e
+
 
 def begin(self):
     """begin building operations w/ basic file structure"""
@@ -49,8 +83,8 @@ def begin(self):
     return self.dirs
 
 
-def render_chapter(self, assign, chapter):
-    """render an assigned chapter into the ebook"""
+def render_content(self, assign, chapter):
+    """render an assigned chapter into valid xhtml bytes (None if rejected)"""
     if not self.dirs or not self.template:
         raise RuntimeError('cannot render_chapter before `begin`')
     # log chapter generation
@@ -60,70 +94,73 @@ def render_chapter(self, assign, chapter):
     # render chapter w/ appropriate kwargs
     args    = (self.logger, chapter, self.dirs.images, self.template)
     kwargs  = {'epub': self.epub, 'chapter': chapter}
-    fpath   = os.path.join(self.dirs.oebps, assign.link)
-    content = self.factory.render(*args, kwargs, 
-        extern_links=self.epub.extern_links)
+    try:
+        return self.factory.render(*args, kwargs, 
+            extern_links=self.epub.extern_links)
+    except ChapterRejected as e:
+        self.logger.warning('rejected chapter #%d %r (%s): %s' % (
+            assign.play_order, chapter.title, chapter.url, e))
+        self.__dict__.setdefault('rejected', []).append((chapter, str(e)))
+        return None
+
+
+def render_chapter(self, assign, chapter):
+    """render an assigned chapter into the ebook"""
+    content = self.render_content(assign, chapter)
+    if content is None:
+        return
+    fpath = os.path.join(self.dirs.oebps, assign.link)
     with open(fpath, 'wb') as f:
-        string_content = content.decode("utf-8")
-        clean_content = html.unescape(html.unescape(string_content)).replace('&', '&amp;')
-        content_encoded = clean_content.encode("utf-8")
-        if is_valid_xml(content_encoded):
-            self.chapters.append((assign, chapter))
-            f.write(content_encoded)
+        f.write(content)
+    self.chapters.append((assign, chapter))
 
 
-def cleanup_html(self, content: bytes):
+def render(self, log, chapter, *args, **kwargs) -> bytes:
+    """
+    render chapter to bytes w/ the given settings
+    """
+    etree = self.cleanup_html(chapter.content, chapter.url)
+    ctx   = RenderCtx(log, chapter, etree, *args, **kwargs)
+    self.hydrate(ctx)
+    return self.finalize(ctx)
+
+
+def cleanup_html(self, content: bytes, url: Optional[str] = None):
     """
     cleanup html content to only include supported tags
+
+    the content root is found with the selector learned for url's site
+    """
+    with instrument.stage('cleanup_html'):
+        return sanitize.cleanup_html(content, partial(TEMPLATES.content_root, url=url))
+
+
+def finalize(self, ctx: RenderCtx) -> bytes:
+    """
+    render chapter content w/ specified template
     """
-    content = content.decode('utf-8', 'replace').translate(REPLACE).encode()
-    # check if we can minimalize the scope
-    etree_original   = pyxml.html.fromstring(content)
-    etree = etree_original
-    body    = etree_original.xpath('.//body')
-    etree   = body[0] if body else etree
-    content = etree_original.xpath('//*[@class = "content"]')
-    etree   = content[0] if content else etree
-    article = etree_original.xpath('.//article')
-    etree   = article[0] if article else etree
-    post_content = etree_original.xpath('//*[contains(@class, "content")][contains(@class, "post")]')
-    etree   = post_content[0] if post_content else etree
-    article_body = etree_original.xpath('//*[contains(@itemprop, "articleBody")]')
-    etree   = article_body[0] if article_body else etree
-    # iterate elements in tree and delete/modify them
-    for elem in [elem for elem in etree.iter()][1:]:
-        # if element tag is supported
-        if elem.tag in SUPPORTED_TAGS:
-            # remove attributes not approved for specific tag or no value
-            for attr, value in list(elem.attrib.items()):
-                if attr not in SUPPORTED_TAGS[elem.tag] or not value:
-                    elem.attrib.pop(attr)
-                elif attr == 'href':
-                    elem.attrib['href'] = urllib.parse.quote(elem.attrib['href'])
-        # if element is not supported, append children to parent
-        else:
-            # retrieve parent
-            parent = cast(HtmlElement, elem.getparent())
-            for child in elem.getchildren():
-                parent.append(child)
-            parent.remove(elem)
-            #NOTE: this is a bug with lxml, some children have
-            # text in the parent included in the tail rather
-            # than text attribute, so we also append tail to text
-            if elem.tail and elem.tail.strip():
-                parent.text = (parent.text or '') + elem.tail.strip()
-    # fix and remove invalid images
-    for img in etree.xpath('.//img'):
-        # ensure all images with no src are removed
-        if 'src' not in img.attrib:
-            cast(HtmlElement, img.getparent()).remove(img)
-        # ensure they also have an alt
-        elif 'alt' not in img.attrib:
-            img.attrib['alt'] = img.attrib['src']
-    # return new element-tree
-    return etree
+    if not len(ctx.etree) and not (ctx.etree.text or '').strip():
+        raise ChapterRejected('no content left after cleanup')
+    content = ctx.template.render(**ctx.render_kwargs)
+    # attach elements from chapter etree to content etree
+    root = lxml.html.document_fromstring(content.encode())
+    head = root.find('head')
+    body = root.find('body')
+    # record the source post so `--update` can tell which posts a book holds
+    if ctx.chapter.url:
+        etree.SubElement(head, 'meta', name=SOURCE_META, content=ctx.chapter.url)
+    sanitize.append_text(body, list(body), ctx.etree.text)
+    for elem in list(ctx.etree):
+        body.append(elem)
+    # return html as string to be written
+    with instrument.stage('serialize'):
+        self.prettify(root)
+        return serialize_xhtml(root)
 
 
 pypub.EpubBuilder.begin = begin
+pypub.EpubBuilder.render_content = render_content
 pypub.EpubBuilder.render_chapter = render_chapter
+pypub.factory.SimpleChapterFactory.render = render
 pypub.factory.SimpleChapterFactory.cleanup_html = cleanup_html
+pypub.factory.SimpleChapterFactory.finalize = finalize
@@ -0,0 +1,94 @@
+import email.utils
+import random
+import threading
+import time
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+#: statuses that mean the host is overloaded, the request is worth retrying
+THROTTLED = {429, 500, 502, 503, 504}
+
+
+def retry_after(value: Optional[str], now: Optional[float] = None) -> Optional[float]:
+    """Seconds to wait according to a Retry-After header (delay or http date)."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = time.time() if now is None else now
+    return max(0.0, date.timestamp() - now)
+
+
+def backoff(attempt: int, base: float, cap: float) -> float:
+    """Full jitter exponential backoff before retry number ``attempt`` (from 0)."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class HostLimiter:
+    """Additive increase, multiplicative decrease concurrency window of a host.
+
+    Every successful response widens the window by ``1 / limit`` (so by one
+    request per window's worth of successes) up to ``maximum``. A throttled
+    response halves it, at most once per window of requests, since the
+    requests already in flight were sent before the host could be heard. A
+    ``Retry-After`` pauses every request to the host until it has passed.
+    """
+
+    def __init__(self, maximum: int, initial: Optional[int] = None, minimum: int = 1,
+                 decrease: float = 0.5):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.decrease = decrease
+        self.limit = float(initial or max(minimum, maximum // 2))
+        self.in_flight = 0
+        self.resume_at = 0.0
+        self.sent = 0
+        self.last_cut = -1
+        self.condition = threading.Condition()
+
+    def acquire(self) -> int:
+        """Wait for a slot, returns the sequence number of the request."""
+        with self.condition:
+            while True:
+                wait = self.resume_at - time.monotonic()
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    break
+                self.condition.wait(wait if wait > 0 else None)
+            self.in_flight += 1
+            self.sent += 1
+            return self.sent
+
+    def release(self, sequence: int, throttled: bool = False, pause: Optional[float] = None):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                # requests sent before the last cut saw the old window, do not cut twice
+                if sequence > self.last_cut:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self.last_cut = self.sent
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            if pause:
+                self.resume_at = max(self.resume_at, time.monotonic() + pause)
+            self.condition.notify_all()
+
+
+class RateController:
+    """Per-host ``HostLimiter``s of a fetcher."""
+
+    def __init__(self, max_per_host: int):
+        self.max_per_host = max_per_host
+        self.hosts: Dict[str, HostLimiter] = {}
+        self.lock = threading.Lock()
+
+    def host(self, url: str) -> HostLimiter:
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = HostLimiter(self.max_per_host)
+            return self.hosts[host]
@@ -0,0 +1,113 @@
+import html
+import logging
+import re
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+from typing import List, Optional
+
+import pypub
+from pypub.builder import jinja_env
+from pypub.factory import RenderCtx
+
+import instrument
+from images import ImagePipeline, image_url, process_pool
+from pypubpatch import ChapterRejected
+from sanitize import externalize_links
+from utils import depipe
+
+logger = logging.getLogger(__name__)
+
+#: src given to images in worker output, followed by the image's index
+PLACEHOLDER = 'blogtoepub-image:'
+PLACEHOLDER_IMG = re.compile(rb'<img\b[^>]*?\ssrc="' + PLACEHOLDER.encode() + rb'(\d+)"[^>]*/>')
+
+
+@dataclass
+class RenderedChapter:
+    """A chapter rendered by a worker, its images still to be resolved."""
+    title: str
+    content: Optional[bytes]
+    images: List[str] = field(default_factory=list)
+    rejected: Optional[str] = None
+
+
+class PlaceholderChapterFactory(pypub.SimpleChapterFactory):
+    """Chapter factory that collects image urls instead of downloading them."""
+
+    def __init__(self):
+        self.images = []
+
+    def hydrate(self, ctx: RenderCtx):
+        for image in ctx.etree.xpath('.//img[@src]'):
+            url = image_url(image.attrib['src'], ctx.chapter.url)
+            if url:
+                image.attrib['src'] = f'{PLACEHOLDER}{len(self.images)}'
+                self.images.append(url)
+        if ctx.extern_links and ctx.chapter.url:
+            externalize_links(ctx.chapter.url, ctx.etree)
+
+
+def render_chapter(title: str, content: bytes, url: Optional[str], epub_title: str,
+                   css_paths: List[str], extern_links: bool) -> RenderedChapter:
+    """Clean and render a chapter into xhtml, runs in a worker process."""
+    chapter = pypub.Chapter(depipe(title), content, url)
+    factory = PlaceholderChapterFactory()
+    epub = SimpleNamespace(title=epub_title, css_paths=css_paths)
+    template = jinja_env.get_template('page.xhtml.j2')
+    try:
+        content = factory.render(logger, chapter, None, template,
+                                 {'epub': epub, 'chapter': chapter}, extern_links=extern_links)
+    except ChapterRejected as e:
+        return RenderedChapter(chapter.title, None, rejected=str(e))
+    return RenderedChapter(chapter.title, content, factory.images)
+
+
+class ParallelRenderer:
+    """Renders chapters in a process pool, the main process adds the images.
+
+    ``render_content`` blocks its thread while a worker parses, cleans and
+    renders the chapter, so as many chapters render at once as there are
+    workers, then points the chapter's images at the pipeline's embedded
+    copies. The result is added to the book like the builder's own
+    ``render_content`` output.
+    """
+
+    def __init__(self, images: ImagePipeline, workers: Optional[int] = None):
+        self.images = images
+        self.pool: ProcessPoolExecutor = process_pool(workers)
+
+    def render(self, epub: pypub.Epub, chapter: pypub.Chapter) -> RenderedChapter:
+        return self.pool.submit(render_chapter, chapter.title, chapter.content, chapter.url,
+                                epub.title, list(epub.css_paths), epub.extern_links).result()
+
+    def resolve_images(self, rendered: RenderedChapter) -> bytes:
+        def substitute(match):
+            src = rendered.images[int(match.group(1))]
+            placeholder = f'src="{PLACEHOLDER}{match.group(1).decode()}"'.encode()
+            downloaded, path = self.images.resolve(src)
+            if path:
+                return match.group(0).replace(placeholder, f'src="{path}"'.encode())
+            if downloaded:
+                # over the image budget
+                return b''
+            escaped = html.escape(src, quote=True)
+            return match.group(0).replace(placeholder, f'src="{escaped}"'.encode())
+
+        with instrument.stage('images'):
+            return PLACEHOLDER_IMG.sub(substitute, rendered.content)
+
+    def render_content(self, builder, assign: pypub.Assignment,
+                       chapter: pypub.Chapter) -> Optional[bytes]:
+        """Render a chapter of ``builder``'s book (None if rejected)."""
+        rendered = self.render(builder.epub, chapter)
+        chapter.title = rendered.title
+        if rendered.content is None:
+            logger.warning('rejected chapter #%d %r (%s): %s', assign.play_order,
+                           rendered.title, chapter.url, rendered.rejected)
+            builder.rejected.append((chapter, rendered.rejected))
+            return None
+        return self.resolve_images(rendered)
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
@@ -0,0 +1,143 @@
+"""
+Single pass html sanitizer for chapter content
+"""
+import urllib.parse
+from typing import Callable, Optional
+
+import lxml.html
+from lxml import etree
+from lxml.html import HtmlElement
+from pypub.factory import REPLACE, SUPPORTED_TAGS
+
+from decode import parse_html
+
+#: content root candidates, from most to least specific
+CONTENT_ROOTS = [
+    etree.XPath('//*[contains(@itemprop, "articleBody")]'),
+    etree.XPath('//*[contains(@class, "content")][contains(@class, "post")]'),
+    etree.XPath('.//article'),
+    etree.XPath('//*[@class = "content"]'),
+    etree.XPath('.//body'),
+]
+
+
+#: elements whose content is never chapter text, dropped with everything in them
+NON_CONTENT_TAGS = {
+    'script', 'style', 'noscript', 'template', 'iframe', 'object', 'svg',
+    'form', 'button', 'select',
+}
+
+
+def content_root(document: HtmlElement) -> HtmlElement:
+    """Return the element most likely to hold the post content."""
+    for xpath in CONTENT_ROOTS:
+        found = xpath(document)
+        if found:
+            return found[0]
+    return document
+
+
+def plain(text: Optional[str]) -> Optional[str]:
+    """Text with typographic quotes and dashes made plain, like pypub does."""
+    return text.translate(REPLACE) if text and not text.isascii() else text
+
+
+def append_text(parent: HtmlElement, kept: list, text: Optional[str]):
+    """Append text after the last kept child (or into the parent's text)."""
+    if not text:
+        return
+    if kept:
+        kept[-1].tail = (kept[-1].tail or '') + text
+    else:
+        parent.text = (parent.text or '') + text
+
+
+def clean_attributes(elem: HtmlElement) -> bool:
+    """Filter the attributes of a supported element, False if it must go."""
+    allowed = SUPPORTED_TAGS[elem.tag]
+    attrib = elem.attrib
+    for attr, value in attrib.items():
+        if attr not in allowed or not value:
+            del attrib[attr]
+        elif attr == 'href':
+            attrib['href'] = urllib.parse.quote(plain(value))
+        elif not value.isascii():
+            attrib[attr] = plain(value)
+    if elem.tag == 'img':
+        # ensure all images with no src are removed and the rest have an alt
+        if 'src' not in attrib:
+            return False
+        attrib['alt'] = attrib['src']
+    return True
+
+
+def clean_children(parent: HtmlElement):
+    """Rebuild the children of an element whose descendants are clean.
+
+    Unsupported children are replaced in place by their own (already
+    clean) children and text. Non-content children (scripts, styles,
+    embeds, forms) and comments are dropped but keep their tail.
+    The new child list is assigned once, so this is linear in the number
+    of children however many of them are unwrapped.
+    """
+    kept = []
+    changed = False
+    for child in parent:
+        tag = child.tag
+        if not isinstance(tag, str) or tag in NON_CONTENT_TAGS:
+            append_text(parent, kept, child.tail)
+            changed = True
+        elif tag not in SUPPORTED_TAGS:
+            append_text(parent, kept, child.text)
+            for grandchild in child:
+                kept.append(grandchild)
+            append_text(parent, kept, child.tail)
+            changed = True
+        elif clean_attributes(child):
+            kept.append(child)
+        else:
+            append_text(parent, kept, child.tail)
+            changed = True
+    if changed:
+        parent[:] = kept
+
+
+def sanitize(root: HtmlElement) -> HtmlElement:
+    """Strip everything an epub does not support below ``root`` in one pass.
+
+    Elements are visited children first with an explicit stack, so deeply
+    nested markup cannot hit the recursion limit. Text is made ``plain``
+    on the way down, before unwrapping moves it around.
+    """
+    stack = [(root, False)]
+    while stack:
+        elem, visited = stack.pop()
+        if visited:
+            clean_children(elem)
+            continue
+        stack.append((elem, True))
+        elem.text = plain(elem.text)
+        for child in elem:
+            child.tail = plain(child.tail)
+            # non-content subtrees are dropped whole, no need to clean them
+            if isinstance(child.tag, str) and child.tag not in NON_CONTENT_TAGS:
+                stack.append((child, False))
+    return root
+
+
+def cleanup_html(content: bytes,
+                 root: Callable[[HtmlElement], HtmlElement] = content_root) -> HtmlElement:
+    """Parse chapter html and return its sanitized content root, found by ``root``."""
+    if not content.strip():
+        return lxml.html.Element('body')
+    document = parse_html(content)
+    return sanitize(root(document))
+
+
+def externalize_links(url: str, root: HtmlElement):
+    """Make relative chapter links absolute (pypub's version needs pyxml)."""
+    for elem in root.iter('a'):
+        href = elem.get('href')
+        if not href or '://' in href[:10] or href.startswith('#'):
+            continue
+        elem.set('href', urllib.parse.urljoin(url, href))
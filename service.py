@@ -0,0 +1,463 @@
+"""
+Local build service: a job queue in front of create_epub, sharing warm resources
+"""
+import collections
+import json
+import os
+import re
+import shutil
+import socketserver
+import stat
+import statistics
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from functools import partial
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Deque, Dict, List, Optional, Tuple, Union
+from urllib.parse import parse_qs, urlsplit
+
+from batch import Job, parse_job
+from fetch import Fetcher
+from images import ImagePipeline
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+#: finished jobs kept, with their books, and the timing statistics are taken over
+HISTORY = 200
+
+#: seconds a finished job and its books are kept
+JOB_TTL = 24 * 60 * 60
+
+#: largest job description accepted, in bytes
+MAX_REQUEST = 64 * 1024
+
+
+@dataclass
+class BuildJob:
+    """A job of the service and what is known of its progress."""
+    id: str
+    job: Job
+    host: str
+    state: str = QUEUED
+    submitted: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    written: int = 0
+    total: Optional[int] = None
+    paths: List[str] = field(default_factory=list)
+    error: Optional[str] = None
+
+    @property
+    def wait(self) -> Optional[float]:
+        """Seconds spent in the queue."""
+        if self.started is None:
+            return None
+        return self.started - self.submitted
+
+    @property
+    def build(self) -> Optional[float]:
+        """Seconds spent building."""
+        if self.started is None:
+            return None
+        return (self.finished or time.time()) - self.started
+
+    def status(self) -> dict:
+        return {
+            "id": self.id,
+            "url": self.job.url,
+            "host": self.host,
+            "state": self.state,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "wait": self.wait,
+            "build": self.build,
+            "chapters": {"written": self.written, "total": self.total},
+            "files": [os.path.basename(path) for path in self.paths],
+            "error": self.error,
+        }
+
+
+def timings(values: List[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "mean": statistics.fmean(values),
+        "p50": values[len(values) // 2],
+        "p90": values[min(len(values) - 1, int(len(values) * 0.9))],
+        "max": values[-1],
+    }
+
+
+class BuildService:
+    """Run build jobs on ``concurrency`` threads that keep their resources warm.
+
+    Every job goes through the same fetcher, so connection pools, the HTTP
+    cache and the learned site templates carry over from job to job, as do
+    the cover font and images. Each thread has its own image pipeline,
+    whose download threads and downscaling processes stay up between jobs.
+    Jobs are queued per host and taken from the hosts in turn, with at most
+    ``per_host`` jobs of one host running at once, so a long queue for one
+    blog does not hold up the others. Each job writes into its own
+    directory under ``output_dir``, which is deleted with the job once it
+    has been finished for ``ttl`` seconds or ``HISTORY`` newer jobs have
+    finished. Covers and books to update can only be taken from
+    ``files_dir``, and a book is updated as a copy in the job's directory.
+    ``options`` are passed to every build.
+    """
+
+    def __init__(self, build: Callable[..., Optional[List[str]]], fetcher: Fetcher,
+                 make_images: Callable[[], ImagePipeline], output_dir: str = "./output/jobs",
+                 concurrency: int = 2, per_host: int = 1, files_dir: Optional[str] = None,
+                 ttl: float = JOB_TTL, **options):
+        self.build = build
+        self.fetcher = fetcher
+        self.output_dir = output_dir
+        self.files_dir = os.path.realpath(files_dir) if files_dir else None
+        self.ttl = ttl
+        self.per_host = per_host
+        self.options = options
+        self.condition = threading.Condition()
+        self.jobs: Dict[str, BuildJob] = {}
+        # hosts with queued jobs, in the order they get their next turn
+        self.queues: Dict[str, Deque[BuildJob]] = collections.OrderedDict()
+        self.running: Dict[str, int] = collections.Counter()
+        self.finished: Deque[BuildJob] = collections.deque(maxlen=HISTORY)
+        self.counts: Dict[str, int] = collections.Counter()
+        self.closed = False
+        self.images = [make_images() for _ in range(max(1, concurrency))]
+        self.threads = [threading.Thread(target=self.worker, args=(images,), daemon=True)
+                        for images in self.images]
+        for thread in self.threads:
+            thread.start()
+
+    def resolve_file(self, name: str, path: str) -> str:
+        """The file a job option names, which must be inside ``files_dir``."""
+        if self.files_dir is None:
+            raise ValueError(f"{name} needs the service to be started with --serve-files")
+        resolved = os.path.realpath(os.path.join(self.files_dir, path))
+        if os.path.commonpath([resolved, self.files_dir]) != self.files_dir:
+            raise ValueError(f"{name} must be inside the service's files directory")
+        if not os.path.isfile(resolved):
+            raise ValueError(f"{name} {path!r} does not exist")
+        return resolved
+
+    def submit(self, job: Job) -> BuildJob:
+        """Queue a job, its files checked first (ValueError when they are refused)."""
+        if job.cover:
+            job.cover = self.resolve_file("cover", job.cover)
+        if job.update:
+            job.update = self.resolve_file("update", job.update)
+        build_job = BuildJob(uuid.uuid4().hex[:12], job, urlsplit(job.url).hostname or "")
+        with self.condition:
+            self.jobs[build_job.id] = build_job
+            self.queues.setdefault(build_job.host, collections.deque()).append(build_job)
+            self.condition.notify_all()
+        self.expire()
+        return build_job
+
+    def next_job(self) -> Optional[BuildJob]:
+        """Wait for the next job to run, None once the service is closed."""
+        with self.condition:
+            while not self.closed:
+                for host, queue in self.queues.items():
+                    if self.running[host] < self.per_host:
+                        build_job = queue.popleft()
+                        # the host goes to the back of the line
+                        del self.queues[host]
+                        if queue:
+                            self.queues[host] = queue
+                        self.running[host] += 1
+                        build_job.state = RUNNING
+                        build_job.started = time.time()
+                        return build_job
+                self.condition.wait()
+            return None
+
+    def worker(self, images: ImagePipeline):
+        while (build_job := self.next_job()) is not None:
+            job = build_job.job
+            output_dir = os.path.join(self.output_dir, build_job.id)
+            print(f"Building {job.url} as job {build_job.id}")
+            update = None
+            try:
+                if job.update:
+                    # the book in files_dir is left as it is
+                    os.makedirs(output_dir, exist_ok=True)
+                    update = os.path.join(output_dir, os.path.basename(job.update))
+                    shutil.copyfile(job.update, update)
+                paths = self.build(job.url, job.title, job.cover, job.add_cover_text, self.fetcher,
+                                   update, job.link_engine, job.max_pages if job.crawl else 1,
+                                   job.max_depth, images, job.link_filter, ui=False,
+                                   discover=job.discover, output_dir=output_dir,
+                                   progress=partial(self.progress, build_job), **self.options)
+                if update and not paths:
+                    # no new posts, the copy is the book
+                    paths = [update]
+                state, error = DONE, None
+            except Exception as e:
+                paths, state, error = None, FAILED, f"{type(e).__name__}: {e}"
+                print(f"Failed {job.url}: {error}")
+            images.forget()
+            with self.condition:
+                build_job.paths = paths or []
+                build_job.state = state
+                build_job.error = error
+                build_job.finished = time.time()
+                self.running[build_job.host] -= 1
+                self.finished.append(build_job)
+                self.counts[state] += 1
+                self.condition.notify_all()
+            self.expire()
+
+    def expire(self):
+        """Forget finished jobs past ``ttl`` or beyond the ``HISTORY`` newest, with their files."""
+        with self.condition:
+            finished = sorted((build_job for build_job in self.jobs.values()
+                               if build_job.state not in (QUEUED, RUNNING)),
+                              key=lambda build_job: build_job.finished)
+            deadline = time.time() - self.ttl
+            expired = [build_job for n, build_job in enumerate(finished)
+                       if build_job.finished < deadline or n < len(finished) - HISTORY]
+            for build_job in expired:
+                del self.jobs[build_job.id]
+        for build_job in expired:
+            self.remove_files(build_job)
+
+    def remove_files(self, build_job: BuildJob):
+        shutil.rmtree(os.path.join(self.output_dir, build_job.id), ignore_errors=True)
+
+    def progress(self, build_job: BuildJob, written: int, total: int):
+        with self.condition:
+            build_job.written = written
+            build_job.total = total
+
+    def get(self, job_id: str) -> Optional[BuildJob]:
+        with self.condition:
+            return self.jobs.get(job_id)
+
+    def wait(self, build_job: BuildJob, timeout: Optional[float] = None) -> bool:
+        """Wait for a job to end, returns whether it did."""
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: build_job.state not in (QUEUED, RUNNING), timeout)
+
+    def cancel(self, build_job: BuildJob) -> bool:
+        """Take a job off the queue, or forget a finished one and delete its files.
+
+        A running job cannot be stopped, returns False for it.
+        """
+        with self.condition:
+            if build_job.state == RUNNING:
+                return False
+            if build_job.state == QUEUED:
+                queue = self.queues[build_job.host]
+                queue.remove(build_job)
+                if not queue:
+                    del self.queues[build_job.host]
+                build_job.state = CANCELLED
+                build_job.finished = time.time()
+                self.counts[CANCELLED] += 1
+                self.condition.notify_all()
+            self.jobs.pop(build_job.id, None)
+        self.remove_files(build_job)
+        return True
+
+    def statuses(self) -> List[dict]:
+        with self.condition:
+            return [build_job.status() for build_job in self.jobs.values()]
+
+    def stats(self) -> dict:
+        """Queue depth and job timings, for capacity planning."""
+        with self.condition:
+            finished = [build_job for build_job in self.finished if build_job.state != CANCELLED]
+            return {
+                "workers": len(self.threads),
+                "queued": sum(len(queue) for queue in self.queues.values()),
+                "queued_by_host": {host: len(queue) for host, queue in self.queues.items()},
+                "running": sum(self.running.values()),
+                "running_by_host": {host: n for host, n in self.running.items() if n},
+                "finished": dict(self.counts),
+                "wait": timings([build_job.wait for build_job in finished]),
+                "build": timings([build_job.build for build_job in finished]),
+            }
+
+    def close(self):
+        """Stop taking jobs, wait for the running ones and release the resources."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        for images in self.images:
+            images.close()
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """JSON API of a ``BuildService``.
+
+    POST /jobs                  queue a job, the body holds its options
+    GET /jobs                   status of every job
+    GET /jobs/<id>              status of a job
+    GET /jobs/<id>/epub[/<n>]   the job's epub (or n-th volume), ?wait=1 waits for it
+    DELETE /jobs/<id>           cancel a queued job, or delete a finished one
+    GET /stats                  queue depth and timings
+    """
+    server_version = "blog-to-epub"
+    service: BuildService
+
+    def address_string(self) -> str:
+        # unix socket clients have no address
+        return self.client_address[0] if self.client_address else "local"
+
+    def send_json(self, status: int, body, headers: Optional[Dict[str, str]] = None):
+        data = json.dumps(body, indent=2).encode() + b"\n"
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_failure(self, status: int, message: str):
+        self.send_json(status, {"error": message})
+
+    def route(self):
+        """The path split into parts, the query and the job it names if any."""
+        url = urlsplit(self.path)
+        parts = [part for part in url.path.split("/") if part]
+        build_job = self.service.get(parts[1]) if len(parts) > 1 and parts[0] == "jobs" else None
+        return parts, parse_qs(url.query), build_job
+
+    def do_GET(self):
+        parts, query, build_job = self.route()
+        if parts == ["stats"]:
+            self.send_json(HTTPStatus.OK, self.service.stats())
+        elif parts == ["jobs"]:
+            self.send_json(HTTPStatus.OK, self.service.statuses())
+        elif build_job is None:
+            self.send_failure(HTTPStatus.NOT_FOUND, f"no such resource {self.path}")
+        elif len(parts) == 2:
+            self.send_json(HTTPStatus.OK, build_job.status())
+        elif parts[2] == "epub" and len(parts) <= 4:
+            self.send_epub(build_job, parts[3] if len(parts) == 4 else "1",
+                           query.get("wait", ["0"])[0] not in ("0", "false", ""))
+        else:
+            self.send_failure(HTTPStatus.NOT_FOUND, f"no such resource {self.path}")
+
+    def send_epub(self, build_job: BuildJob, volume: str, wait: bool):
+        if wait:
+            self.service.wait(build_job)
+        if build_job.state in (QUEUED, RUNNING):
+            self.send_failure(HTTPStatus.CONFLICT, f"job is {build_job.state}")
+            return
+        if build_job.state != DONE:
+            self.send_failure(HTTPStatus.CONFLICT, build_job.error or f"job is {build_job.state}")
+            return
+        if not volume.isdigit() or not 1 <= int(volume) <= len(build_job.paths):
+            self.send_failure(HTTPStatus.NOT_FOUND, f"job has {len(build_job.paths)} file(s)")
+            return
+        path = build_job.paths[int(volume) - 1]
+        try:
+            f = open(path, "rb")
+        except OSError as e:
+            self.send_failure(HTTPStatus.GONE, str(e))
+            return
+        with f:
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", "application/epub+zip")
+            self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+            self.send_header("Content-Disposition", f'attachment; filename="{os.path.basename(path)}"')
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile)
+
+    def do_POST(self):
+        parts, _, _ = self.route()
+        if parts != ["jobs"]:
+            self.send_failure(HTTPStatus.NOT_FOUND, f"no such resource {self.path}")
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_REQUEST:
+            self.send_failure(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "job description too large")
+            return
+        try:
+            options = json.loads(self.rfile.read(length) or b"null")
+            if isinstance(options, str):
+                options = {"url": options}
+            if not isinstance(options, dict):
+                raise ValueError("expected a url or an object of options")
+            job = parse_job(options, "job")
+            if not isinstance(job.url, str) or not urlsplit(job.url).hostname:
+                raise ValueError(f"job has no valid url: {job.url!r}")
+            build_job = self.service.submit(job)
+        except (ValueError, TypeError, re.error) as e:
+            self.send_failure(HTTPStatus.BAD_REQUEST, str(e))
+            return
+        self.send_json(HTTPStatus.ACCEPTED, build_job.status(),
+                       {"Location": f"/jobs/{build_job.id}"})
+
+    def do_DELETE(self):
+        parts, _, build_job = self.route()
+        if build_job is None or len(parts) != 2:
+            self.send_failure(HTTPStatus.NOT_FOUND, f"no such resource {self.path}")
+        elif not self.service.cancel(build_job):
+            self.send_failure(HTTPStatus.CONFLICT, "a running job cannot be cancelled")
+        else:
+            self.send_json(HTTPStatus.OK, build_job.status())
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def parse_address(address: str) -> Union[str, Tuple[str, int]]:
+    """The unix socket path or (host, port) of a service address, ValueError if it is neither.
+
+    An address holding a ``/`` is the path of a unix socket, anything else
+    is ``[host:]port`` and the host defaults to 127.0.0.1. A socket path
+    may only name a socket left by an earlier run, never another file.
+    """
+    if "/" in address:
+        try:
+            mode = os.stat(address).st_mode
+        except FileNotFoundError:
+            return address
+        if not stat.S_ISSOCK(mode):
+            raise ValueError(f"{address} exists and is not a socket")
+        return address
+    host, _, port = address.rpartition(":")
+    if not port.isdigit() or not 0 < int(port) < 65536:
+        raise ValueError(f"expected [HOST:]PORT or a unix socket path, not {address!r}")
+    return host or "127.0.0.1", int(port)
+
+
+def serve(service: BuildService, address: str):
+    """Answer requests on ``address`` until interrupted, then close the service."""
+    handler = type("Handler", (ServiceHandler,), {"service": service})
+    where = parse_address(address)
+    if isinstance(where, str):
+        if os.path.exists(where):
+            os.remove(where)  # a socket, parse_address refuses other files
+        server = UnixHTTPServer(where, handler)
+    else:
+        server = ThreadingHTTPServer(where, handler)
+    print(f"Serving on {address} with {len(service.threads)} worker(s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if "/" in address and os.path.exists(address):
+            os.remove(address)
+        service.close()
@@ -0,0 +1,187 @@
+"""
+Content root selectors learned per site
+
+Every post of a blog comes out of the same template, so the element that
+holds the post sits at the same place in each of them. The first posts
+of a host are looked up with the heuristics of ``sanitize`` and
+summarized; from those samples one precompiled XPath is learned that the
+remaining posts are looked up with.
+"""
+import logging
+import re
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from lxml import etree
+from lxml.html import HtmlElement
+
+import sanitize
+
+logger = logging.getLogger(__name__)
+
+#: posts summarized per host before a selector is learned
+SAMPLE_POSTS = 3
+
+#: share of a post's own text (what is not template boilerplate) a learned root must hold
+COVERAGE = 0.8
+
+#: elements that can hold a whole post, rather than one paragraph of it
+ROOT_TAGS = {'body', 'main', 'article', 'section', 'div', 'td'}
+
+#: subtrees whose text is never post content
+SKIPPED_TAGS = {'head', 'script', 'style', 'noscript', 'template'}
+
+#: tags usable as an XPath name test as they are
+XPATH_TAG = re.compile(r'^[A-Za-z_][\w.-]*$')
+
+#: ids and classes with digits usually differ per post (post-123), slashes would split a path
+UNUSABLE_VALUE = re.compile(r'[\d/]')
+
+
+def path_step(elem: HtmlElement) -> str:
+    """XPath step for an element, its id or class when they do not vary per post."""
+    tag = elem.tag if XPATH_TAG.match(elem.tag) else '*'
+    for attr in ('id', 'class'):
+        value = elem.get(attr)
+        if not value or UNUSABLE_VALUE.search(value):
+            continue
+        if '"' not in value:
+            return f'{tag}[@{attr}="{value}"]'
+        if "'" not in value:
+            return f"{tag}[@{attr}='{value}']"
+    return tag
+
+
+def element_path(elem: HtmlElement) -> str:
+    steps = [path_step(elem)] + [path_step(ancestor) for ancestor in elem.iterancestors()]
+    return '/' + '/'.join(reversed(steps))
+
+
+@dataclass
+class Sample:
+    #: path -> (number of elements on it, text length, text hash) of the first
+    nodes: Dict[str, Tuple[int, int, int]]
+    #: path of the root the heuristics picked, None when they fell back to the body
+    heuristic: Optional[str]
+    #: text length of the whole document
+    length: int
+
+
+def summarize(document: HtmlElement, root: HtmlElement) -> Sample:
+    """Text length and hash of the subtree at every element path of a document.
+
+    Subtrees are hashed from their text and their children's hashes, with
+    an explicit stack so deeply nested markup cannot hit the recursion limit.
+    """
+    nodes: Dict[str, Tuple[int, int, int]] = {}
+    path = top = '/' + path_step(document)
+    frames = [[iter(document), path, len(document.text or ''), [document.text]]]
+    while frames:
+        frame = frames[-1]
+        children, path = frame[0], frame[1]
+        child = next(children, None)
+        if child is not None:
+            frame[2] += len(child.tail or '')
+            frame[3].append(child.tail)
+            if isinstance(child.tag, str) and child.tag not in SKIPPED_TAGS:
+                frames.append([iter(child), f'{path}/{path_step(child)}',
+                               len(child.text or ''), [child.text]])
+            continue
+        frames.pop()
+        length, value = frame[2], hash(tuple(frame[3]))
+        count = nodes[path][0] + 1 if path in nodes else 1
+        nodes[path] = (count, length, value) if count == 1 else (count, *nodes[path][1:])
+        if frames:
+            frames[-1][2] += length
+            frames[-1][3].append(value)
+    heuristic = element_path(root) if root.tag not in ('html', 'body') else None
+    return Sample(nodes, heuristic, nodes[top][1])
+
+
+def learn(samples: List[Sample]) -> Optional[str]:
+    """Path of the content root shared by the sampled posts of one site.
+
+    Candidates are paths of block containers with exactly one element in
+    every sample whose text differs between samples; paths whose text is the same everywhere
+    are template boilerplate (menus, sidebars, footers). The heuristics'
+    pick is kept when they agree on a candidate below ``body``. Otherwise
+    the smallest candidate holding ``COVERAGE`` of every post's own text
+    (all of its text except the boilerplate) wins.
+    """
+    common = set(samples[0].nodes)
+    for sample in samples[1:]:
+        common &= set(sample.nodes)
+    common = {path for path in common if all(sample.nodes[path][0] == 1 for sample in samples)}
+    stable = {path for path in common if len({sample.nodes[path][2] for sample in samples}) == 1}
+    varying = common - stable
+    heuristics = {sample.heuristic for sample in samples}
+    if len(heuristics) == 1:
+        heuristic = heuristics.pop()
+        if heuristic is not None and heuristic in varying:
+            return heuristic
+    boilerplate = [path for path in stable if path.rsplit('/', 1)[0] not in stable]
+    candidates = {path for path in varying
+                  if path.rsplit('/', 1)[1].split('[', 1)[0] in ROOT_TAGS}
+    for sample in samples:
+        own = sample.length - sum(sample.nodes[path][1] for path in boilerplate)
+        candidates = {path for path in candidates
+                      if 0 < sample.nodes[path][1] >= COVERAGE * own}
+    if not candidates:
+        return None
+    return min(candidates, key=lambda path: (sum(sample.nodes[path][1] for sample in samples),
+                                             -path.count('/')))
+
+
+def compile_path(path: Optional[str]) -> Optional[etree.XPath]:
+    if path is None:
+        return None
+    try:
+        return etree.XPath(path)
+    except etree.XPathSyntaxError:
+        return None
+
+
+class SiteTemplates:
+    """Content root lookup that learns one selector per host.
+
+    Until ``samples`` posts of a host have been seen, posts are looked up
+    with ``sanitize.content_root`` and summarized. After that the learned
+    XPath is the only probe; posts it does not match (and hosts nothing
+    could be learned for) fall back to the heuristics. Safe to share
+    between render threads; every render worker process learns on its own.
+    """
+
+    def __init__(self, samples: int = SAMPLE_POSTS):
+        self.samples = samples
+        self.lock = threading.Lock()
+        self.sampled: Dict[str, List[Sample]] = {}
+        self.selectors: Dict[str, Optional[etree.XPath]] = {}
+
+    def content_root(self, document: HtmlElement, url: Optional[str] = None) -> HtmlElement:
+        """Return the element holding the post content of ``url``."""
+        host = urlsplit(url).netloc.lower() if url else ''
+        if not host:
+            return sanitize.content_root(document)
+        if host in self.selectors:
+            xpath = self.selectors[host]
+            found = xpath(document) if xpath is not None else None
+            return found[0] if found else sanitize.content_root(document)
+        root = sanitize.content_root(document)
+        sample = summarize(document, root)
+        with self.lock:
+            if host in self.selectors:
+                return root
+            samples = self.sampled.setdefault(host, [])
+            samples.append(sample)
+            if len(samples) >= self.samples:
+                path = learn(samples)
+                logger.info('content root of %s: %s', host, path or 'heuristics')
+                self.selectors[host] = compile_path(path)
+                del self.sampled[host]
+        return root
+
+
+#: selectors learned in this process
+TEMPLATES = SiteTemplates()
@@ -0,0 +1,201 @@
+import os
+import re
+import shutil
+import tempfile
+import threading
+from typing import List, Optional, Tuple
+
+import pypub
+from pypub.builder import (STATIC, MimeFile, epub_dirs, generate_cover,
+                           get_extension, jinja_env)
+
+import instrument
+from archive import DEFAULT_LEVEL, ZIP_STORED, ZipWriter
+import pypubpatch  # noqa: F401 (patches render_content onto the builder)
+
+IMAGE_SRC = re.compile(rb'\ssrc="images/([^"/]+)"')
+
+
+class StreamingEpubBuilder(pypub.EpubBuilder):
+    """Epub builder that writes straight into the output archive.
+
+    Static files and the cover are written by ``begin``, each chapter is
+    added to the zip as soon as it is rendered (in any order), and the
+    OPF/NCX/TOC index is written last by ``index``. The archive is built
+    under ``<fpath>.part`` and only moved into place by ``compress``.
+    Text entries are deflated at ``compress_level`` on ``ZipWriter``'s
+    threads, images are stored as they are.
+    Images are moved into the archive right after their chapter, either
+    from the factory's ``ImagePipeline`` or, for pypub's default factory,
+    from the scratch directory it downloads them into.
+    """
+
+    def __init__(self, epub: pypub.Epub, compress_level: int = DEFAULT_LEVEL):
+        super().__init__(epub)
+        self.compress_level = compress_level
+        self.fpath: Optional[str] = None
+        self.partial: Optional[str] = None
+        self.zipf: Optional[ZipWriter] = None
+        self.styles = []
+        self.images = []
+        self.image_names = set()
+        self.rejected = []
+        self.lock = threading.Lock()
+
+    def write(self, name: str, data: bytes, compress_type: Optional[int] = None):
+        """Write a single entry (relative to the archive root) into the epub."""
+        with self.lock:
+            self.zipf.write(name, data, compress_type)
+
+    def write_static(self, fpath: str, name: str, compress_type: Optional[int] = None):
+        with open(os.path.join(STATIC, fpath), "rb") as f:
+            self.write(name, f.read(), compress_type)
+
+    def add_style(self, path: str):
+        fname = os.path.basename(path)
+        with open(path, "rb") as f:
+            self.write(f"OEBPS/styles/{fname}", f.read())
+        self.styles.append(fname)
+
+    def add_image(self, fname: str, data: bytes):
+        # pipeline images are named by content, one imported by --update is
+        # the same image
+        if fname in self.image_names:
+            return
+        self.image_names.add(fname)
+        self.write(f"OEBPS/images/{fname}", data)
+        if fname != self.cover:
+            self.images.append(MimeFile(fname, get_extension(fname)))
+
+    def flush_images(self):
+        """Move images downloaded by the chapter factory into the archive."""
+        pipeline = getattr(self.factory, "images", None)
+        if pipeline is not None:
+            for fname, data in pipeline.drain():
+                self.add_image(fname, data)
+        for fname in os.listdir(self.dirs.images):
+            path = os.path.join(self.dirs.images, fname)
+            with open(path, "rb") as f:
+                self.add_image(fname, f.read())
+            os.remove(path)
+
+    def missing_images(self, content: bytes) -> List[Tuple[str, bytes]]:
+        """Pipeline images a rendered chapter uses that the archive lacks."""
+        pipeline = getattr(self.factory, "images", None)
+        if pipeline is None:
+            return []
+        missing = []
+        for name in dict.fromkeys(IMAGE_SRC.findall(content)):
+            name = name.decode()
+            data = pipeline.image_data(name) if name not in self.image_names else None
+            if data is not None:
+                missing.append((name, data))
+        return missing
+
+    def prepare(self):
+        """load the page template and scratch space needed to render chapters"""
+        if not self.template:
+            self.template = jinja_env.get_template("page.xhtml.j2")
+        if not self.dirs:
+            # only the image directory is used, as scratch space for downloads
+            self.dirs = epub_dirs()
+        return self.dirs
+
+    def begin(self, fpath: Optional[str] = None):
+        """begin building operations by opening the archive w/ static files"""
+        if self.zipf:
+            return self.dirs
+        self.prepare()
+        args = (self.epub.title, self.epub.creator)
+        self.logger.info("generating: %r (by: %s)" % args)
+        self.fpath = fpath
+        if fpath:
+            self.partial = f"{fpath}.part"
+        else:
+            handle, self.partial = tempfile.mkstemp(suffix=".epub.part", dir=".")
+            os.close(handle)
+        self.zipf = ZipWriter(self.partial, self.compress_level)
+        # mimetype must be the first entry, uncompressed
+        self.write_static("mimetype", "mimetype", ZIP_STORED)
+        self.write_static("container.xml", "META-INF/container.xml")
+        for css in ("css/coverpage.css", "css/styles.css"):
+            self.add_style(os.path.join(STATIC, css))
+        for path in self.epub.css_paths:
+            self.add_style(path)
+        # generate cover-image
+        if self.epub.cover is not None:
+            self.cover = os.path.basename(self.epub.cover)
+            with open(self.epub.cover, "rb") as f:
+                self.add_image(self.cover, f.read())
+        else:
+            self.logger.info("generating cover-image (%r by %r)" % args)
+            self.cover = generate_cover(*args, self.dirs.images)
+            self.flush_images()
+        # render cover-page
+        template = jinja_env.get_template("coverpage.xhtml.j2")
+        cover = template.render(cover=f"images/{self.cover}", epub=self.epub)
+        self.write("OEBPS/coverpage.xhtml", cover.encode(self.encoding))
+        return self.dirs
+
+    def add_rendered(self, assign: pypub.Assignment, chapter: pypub.Chapter,
+                     content: bytes):
+        """Add an already rendered chapter to the archive."""
+        self.write(f"OEBPS/{assign.link}", content)
+        # keep only what the index needs, the content is in the archive now
+        stub = pypub.Chapter(chapter.title, b"", chapter.url)
+        with self.lock:
+            self.chapters.append((assign, stub))
+
+    def render_chapter(self, assign: pypub.Assignment, chapter: pypub.Chapter):
+        """render an assigned chapter straight into the archive"""
+        with instrument.stage("render_chapter"):
+            content = self.render_content(assign, chapter)
+        self.flush_images()
+        if content is not None:
+            self.add_rendered(assign, chapter, content)
+
+    def index(self):
+        """write index files for the epub after every chapter"""
+        if not self.zipf or not self.cover:
+            raise RuntimeError("cannot index epub before `begin`")
+        # chapters may finish in any order, play order follows assignment
+        self.chapters.sort(key=lambda item: item[0].play_order)
+        for order, (assign, _) in enumerate(self.chapters, 1):
+            assign.play_order = order
+        kwargs = {
+            "uid":      self.uid,
+            "epub":     self.epub,
+            "cover":    MimeFile(self.cover, get_extension(self.cover)),
+            "styles":   self.styles,
+            "chapters": self.chapters,
+            "images":   self.images,
+        }
+        self.logger.info("epub=%r, writing final templates" % self.epub.title)
+        for name in ("book.ncx.j2", "book.opf.j2", "toc.xhtml.j2"):
+            content = jinja_env.get_template(name).render(**kwargs)
+            self.write(f"OEBPS/{name.rsplit('.j2', 1)[0]}",
+                       content.encode(self.encoding))
+
+    def compress(self, fpath: Optional[str] = None) -> str:
+        """close the archive and move it into place"""
+        if not self.zipf:
+            raise RuntimeError("cannot finalize before `begin`")
+        fpath = fpath or self.fpath or self.epub.title
+        fpath = fpath.rsplit(".epub", 1)[0] + ".epub"
+        self.logger.info("epub=%r, closing archive" % self.epub.title)
+        self.zipf.close()
+        self.zipf = None
+        shutil.move(self.partial, fpath)
+        self.partial = None
+        return fpath
+
+    def cleanup(self):
+        """remove the scratch directory and any unfinished archive"""
+        if self.zipf:
+            self.zipf.discard()
+            self.zipf = None
+        if self.partial and os.path.exists(self.partial):
+            os.remove(self.partial)
+        if self.dirs:
+            shutil.rmtree(self.dirs.basedir, ignore_errors=True)
+            self.dirs = None
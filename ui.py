@@ -0,0 +1,79 @@
+from typing import Callable, List, Optional
+
+from PyQt5.QtWidgets import QApplication, QMainWindow, QVBoxLayout, \
+      QListWidget, QPushButton, QWidget, QMessageBox
+
+
+class LinkManager(QMainWindow):
+    def __init__(self, links, on_change: Optional[Callable[[List[str]], None]] = None):
+        super().__init__()
+        self.setWindowTitle("Select links for epub")
+        self.result = []
+        self.on_change = on_change
+        self.init_ui(links)
+
+    def init_ui(self, links):
+        # Main layout
+        self.central_widget = QWidget()
+        self.setCentralWidget(self.central_widget)
+        layout = QVBoxLayout()
+
+        # List widget to display links
+        self.list_widget = QListWidget()
+        self.list_widget.addItems(links)
+        self.list_widget.setSelectionMode(QListWidget.MultiSelection)
+        layout.addWidget(self.list_widget)
+
+        # Buttons
+        self.exclude_button = QPushButton("Exclude selected")
+        self.exclude_button.clicked.connect(self.exclude_selected)
+        layout.addWidget(self.exclude_button)
+
+        self.reverse_button = QPushButton("Reverse order")
+        self.reverse_button.clicked.connect(self.reverse_order)
+        layout.addWidget(self.reverse_button)
+
+        self.submit_button = QPushButton("Submit")
+        self.submit_button.clicked.connect(self.submit)
+        layout.addWidget(self.submit_button)
+
+        # Set layout
+        self.central_widget.setLayout(layout)
+
+    def links(self) -> List[str]:
+        return [self.list_widget.item(i).text() for i in range(self.list_widget.count())]
+
+    def changed(self):
+        if self.on_change:
+            self.on_change(self.links())
+
+    def exclude_selected(self):
+        for item in self.list_widget.selectedItems():
+            self.list_widget.takeItem(self.list_widget.row(item))
+        self.changed()
+
+    def reverse_order(self):
+        items = self.links()
+        self.list_widget.clear()
+        self.list_widget.addItems(reversed(items))
+        self.changed()
+
+    def submit(self):
+        self.result = self.links()
+        if not self.result:
+            QMessageBox.critical(self, "Error", "No links left to process!")
+            return
+        self.close()
+
+
+def select_links(links: List[str],
+                 on_change: Optional[Callable[[List[str]], None]] = None) -> List[str]:
+    """Let the user exclude and reorder links, returns the submitted list.
+
+    ``on_change`` is called with the list every time the user edits it.
+    """
+    app = QApplication([])
+    manager = LinkManager(links, on_change)
+    manager.show()
+    app.exec_()
+    return manager.result
@@ -0,0 +1,115 @@
+import posixpath
+import zipfile
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import pypub
+from lxml import etree
+
+from pypubpatch import SOURCE_META
+from streambuilder import StreamingEpubBuilder
+
+NAMESPACES = {
+    "opf": "http://www.idpf.org/2007/opf",
+    "dc": "http://purl.org/dc/elements/1.1/",
+    "ncx": "http://www.daisy.org/z3986/2005/ncx/",
+    "container": "urn:oasis:names:tc:opendocument:xmlns:container",
+}
+
+
+class UpdateError(ValueError):
+    """An existing book cannot be updated."""
+
+
+@dataclass
+class ExistingChapter:
+    id: str
+    link: str
+    play_order: int
+    title: str
+    source: Optional[str]
+
+
+@dataclass
+class ExistingBook:
+    path: str
+    title: str
+    oebps: str
+    chapters: List[ExistingChapter] = field(default_factory=list)
+    images: List[str] = field(default_factory=list)
+
+    @property
+    def sources(self) -> set:
+        return {chapter.source for chapter in self.chapters if chapter.source}
+
+    @property
+    def last_chapter(self) -> int:
+        numbers = [int(chapter.id.rsplit("_", 1)[-1]) for chapter in self.chapters
+                   if chapter.id.rsplit("_", 1)[-1].isdigit()]
+        return max(numbers + [len(self.chapters)])
+
+
+def chapter_source(content: bytes) -> Optional[str]:
+    """Return the source url recorded in a rendered chapter, if any."""
+    root = etree.fromstring(content, etree.XMLParser(recover=True))
+    if root is None:
+        return None
+    for meta in root.iter("{*}meta"):
+        if meta.get("name") == SOURCE_META:
+            return meta.get("content")
+    return None
+
+
+def read_epub(path: str) -> ExistingBook:
+    """Read the manifest, table of contents and chapter sources of an epub."""
+    with zipfile.ZipFile(path) as archive:
+        container = etree.fromstring(archive.read("META-INF/container.xml"))
+        opf_path = container.xpath("//container:rootfile/@full-path",
+                                   namespaces=NAMESPACES)[0]
+        oebps = posixpath.dirname(opf_path)
+        opf = etree.fromstring(archive.read(opf_path))
+        title = opf.findtext(".//dc:title", default="", namespaces=NAMESPACES)
+
+        manifest = {item.get("id"): item for item in
+                    opf.iterfind(".//opf:manifest/opf:item", NAMESPACES)}
+        ncx = etree.fromstring(archive.read(posixpath.join(oebps, "book.ncx")))
+        titles = {
+            point.get("id"): point.findtext("ncx:navLabel/ncx:text", default="",
+                                            namespaces=NAMESPACES)
+            for point in ncx.iterfind(".//ncx:navPoint", NAMESPACES)
+        }
+
+        book = ExistingBook(path, title, oebps)
+        spine = [ref.get("idref") for ref in
+                 opf.iterfind(".//opf:spine/opf:itemref", NAMESPACES)]
+        for idref in spine:
+            if idref not in titles or idref not in manifest:
+                continue  # cover page and table of contents
+            link = manifest[idref].get("href")
+            content = archive.read(posixpath.join(oebps, link))
+            book.chapters.append(ExistingChapter(
+                idref, link, len(book.chapters) + 1, titles[idref],
+                chapter_source(content)))
+        for id, item in manifest.items():
+            href = item.get("href")
+            if id != "cover_img" and href.startswith("images/"):
+                book.images.append(href)
+    return book
+
+
+def import_book(builder: StreamingEpubBuilder, book: ExistingBook) -> int:
+    """Copy the chapters and images of an existing book into a new build.
+
+    The chapters are copied as already rendered xhtml, ahead of any chapters
+    rendered afterwards. Returns the number to give the next new chapter.
+    """
+    with zipfile.ZipFile(book.path) as archive:
+        for chapter in book.chapters:
+            assign = pypub.Assignment(chapter.id, chapter.link, chapter.play_order)
+            content = archive.read(posixpath.join(book.oebps, chapter.link))
+            builder.add_rendered(
+                assign, pypub.Chapter(chapter.title, b"", chapter.source), content)
+        for image in book.images:
+            builder.add_image(posixpath.basename(image),
+                              archive.read(posixpath.join(book.oebps, image)))
+    return book.last_chapter + 1
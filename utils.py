@@ -1,12 +1,19 @@
-import re
 from collections import defaultdict
+from functools import lru_cache
+from io import BytesIO
 import json
 from urllib.parse import urljoin
 import requests
 from bs4 import BeautifulSoup
 from PIL import Image, ImageDraw, ImageFont
 from concurrent.futures import ThreadPoolExecutor
+import pypub
+from pypub.chapter import convert_content
 from pil_autowrap import fit_text
+import instrument
+from decode import declare_charset
+from fetch import Fetcher
+from links import find_post_links, is_image_url
 
 class Node:
     def __init__(self, root):
@@ -40,13 +47,23 @@ def get_request_headers():
     }
     return headers
 
-def is_image_url(url):
-    image_extensions = re.compile(r'\.(jpg|jpeg|png|gif|bmp|tiff|webp|svg)$', re.IGNORECASE)
-    return bool(image_extensions.search(url))
+def get_post_links(url, fetcher=None, engine="soup"):
+    fetcher = fetcher or Fetcher()
+    response = fetcher.fetch(url, headers=get_request_headers())
+    return detect_post_links(response, url, engine)
 
-def get_post_links(url):
-    soup = BeautifulSoup(requests.get(url, 
-            headers=get_request_headers()).text, features="html.parser")
+def detect_post_links(response, url, engine="soup"):
+    """Run repeating-subtree link detection over a fetched index page."""
+    with instrument.stage("detect_links"):
+        if engine == "lxml":
+            # only trust an explicit charset, otherwise let lxml read <meta charset>
+            content_type = response.headers.get("Content-Type", "").lower()
+            encoding = response.encoding if "charset" in content_type else None
+            return find_post_links(response.content, url, encoding)
+        return find_post_links_soup(response.text, url)
+
+def find_post_links_soup(html, url):
+    soup = BeautifulSoup(html, features="html.parser")
 
     node_registry = defaultdict(list)
     subtree_sizes = defaultdict(int)
@@ -96,10 +113,11 @@ def get_post_links(url):
 def depipe(text):
     return text.split("|")[0].strip()
 
-def fetch_title(url: str) -> str:
+def fetch_title(url: str, fetcher=None) -> str:
     """Fetch the title of a webpage given its URL."""
+    fetcher = fetcher or Fetcher()
     try:
-        response = requests.get(url, timeout=5)  # Set a timeout for the request
+        response = fetcher.fetch(url, timeout=5)  # Set a timeout for the request
         response.raise_for_status()  # Raise an error for HTTP codes 4xx/5xx
         soup = BeautifulSoup(response.text, 'html.parser')
         title_tag = soup.find('title')
@@ -108,6 +126,17 @@ def fetch_title(url: str) -> str:
         print(f"Error fetching {url}: {e}")
         return 'Error fetching title'
 
+def fetch_chapter(url: str, fetcher=None) -> pypub.Chapter:
+    """Fetch a blog post as a chapter over the shared connection pool."""
+    fetcher = fetcher or Fetcher()
+    response = fetcher.fetch(url, headers=get_request_headers())
+    response.raise_for_status()
+    html = convert_content(url, response.content)
+    if html is response.content:
+        # the chapter keeps only the bytes, so they must name their own charset
+        html = declare_charset(html, response.headers)
+    return pypub.create_chapter_from_html(html, url=url)
+
 def get_titles_from_links(links):
     """Fetch titles from a list of links concurrently."""
     titles = []
@@ -116,19 +145,44 @@ def get_titles_from_links(links):
         titles = list(results)
     return titles
 
-def add_formatted_text_to_cover(image_path, title, url, output_path):
-    img = Image.open(image_path)
+@lru_cache(maxsize=8)
+def load_font(path, size):
+    """Load a font once, batch builds share it (and its measured glyphs) across books."""
+    return ImageFont.truetype(path, size=size)
+
+@lru_cache(maxsize=8)
+def load_cover(image_path):
+    """Decode a cover image once per process, callers draw on a copy."""
+    with Image.open(image_path) as img:
+        img.load()
+        return img
+
+@lru_cache(maxsize=64)
+def render_cover(image_path, title, url, size, volume=None):
+    """Render the title, url and volume number onto a cover of the given size, as png bytes."""
+    img = load_cover(image_path)
+    img = img.resize(size) if img.size != size else img.copy()
     draw = ImageDraw.Draw(img)
     
     color = "#130D0B"
     title_position = (56, 122)
     url_position = (56, 260)
+    volume_position = (56, 300)
 
-    font = ImageFont.truetype("fonts/OpenSans-Regular.ttf", size=100)
+    font = load_font("fonts/OpenSans-Regular.ttf", 100)
     title_font, wrapped_title_text = fit_text(font, title, 284, 120, max_iterations=10)
     url_font, wrapped_url_text = fit_text(font, url, 284, 14, max_iterations=10)
     
     draw.text(title_position, wrapped_title_text, font=title_font, fill=color)
     draw.text(url_position, wrapped_url_text, font=url_font, fill=color)
+    if volume is not None:
+        draw.text(volume_position, f"Vol. {volume}", font=load_font("fonts/OpenSans-Regular.ttf", 36), fill=color)
     
-    img.save(output_path)
+    output = BytesIO()
+    img.save(output, "PNG")
+    return output.getvalue()
+
+def add_formatted_text_to_cover(image_path, title, url, output_path, size=None, volume=None):
+    size = size or load_cover(image_path).size
+    with open(output_path, "wb") as f:
+        f.write(render_cover(image_path, title, url, tuple(size), volume))
@@ -0,0 +1,81 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+import pypub
+
+import instrument
+from streambuilder import StreamingEpubBuilder
+
+
+class VolumeWriter:
+    """Write rendered chapters, in order, into a book split into volumes.
+
+    ``open_volume(number)`` returns a begun builder for volume ``number``
+    (from 1). The next volume is begun once the current one holds
+    ``max_chapters`` chapters, or when the next chapter and its images
+    would take it past ``max_bytes`` bytes (uncompressed). Without either
+    limit everything goes into the first volume. Each volume carries the
+    images its own chapters use. A finished volume is indexed and
+    compressed on a background thread while the next one is written.
+    """
+
+    def __init__(self, open_volume: Callable[[int], StreamingEpubBuilder],
+                 max_chapters: Optional[int] = None, max_bytes: Optional[int] = None,
+                 threads: int = 2):
+        self.open_volume = open_volume
+        self.max_chapters = max_chapters
+        self.max_bytes = max_bytes
+        self.finishing = ThreadPoolExecutor(threads)
+        self.finished: List[Future] = []
+        self.builders: List[StreamingEpubBuilder] = []
+        self.builder: Optional[StreamingEpubBuilder] = None
+        self.chapters = 0
+        self.bytes = 0
+        self.next_volume()
+
+    def next_volume(self):
+        if self.builder is not None:
+            self.finished.append(self.finishing.submit(self.finish, self.builder))
+        self.builder = self.open_volume(len(self.builders) + 1)
+        self.builders.append(self.builder)
+        self.chapters = len(self.builder.chapters)
+        self.bytes = 0
+
+    def full(self, size: int) -> bool:
+        """Whether a chapter of ``size`` bytes belongs in the next volume."""
+        if not self.chapters:
+            return False
+        if self.max_chapters is not None and self.chapters >= self.max_chapters:
+            return True
+        return self.max_bytes is not None and self.bytes + size > self.max_bytes
+
+    def write(self, assign: pypub.Assignment, chapter: pypub.Chapter, content: bytes):
+        images = self.builder.missing_images(content)
+        size = len(content) + sum(len(data) for _, data in images)
+        if self.full(size):
+            self.next_volume()
+            images = self.builder.missing_images(content)
+            size = len(content) + sum(len(data) for _, data in images)
+        for name, data in images:
+            self.builder.add_image(name, data)
+        self.builder.add_rendered(assign, chapter, content)
+        self.chapters += 1
+        self.bytes += size
+
+    @staticmethod
+    def finish(builder: StreamingEpubBuilder) -> str:
+        with instrument.stage("index"):
+            builder.index()
+        with instrument.stage("compress"):
+            return builder.compress()
+
+    def close(self) -> List[str]:
+        """Finish the last volume, returns the paths of every volume."""
+        self.finished.append(self.finishing.submit(self.finish, self.builder))
+        return [future.result() for future in self.finished]
+
+    def cleanup(self):
+        """Wait for volumes being finished and remove what is left of unfinished ones."""
+        self.finishing.shutdown(wait=True)
+        for builder in self.builders:
+            builder.cleanup()